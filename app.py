@@ -4,7 +4,7 @@ Application Locator - Gestion de Location Immobilière
 
 import streamlit as st
 import pandas as pd
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 import plotly.express as px
 import plotly.graph_objects as go
 from src import database as db
@@ -13,6 +13,12 @@ from src import quittance as qt
 from src import email_alerts as ea
 import os
 
+# Types MIME des formats de quittance
+MIME_QUITTANCE = {
+    'docx': "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    'pdf': "application/pdf",
+}
+
 # Configuration de la page
 st.set_page_config(
     page_title="Locator - Gestion Locative",
@@ -28,6 +34,9 @@ if 'initialized' not in st.session_state:
     fm.init_directories()
     st.session_state.initialized = True
 
+# Worker d'envoi des emails en arrière-plan (un par processus)
+ea.demarrer_worker_emails()
+
 # Styles CSS personnalisés
 st.markdown("""
 <style>
@@ -130,6 +139,37 @@ if menu == "📊 Dashboard":
             df_impayés = pd.DataFrame(impayés_data)
             st.dataframe(df_impayés, use_container_width=True)
     
+    # Balance âgée des impayés
+    anciennete = db.get_anciennete_impayes()
+    if anciennete['lignes']:
+        st.markdown("---")
+        st.subheader("⏳ Ancienneté des impayés")
+        
+        libelles = {cle: libelle for cle, libelle, _, _ in db.TRANCHES_ANCIENNETE}
+        totaux = anciennete['totaux']
+        
+        cols = st.columns(len(libelles) + 1)
+        for col, (cle, libelle) in zip(cols, libelles.items()):
+            col.metric(libelle, f"{totaux[cle]:.2f} €")
+        cols[-1].metric("Total dû", f"{totaux['total']:.2f} €")
+        
+        tab_loc, tab_appt = st.tabs(["👥 Par locataire", "🏢 Par appartement"])
+        
+        with tab_loc:
+            df_anciennete = pd.DataFrame(anciennete['lignes'])
+            df_anciennete = df_anciennete[['locataire', 'adresse'] + list(libelles) + ['total']]
+            df_anciennete = df_anciennete.rename(columns={'locataire': 'Locataire', 'adresse': 'Appartement', 'total': 'Total', **libelles})
+            st.dataframe(df_anciennete, use_container_width=True, hide_index=True)
+        
+        with tab_appt:
+            df_appt = pd.DataFrame(anciennete['par_appartement'])
+            fig = go.Figure(data=[
+                go.Bar(name=libelle, x=df_appt['adresse'], y=df_appt[cle])
+                for cle, libelle in libelles.items()
+            ])
+            fig.update_layout(barmode='stack', title_text="Montants dus par ancienneté", yaxis_title="€")
+            st.plotly_chart(fig, use_container_width=True)
+    
     # Graphiques
     st.markdown("---")
     st.subheader("📈 Analyses")
@@ -149,6 +189,48 @@ if menu == "📊 Dashboard":
         # Graphique des revenus (exemple simplifié)
         # TODO: Ajouter un graphique d'évolution des revenus mensuels
         st.info("📊 Graphique d'évolution des revenus - À venir")
+    
+    # Occupation mensuelle déduite des baux
+    st.markdown("---")
+    st.subheader("🗓️ Occupation mensuelle")
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        occ_debut = st.date_input("Du", value=date(date.today().year - 1, date.today().month, 1), key="occ_debut")
+    with col2:
+        occ_fin = st.date_input("Au", value=date.today(), key="occ_fin")
+    
+    if occ_debut > occ_fin:
+        st.error("La date de début doit précéder la date de fin")
+    else:
+        occupation = db.get_occupation_mensuelle(occ_debut, occ_fin)
+        matrice = occupation['matrice']
+        
+        if matrice.size == 0:
+            st.info("Aucune chambre enregistrée")
+        else:
+            st.metric("📊 Taux d'occupation sur la période", f"{matrice.mean() * 100:.1f}%")
+            
+            chambres_par_id = {c.id: c for c in db.get_all_chambres()}
+            appartements_par_id = {a.id: a for a in db.get_all_appartements()}
+            libelles_chambres = []
+            for chambre_id in occupation['chambre_ids']:
+                ch = chambres_par_id[int(chambre_id)]
+                appt = appartements_par_id.get(ch.appartement_id)
+                libelles_chambres.append(f"{appt.adresse if appt else '?'} - {ch.numero}")
+            libelles_mois = [f"{m:02d}/{a}" for a, m in occupation['mois']]
+            
+            fig = px.imshow(
+                matrice.astype(int),
+                x=libelles_mois,
+                y=libelles_chambres,
+                color_continuous_scale=[[0, '#ffebee'], [1, '#4caf50']],
+                zmin=0,
+                zmax=1,
+                aspect='auto'
+            )
+            fig.update_layout(title_text="Chambres occupées par mois", coloraxis_showscale=False)
+            st.plotly_chart(fig, use_container_width=True)
 
 
 # ==================== APPARTEMENTS ====================
@@ -806,17 +888,11 @@ elif menu == "💰 Paiements":
                             chambre = db.get_chambre_by_id(paiement.chambre_id)
                             appt = db.get_appartement_by_id(chambre.appartement_id)
                             
-                            # Générer la quittance
-                            quittance_path = qt.generer_quittance_simple(
+                            # Générer la quittance directement dans le répertoire du locataire
+                            final_path = qt.generer_quittance_simple(
                                 locataire, chambre, appt, paiement, paiement.mois, paiement.annee
                             )
                             
-                            # Sauvegarder dans le répertoire du locataire
-                            final_path = fm.save_quittance_file(
-                                quittance_path, locataire.nom,
-                                paiement.annee, paiement.mois
-                            )
-                            
                             # Marquer comme quittance générée
                             db.update_paiement(paiement_id, quittance_generee=True)
                             
@@ -857,27 +933,28 @@ elif menu == "💰 Paiements":
                     chambre = db.get_chambre_by_id(paiement.chambre_id)
                     appt = db.get_appartement_by_id(chambre.appartement_id)
                     
-                    quittance_path = qt.generer_quittance_simple(
-                        locataire, chambre, appt, paiement, mois_quittance, annee_quittance
+                    # Rendre en mémoire, puis enregistrer dans le répertoire du locataire
+                    contenu = qt.render_quittance(
+                        locataire, None, chambre, appt, paiement, mois_quittance, annee_quittance, modele='simple'
                     )
-                    
+                    filename = qt.nom_fichier_quittance(locataire, mois_quittance, annee_quittance, modele='simple')
                     final_path = fm.save_quittance_file(
-                        quittance_path, locataire.nom,
-                        annee_quittance, mois_quittance
+                        contenu, filename, locataire.nom,
+                        annee_quittance, mois_quittance,
+                        document=qt.index_quittance(locataire, paiement, mois_quittance, annee_quittance)
                     )
                     
                     db.update_paiement(paiement.id, quittance_generee=True)
                     
                     st.success(f"✅ Quittance générée : {final_path}")
                     
-                    # Proposer le téléchargement
-                    with open(final_path, 'rb') as f:
-                        st.download_button(
-                            label="📥 Télécharger la quittance",
-                            data=f,
-                            file_name=os.path.basename(final_path),
-                            mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-                        )
+                    # Proposer le téléchargement depuis la mémoire
+                    st.download_button(
+                        label="📥 Télécharger la quittance",
+                        data=contenu,
+                        file_name=filename,
+                        mime=MIME_QUITTANCE['docx']
+                    )
 
 
 # ==================== FACTURES ====================
@@ -955,7 +1032,8 @@ elif menu == "📄 Factures":
                         date_paiement = None
                 
                 description = st.text_area("Description")
-                fichier = st.file_uploader("Joindre un fichier (PDF, image)", type=['pdf', 'jpg', 'jpeg', 'png'])
+                fichier = st.file_uploader("Joindre un fichier (PDF, image)", type=['pdf', 'jpg', 'jpeg', 'png'],
+                                           help=f"{fm.FACTURE_TAILLE_MAX / (1024 * 1024):g} Mo maximum")
                 
                 submitted = st.form_submit_button("💾 Enregistrer la facture")
                 
@@ -963,29 +1041,37 @@ elif menu == "📄 Factures":
                     if montant > 0:
                         # Sauvegarder le fichier si fourni
                         fichier_path = ""
+                        fichier_refuse = None
                         if fichier:
                             appt = db.get_appartement_by_id(appt_id)
-                            fichier_path = fm.save_facture_file(
-                                fichier,
-                                appt.adresse,
-                                date_facture.year,
-                                fichier.name
-                            )
-                        
-                        # Créer la facture
-                        db.create_facture(
-                            appartement_id=appt_id,
-                            categorie=categorie,
-                            montant=montant,
-                            date_facture=date_facture,
-                            fournisseur=fournisseur,
-                            description=description,
-                            fichier_path=fichier_path,
-                            statut=statut
-                        )
+                            try:
+                                fichier_path = fm.save_facture_file(
+                                    fichier,
+                                    appt.adresse,
+                                    date_facture.year,
+                                    fichier.name,
+                                    appartement_id=appt.id
+                                )
+                            except fm.FichierTropVolumineux as e:
+                                fichier_refuse = e
                         
-                        st.success("✅ Facture enregistrée avec succès!")
-                        st.rerun()
+                        if fichier_refuse:
+                            st.error(f"❌ {fichier_refuse}")
+                        else:
+                            # Créer la facture
+                            db.create_facture(
+                                appartement_id=appt_id,
+                                categorie=categorie,
+                                montant=montant,
+                                date_facture=date_facture,
+                                fournisseur=fournisseur,
+                                description=description,
+                                fichier_path=fichier_path,
+                                statut=statut
+                            )
+                            
+                            st.success("✅ Facture enregistrée avec succès!")
+                            st.rerun()
                     else:
                         st.error("Le montant doit être supérieur à 0")
 
@@ -995,6 +1081,131 @@ elif menu == "📄 Factures":
 elif menu == "📝 Quittances":
     st.markdown("<h1 class='main-header'>📝 Gestion des Quittances</h1>", unsafe_allow_html=True)
     
+    # Génération groupée de fin de mois
+    with st.expander("📦 Génération groupée de fin de mois"):
+        appartements_lot = db.get_all_appartements()
+        
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            annee_lot = st.number_input("Année", min_value=2020, max_value=2030, value=datetime.now().year, key="annee_lot")
+        with col2:
+            mois_lot = st.number_input("Mois", min_value=1, max_value=12, value=datetime.now().month, key="mois_lot")
+        with col3:
+            appt_lot_options = {"Tous les appartements": None}
+            appt_lot_options.update({f"{a.adresse} - {a.ville}": a.id for a in appartements_lot})
+            appt_lot_nom = st.selectbox("Appartement", list(appt_lot_options.keys()), key="appt_lot")
+            appt_lot_id = appt_lot_options[appt_lot_nom]
+        
+        if st.button("📦 Générer les quittances du mois", key="btn_lot"):
+            with st.spinner("Génération des quittances en cours..."):
+                resultat_lot = qt.generer_quittances_mois(mois_lot, annee_lot, appartement_id=appt_lot_id)
+            
+            if resultat_lot['generees']:
+                st.success(f"✅ {len(resultat_lot['generees'])} quittance(s) générée(s)")
+            else:
+                st.info("Aucune quittance à générer pour cette période")
+            if resultat_lot['inchangees']:
+                st.caption(f"{resultat_lot['inchangees']} quittance(s) déjà à jour")
+            for paiement_id, erreur in resultat_lot['erreurs'].items():
+                st.error(f"❌ Paiement {paiement_id} : {erreur}")
+        
+        if st.button("📧 Envoyer les quittances du mois", key="btn_envoi_lot"):
+            barre_envoi = st.progress(0.0, text="Génération des quittances manquantes...")
+            
+            def afficher_progression(faits, total, locataire, erreur):
+                barre_envoi.progress(faits / total, text=f"{faits}/{total} - {locataire.nom}")
+            
+            resultat_envoi = ea.envoyer_quittances_mois(mois_lot, annee_lot, appartement_id=appt_lot_id,
+                                                        progression=afficher_progression)
+            barre_envoi.empty()
+            
+            if resultat_envoi.get('message'):
+                st.error(f"❌ {resultat_envoi['message']}")
+            elif resultat_envoi['total']:
+                st.success(f"✅ {resultat_envoi['envoyes']}/{resultat_envoi['total']} quittance(s) envoyée(s)")
+            else:
+                st.info("Aucune quittance à envoyer pour cette période")
+            if resultat_envoi['reprogrammes']:
+                st.warning(f"⏳ {resultat_envoi['reprogrammes']} envoi(s) en échec temporaire, retentés automatiquement")
+            if resultat_envoi['repris']:
+                st.caption(f"{resultat_envoi['repris']} envoi(s) pris en charge par la file d'envoi")
+            if resultat_envoi['sans_email']:
+                st.caption(f"{resultat_envoi['sans_email']} locataire(s) sans adresse email")
+            for detail in resultat_envoi['details']:
+                if not detail['success']:
+                    st.error(f"❌ {detail['locataire']} : {detail['message']}")
+            for paiement_id, erreur in resultat_envoi['erreurs_generation'].items():
+                st.error(f"❌ Paiement {paiement_id} : {erreur}")
+        
+        # Archive de toutes les quittances déjà générées pour la période
+        chambres_lot = None
+        if appt_lot_id is not None:
+            chambres_lot = {c.id for c in db.get_chambres_by_appartement(appt_lot_id)}
+        chemins_lot = [
+            p.chemin_quittance for p in db.get_paiements_by_mois_annee(mois_lot, annee_lot)
+            if p.chemin_quittance and (chambres_lot is None or p.chambre_id in chambres_lot)
+        ]
+        
+        if chemins_lot:
+            nom_zip = f"quittances-{annee_lot}{mois_lot:02d}.zip"
+            
+            def preparer_zip(chemins=chemins_lot):
+                # Construit au clic seulement ; le contenu est ensuite tenu en mémoire par Streamlit
+                return fm.contenu_zip_quittances(chemins)
+            
+            st.download_button(
+                label=f"📥 Télécharger les {len(chemins_lot)} quittance(s) (ZIP)",
+                data=preparer_zip,
+                file_name=nom_zip,
+                mime="application/zip",
+                key="dl_lot"
+            )
+    
+    # Attestations annuelles (CAF, impôts)
+    with st.expander("🗓️ Attestations annuelles de loyers"):
+        locataires_att = db.get_all_locataires()
+        
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            annee_att = st.number_input("Année", min_value=2020, max_value=2030, value=datetime.now().year - 1, key="annee_att")
+        with col2:
+            loc_att_options = {"Tous les locataires": None}
+            loc_att_options.update({l.nom: l.id for l in locataires_att})
+            loc_att_nom = st.selectbox("Locataire", list(loc_att_options.keys()), key="loc_att")
+            loc_att_id = loc_att_options[loc_att_nom]
+        with col3:
+            format_att = st.selectbox("Format", ['docx', 'pdf'], key="format_att")
+        
+        if st.button("🗓️ Générer les attestations", key="btn_att"):
+            with st.spinner("Génération des attestations en cours..."):
+                resultat_att = qt.generer_attestations_annee(annee_att, locataire_id=loc_att_id, format=format_att)
+            
+            chemins_att = list(resultat_att['generees'].values())
+            if chemins_att:
+                st.success(f"✅ {len(chemins_att)} attestation(s) générée(s)")
+            else:
+                st.info("Aucun loyer payé pour cette période")
+            for locataire_id, erreur in resultat_att['erreurs'].items():
+                st.error(f"❌ Locataire {locataire_id} : {erreur}")
+            
+            if len(chemins_att) == 1:
+                with open(chemins_att[0], 'rb') as f:
+                    st.download_button(
+                        label="📥 Télécharger l'attestation",
+                        data=f.read(),
+                        file_name=os.path.basename(chemins_att[0]),
+                        mime=MIME_QUITTANCE[format_att],
+                        key="dl_att"
+                    )
+            elif chemins_att:
+                st.download_button(
+                    label=f"📥 Télécharger les {len(chemins_att)} attestation(s) (ZIP)",
+                    data=fm.contenu_zip_quittances(chemins_att),
+                    file_name=f"attestations-{annee_att}.zip",
+                    mime="application/zip",
+                    key="dl_att"
+                )
+    
     st.subheader("📋 Liste des quittances")
     
     # Sélection de l'appartement
@@ -1063,6 +1274,10 @@ elif menu == "📝 Quittances":
                     # Afficher les quittances disponibles
                     st.subheader("📄 Quittances disponibles")
                     
+                    format_quittance = st.radio("Format des quittances", ["docx", "pdf"], horizontal=True,
+                                                format_func=lambda f: "Word (.docx)" if f == "docx" else "PDF", key="format_quittance")
+                    mime_quittance = MIME_QUITTANCE[format_quittance]
+                    
                     # Préparer les données
                     from datetime import datetime
                     date_aujourdhui = datetime.now()
@@ -1094,6 +1309,12 @@ elif menu == "📝 Quittances":
                     # Trier par les plus proches d'aujourd'hui (diff_mois le plus petit)
                     quittances_data.sort(key=lambda x: abs(x['diff_mois']))
                     
+                    # Envois de quittance en attente dans la file d'envoi
+                    envois_en_file = {
+                        envoi.paiement_id: envoi
+                        for envoi in db.get_emails_en_file('quittance', [q['id'] for q in quittances_data])
+                    }
+                    
                     # Option pour afficher toutes les quittances
                     if 'afficher_toutes_quittances' not in st.session_state:
                         st.session_state['afficher_toutes_quittances'] = False
@@ -1160,40 +1381,52 @@ elif menu == "📝 Quittances":
                                 if st.button("📄 Générer quittance", key=f"gen_{q['id']}"):
                                     paiement = db.get_paiement_by_id(q['id'])
                                     
-                                    # Générer la quittance
-                                    fichier_path = qt.generer_quittance_complete(
+                                    # Générer la quittance (réutilisée si rien n'a changé)
+                                    fichier_path, empreinte, contenu = qt.generer_quittance_si_necessaire(
                                         locataire=locataire,
                                         bail=bail,
                                         chambre=chambre,
                                         appartement=appt_selectionne,
                                         paiement=paiement,
                                         mois=q['mois'],
-                                        annee=q['annee']
+                                        annee=q['annee'],
+                                        format=format_quittance
                                     )
                                     
                                     # Mettre à jour le paiement avec le chemin de la quittance
-                                    db.update_paiement(
-                                        q['id'],
-                                        quittance_generee=True,
-                                        chemin_quittance=fichier_path,
-                                        date_quittance=date.today()
-                                    )
-                                    
-                                    # Proposer le téléchargement
-                                    with open(fichier_path, 'rb') as f:
-                                        st.download_button(
-                                            label="📥 Télécharger",
-                                            data=f.read(),
-                                            file_name=os.path.basename(fichier_path),
-                                            mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                                            key=f"dl_{q['id']}"
+                                    if contenu is not None:
+                                        db.update_paiement(
+                                            q['id'],
+                                            quittance_generee=True,
+                                            chemin_quittance=fichier_path,
+                                            date_quittance=date.today(),
+                                            empreinte_quittance=empreinte
                                         )
+                                    
+                                    # Proposer le téléchargement (depuis la mémoire si la quittance vient d'être rendue)
+                                    if contenu is None:
+                                        with open(fichier_path, 'rb') as f:
+                                            contenu = f.read()
+                                    st.download_button(
+                                        label="📥 Télécharger",
+                                        data=contenu,
+                                        file_name=os.path.basename(fichier_path),
+                                        mime=mime_quittance,
+                                        key=f"dl_{q['id']}"
+                                    )
                                     st.success(f"✅ Quittance générée : {os.path.basename(fichier_path)}")
                             
                             with col_btn2:
                                 # Afficher le statut d'envoi
                                 if q['paiement'].quittance_envoyee:
                                     st.info(f"📧 Envoyée le {q['paiement'].date_envoi_quittance.strftime('%d/%m/%Y à %H:%M') if q['paiement'].date_envoi_quittance else 'Date inconnue'}")
+                                envoi = envois_en_file.get(q['id'])
+                                if envoi is not None:
+                                    if envoi.derniere_erreur:
+                                        st.warning(f"⏳ Envoi en file (tentative {envoi.tentatives}, nouvel essai à "
+                                                   f"{envoi.prochaine_tentative.strftime('%H:%M')}) : {envoi.derniere_erreur}")
+                                    else:
+                                        st.info("⏳ Envoi en file d'attente")
                             
                             with col_btn3:
                                 # Bouton pour envoyer par email
@@ -1204,46 +1437,30 @@ elif menu == "📝 Quittances":
                                     if not locataire.email:
                                         st.error("❌ Le locataire n'a pas d'adresse email !")
                                     else:
-                                        # Générer la quittance si elle n'existe pas
-                                        if not paiement.chemin_quittance or not os.path.exists(paiement.chemin_quittance):
-                                            fichier_path = qt.generer_quittance_complete(
-                                                locataire=locataire,
-                                                bail=bail,
-                                                chambre=chambre,
-                                                appartement=appt_selectionne,
-                                                paiement=paiement,
-                                                mois=q['mois'],
-                                                annee=q['annee']
-                                            )
-                                            db.update_paiement(
-                                                q['id'],
-                                                quittance_generee=True,
-                                                chemin_quittance=fichier_path,
-                                                date_quittance=date.today()
-                                            )
-                                        else:
-                                            fichier_path = paiement.chemin_quittance
-                                        
-                                        # Envoyer l'email
-                                        success, message = ea.envoyer_quittance_email(
+                                        # Générer la quittance si elle manque ou si ses données ont changé
+                                        fichier_path, empreinte, contenu = qt.generer_quittance_si_necessaire(
                                             locataire=locataire,
-                                            paiement=paiement,
+                                            bail=bail,
                                             chambre=chambre,
                                             appartement=appt_selectionne,
-                                            chemin_quittance=fichier_path
+                                            paiement=paiement,
+                                            mois=q['mois'],
+                                            annee=q['annee'],
+                                            format=format_quittance
                                         )
-                                        
-                                        if success:
-                                            # Mettre à jour le statut d'envoi
+                                        if contenu is not None:
                                             db.update_paiement(
                                                 q['id'],
-                                                quittance_envoyee=True,
-                                                date_envoi_quittance=datetime.now()
+                                                quittance_generee=True,
+                                                chemin_quittance=fichier_path,
+                                                date_quittance=date.today(),
+                                                empreinte_quittance=empreinte
                                             )
-                                            st.success(f"✅ {message} - Envoyé à {locataire.email}")
-                                            st.rerun()
-                                        else:
-                                            st.error(f"❌ {message}")
+                                        
+                                        # Programmer l'envoi : le worker marque le paiement comme envoyé une fois l'email parti
+                                        ea.mettre_quittance_en_file(paiement, fichier_path)
+                                        st.success(f"📨 Envoi programmé à {locataire.email}")
+                                        st.rerun()
 
 
 # ==================== PARAMÈTRES ====================
@@ -1275,13 +1492,27 @@ elif menu == "⚙️ Paramètres":
         
         st.markdown("---")
         
+        recapitulatif_alertes = st.checkbox("Un seul email récapitulatif par locataire", key="recap_alertes")
+        joindre_quittances_alertes = st.checkbox("Joindre les quittances du mois non envoyées",
+                                                 disabled=not recapitulatif_alertes, key="recap_quittances")
+        
         if st.button("📧 Tester les alertes maintenant"):
             session = db.get_session()
-            stats = ea.verifier_et_envoyer_alertes(session)
+            if recapitulatif_alertes:
+                with st.spinner("Envoi des récapitulatifs en cours..."):
+                    stats = ea.verifier_et_envoyer_alertes(session, recapitulatif=True,
+                                                           joindre_quittances=joindre_quittances_alertes)
+            else:
+                stats = ea.verifier_et_envoyer_alertes(session, en_file=True)
             
             st.write(f"**Total de paiements à vérifier :** {stats['total']}")
-            st.write(f"**Emails envoyés :** {stats['envoyes']}")
-            st.write(f"**Erreurs :** {stats['erreurs']}")
+            if recapitulatif_alertes:
+                st.write(f"**Emails récapitulatifs envoyés :** {stats.get('emails', 0)}")
+                st.write(f"**Erreurs :** {stats['erreurs']}")
+                if stats.get('deja_envoyes'):
+                    st.caption(f"{stats['deja_envoyes']} impayé(s) déjà relancé(s) par un récapitulatif envoyé")
+            else:
+                st.write(f"**Alertes mises en file d'envoi :** {stats.get('en_file', 0)}")
             
             if stats.get('details'):
                 st.subheader("Détails")
@@ -1291,6 +1522,87 @@ elif menu == "⚙️ Paramètres":
                     else:
                         st.error(f"❌ {detail['locataire']} : {detail['message']}")
     
+        st.markdown("---")
+        st.subheader("📨 File d'envoi")
+        
+        etat_outbox = db.get_etat_outbox()
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("En attente", etat_outbox['en_attente'])
+        col2.metric("En cours", etat_outbox['en_cours'])
+        col3.metric("Envoyés", etat_outbox['envoye'])
+        col4.metric("Abandonnés", etat_outbox['echec'])
+        
+        if etat_outbox['echec']:
+            for envoi in db.get_emails_en_file(statuts=('echec',))[-10:]:
+                st.error(f"❌ {envoi.type_envoi.capitalize()} (paiement {envoi.paiement_id}) : {envoi.derniere_erreur}")
+            if st.button("🔁 Relancer les envois abandonnés"):
+                nb = db.relancer_emails_en_echec()
+                st.success(f"✅ {nb} envoi(s) remis en file")
+                st.rerun()
+        
+        st.markdown("---")
+        st.subheader("⏱️ Performances des envois")
+        
+        periodes_mesures = {"24 heures": 1, "7 jours": 7, "30 jours": 30}
+        periode_mesures = st.selectbox("Période", list(periodes_mesures.keys()), index=1, key="periode_mesures")
+        
+        ea.vider_mesures_envoi()
+        mesures = db.get_statistiques_envois(datetime.now() - timedelta(days=periodes_mesures[periode_mesures]))
+        resume = mesures['global']
+        
+        if resume['tentatives'] == 0:
+            st.info("Aucun envoi sur la période.")
+        else:
+            def ms(valeur):
+                return "-" if valeur is None else f"{valeur:.0f} ms"
+            
+            col1, col2, col3, col4, col5 = st.columns(5)
+            col1.metric("Tentatives", resume['tentatives'])
+            col2.metric("Taux d'échec", f"{resume['taux_echec']:.1f}%")
+            col3.metric("Durée p50", ms(resume['duree_ms']['p50']))
+            col4.metric("Durée p95", ms(resume['duree_ms']['p95']))
+            col5.metric("Durée p99", ms(resume['duree_ms']['p99']))
+            
+            df_mesures = pd.DataFrame([{
+                'Serveur': ligne['serveur'],
+                'Type': ligne['type_envoi'],
+                'Tentatives': ligne['tentatives'],
+                "Taux d'échec (%)": ligne['taux_echec'],
+                'Durée p50 (ms)': ligne['duree_ms']['p50'],
+                'Durée p95 (ms)': ligne['duree_ms']['p95'],
+                'Durée p99 (ms)': ligne['duree_ms']['p99'],
+                'Transfert p95 (ms)': ligne['transfert_ms']['p95'],
+                'Ouverture session p95 (ms)': ligne['ouverture_ms']['p95'],
+                'Attente débit p95 (ms)': ligne['attente_ms']['p95'],
+                'Taille moyenne (o)': ligne['taille_moyenne'],
+            } for ligne in mesures['par_serveur']])
+            st.dataframe(df_mesures, use_container_width=True, hide_index=True)
+            
+            if len(mesures['par_jour']) > 1:
+                df_jours = pd.DataFrame([{
+                    'Jour': ligne['jour'],
+                    'Durée p50 (ms)': ligne['duree_ms']['p50'],
+                    'Durée p95 (ms)': ligne['duree_ms']['p95'],
+                    'Durée p99 (ms)': ligne['duree_ms']['p99'],
+                    "Taux d'échec (%)": ligne['taux_echec'],
+                } for ligne in mesures['par_jour']])
+                fig = px.line(df_jours, x='Jour', y=['Durée p50 (ms)', 'Durée p95 (ms)', 'Durée p99 (ms)'],
+                              markers=True, title="Durée des envois par jour")
+                st.plotly_chart(fig, use_container_width=True)
+                fig = px.bar(df_jours, x='Jour', y="Taux d'échec (%)", title="Taux d'échec par jour")
+                st.plotly_chart(fig, use_container_width=True)
+            
+            if mesures['codes']:
+                st.caption("Réponses du serveur : " + ", ".join(
+                    f"{code} × {nb}" for code, nb in mesures['codes'].items()
+                ))
+            
+            for echec in reversed(mesures['echecs_recents']):
+                st.warning(
+                    f"⚠️ {echec['date_envoi'].strftime('%d/%m/%Y %H:%M')} - {echec['type_envoi']} "
+                    f"(tentative {echec['tentative']}, code {echec['code_smtp'] or '-'}) : {echec['erreur']}"
+                )
+    
     with tab2:
         st.subheader("📊 Statistiques Générales")
         
@@ -0,0 +1,413 @@
+"""
+Banc d'essai et vérification de l'envoi des emails, sur un serveur SMTP local
+
+Démarre smtp_sink.SMTPSink (latence et pannes configurables) et y dirige
+l'application (SMTP_SERVER, SMTP_PORT, SMTP_STARTTLS=0), avec une base
+SQLite temporaire. Mesure, en séquentiel puis sur plusieurs threads :
+    - envoyer_quittance_email
+    - envoyer_alerte_loyer_impaye
+    - verifier_et_envoyer_alertes (le passage quotidien des alertes)
+    - la file d'envoi (traiter_file_emails) avec pannes injectées
+
+Vérifie pour chaque scénario les en-têtes reçus (From, To, Subject), la
+pièce jointe (identique octet pour octet au fichier de quittance), et
+qu'aucun email n'est reçu en double ni perdu malgré les nouvelles tentatives.
+Redemande ensuite tous les envois de quittances : aucun nouvel email ne doit
+partir (clés d'idempotence). Vérifie enfin que chaque tentative d'envoi a
+sa mesure en base. Sort en erreur si une vérification échoue.
+
+Usage :
+    python bench_emails.py [--locataires 100] [--impayes 3] [--threads 1 4 8]
+                           [--latence 0.01] [--pannes 0.1] [--sortie resultats.json]
+"""
+
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+MOIS_NOMS = ["Janvier", "Février", "Mars", "Avril", "Mai", "Juin",
+             "Juillet", "Août", "Septembre", "Octobre", "Novembre", "Décembre"]
+
+
+def _creer_donnees(db, qt, nb_locataires, nb_impayes, annee):
+    """
+    Un locataire par chambre, avec une quittance payée en janvier (fichier généré)
+    et nb_impayes mois impayés à partir de février
+    """
+    from src.models import Appartement, Chambre, Locataire, Paiement
+
+    session = db.get_session()
+    try:
+        appartements = [
+            Appartement(adresse=f"{i + 1} rue du Banc d'Essai", ville='Paris', code_postal='75011', surface=80.0)
+            for i in range((nb_locataires + 3) // 4)
+        ]
+        session.add_all(appartements)
+        session.flush()
+        for i in range(nb_locataires):
+            chambre = Chambre(appartement_id=appartements[i // 4].id, numero=f"Chambre {i % 4 + 1}",
+                              loyer=450.0 + i % 7 * 25, charges=50.0, disponible=False)
+            locataire = Locataire(nom=f"Locataire {i:05d}", email=f"locataire{i}@example.com",
+                                  date_entree=date(annee - 1, 1, 1))
+            session.add_all([chambre, locataire])
+            session.flush()
+            session.add(Paiement(locataire_id=locataire.id, chambre_id=chambre.id, mois=1, annee=annee,
+                                 montant=chambre.loyer + chambre.charges, date_paiement=date(annee, 1, 5),
+                                 statut='paye', mode_paiement='virement'))
+            for mois in range(2, 2 + nb_impayes):
+                session.add(Paiement(locataire_id=locataire.id, chambre_id=chambre.id, mois=mois, annee=annee,
+                                     montant=chambre.loyer + chambre.charges, statut='impaye'))
+        session.commit()
+    finally:
+        session.close()
+
+    lots = db.get_paiements_a_quittancer(1, annee)
+    chemins = {}
+    for paiement, locataire, chambre, appartement in lots:
+        chemins[paiement.id] = qt.generer_quittance_simple(locataire, chambre, appartement, paiement, 1, annee)
+    db.marquer_quittances_generees(chemins)
+    return lots, chemins
+
+
+def _percentile(valeurs, p):
+    valeurs = sorted(valeurs)
+    if not valeurs:
+        return None
+    rang = min(len(valeurs) - 1, max(0, round(p / 100 * (len(valeurs) - 1))))
+    return round(valeurs[rang] * 1000, 3)
+
+
+def _vider_file(db):
+    """Oublie les envois déjà faits, pour que chaque mesure envoie réellement ses emails"""
+    from src.models import EmailOutbox
+
+    session = db.get_session()
+    try:
+        session.query(EmailOutbox).delete()
+        session.commit()
+    finally:
+        session.close()
+
+
+def _mesurer(sink, nom, fonction, taches, threads, vider=True):
+    """Chronomètre fonction(tache) pour chaque tâche, sur `threads` threads (0 = séquentiel)"""
+    from src import database as db
+    from src import email_alerts as ea
+
+    ea.fermer_pools_smtp()
+    sink.vider()
+    if vider:
+        _vider_file(db)
+
+    def executer(tache):
+        debut = time.perf_counter()
+        resultat = fonction(tache)
+        return time.perf_counter() - debut, resultat
+
+    debut = time.perf_counter()
+    if threads == 0:
+        resultats = [executer(tache) for tache in taches]
+    else:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            resultats = list(executor.map(executer, taches))
+    duree = time.perf_counter() - debut
+
+    latences = [latence for latence, _ in resultats]
+    return {
+        'operation': nom,
+        'threads': threads,
+        'messages': len(sink.messages),
+        'duree_s': round(duree, 4),
+        'messages_par_s': round(len(sink.messages) / duree, 1) if duree else None,
+        'latence_ms': {'p50': _percentile(latences, 50), 'p95': _percentile(latences, 95)},
+        'serveur': dict(sink.compteurs),
+    }, [resultat for _, resultat in resultats]
+
+
+def _verifier_messages(sink, attendus, expediteur, pieces_jointes=None):
+    """
+    Compare les messages reçus aux messages attendus
+
+    Args:
+        attendus: dict (destinataire, sujet) -> nom de la pièce jointe attendue (ou None)
+        pieces_jointes: dict nom de fichier -> SHA-256 du fichier d'origine
+
+    Returns:
+        Liste des erreurs constatées (vide si tout est correct)
+    """
+    erreurs = []
+    recus = {}
+    for message in sink.messages_analyses():
+        cle = (str(message['To']), str(message['Subject']))
+        recus[cle] = recus.get(cle, 0) + 1
+        if expediteur not in str(message['From']):
+            erreurs.append(f"{cle} : expéditeur inattendu {message['From']}")
+        if cle not in attendus:
+            erreurs.append(f"{cle} : message inattendu")
+            continue
+        nom_attendu = attendus[cle]
+        jointes = list(message.iter_attachments())
+        if nom_attendu is None:
+            if jointes:
+                erreurs.append(f"{cle} : pièce jointe inattendue")
+            continue
+        if len(jointes) != 1 or jointes[0].get_filename() != nom_attendu:
+            erreurs.append(f"{cle} : pièce jointe manquante ou mal nommée")
+            continue
+        empreinte = hashlib.sha256(jointes[0].get_content()).hexdigest()
+        if empreinte != pieces_jointes[nom_attendu]:
+            erreurs.append(f"{cle} : pièce jointe altérée")
+
+    erreurs.extend(f"{cle} : reçu {nb} fois" for cle, nb in recus.items() if nb > 1)
+    erreurs.extend(f"{cle} : jamais reçu" for cle in attendus if cle not in recus)
+    return erreurs
+
+
+def _bench_quittances(sink, lots, chemins, threads_liste, config, resultats, verifications):
+    from src import email_alerts as ea
+
+    empreintes = {}
+    attendus = {}
+    for paiement, locataire, _, _ in lots:
+        with open(chemins[paiement.id], 'rb') as f:
+            empreintes[os.path.basename(chemins[paiement.id])] = hashlib.sha256(f.read()).hexdigest()
+        attendus[(locataire.email, f"Quittance de loyer - {MOIS_NOMS[paiement.mois - 1]} {paiement.annee}")] = \
+            os.path.basename(chemins[paiement.id])
+
+    def envoyer(lot):
+        paiement, locataire, chambre, appartement = lot
+        return ea.envoyer_quittance_email(locataire, paiement, chambre, appartement, chemins[paiement.id])
+
+    for threads in threads_liste:
+        mesure, retours = _mesurer(sink, 'envoyer_quittance_email', envoyer, lots, threads)
+        resultats.append(mesure)
+        erreurs = [message for succes, message in retours if not succes]
+        erreurs += _verifier_messages(sink, attendus, config['sender'], empreintes)
+        verifications[f"envoyer_quittance_email/threads={threads}"] = erreurs[:20]
+
+    # Mêmes demandes une seconde fois (double clic, relance de la page) : rien ne doit repartir
+    mesure, retours = _mesurer(sink, 'envoyer_quittance_email_doublon', envoyer, lots, threads_liste[-1], vider=False)
+    resultats.append(mesure)
+    erreurs = [message for succes, message in retours if not succes]
+    if sink.messages:
+        erreurs.append(f"{len(sink.messages)} quittance(s) renvoyée(s)")
+    if sink.compteurs.get('connexions'):
+        erreurs.append("connexion SMTP ouverte pour des envois déjà faits")
+    verifications['envoyer_quittance_email_doublon'] = erreurs[:20]
+
+
+def _bench_alertes(sink, db, annee, threads_liste, config, resultats, verifications):
+    from src import email_alerts as ea
+
+    # Passage fictif le 10 décembre : tous les impayés de l'année sont à relancer
+    reference = datetime(annee, 12, 10)
+    impayes = db.get_paiements_a_relancer(reference.month, annee, datetime(annee, reference.month, 1))
+    attendus = {
+        (locataire.email, f"Rappel - Loyer impayé pour {MOIS_NOMS[paiement.mois - 1]} {paiement.annee}"): None
+        for paiement, locataire, _, _ in impayes
+    }
+
+    def envoyer(lot):
+        paiement, locataire, chambre, appartement = lot
+        return ea.envoyer_alerte_loyer_impaye(locataire, paiement, chambre, appartement)
+
+    for threads in threads_liste:
+        mesure, retours = _mesurer(sink, 'envoyer_alerte_loyer_impaye', envoyer, impayes, threads)
+        resultats.append(mesure)
+        erreurs = [message for succes, message in retours if not succes]
+        erreurs += _verifier_messages(sink, attendus, config['sender'])
+        verifications[f"envoyer_alerte_loyer_impaye/threads={threads}"] = erreurs[:20]
+
+    # Passage quotidien des alertes : un seul email par impayé, et rien au second passage
+    session = db.get_session()
+    mesure, retours = _mesurer(sink, 'verifier_et_envoyer_alertes',
+                               lambda _: ea.verifier_et_envoyer_alertes(session, date_reference=reference), [None], 0)
+    resultats.append(mesure)
+    erreurs = [f"{d['locataire']} : {d['message']}" for d in retours[0]['details'] if not d['success']]
+    erreurs += _verifier_messages(sink, attendus, config['sender'])
+    deuxieme = ea.verifier_et_envoyer_alertes(session, date_reference=reference)
+    if deuxieme['total']:
+        erreurs.append(f"second passage : {deuxieme['total']} alerte(s) renvoyée(s)")
+    session.close()
+    verifications['verifier_et_envoyer_alertes'] = erreurs[:20]
+
+
+def _bench_file_pannes(sink, db, lots, chemins, pannes, config, resultats, verifications):
+    """
+    File d'envoi sous pannes injectées : chaque quittance doit arriver une
+    seule fois (Message-ID unique), sauf les envois marqués incertains, qui
+    ne sont jamais renvoyés
+    """
+    from src import email_alerts as ea
+
+    db.OUTBOX_DELAI_BASE = 0  # nouvelles tentatives immédiates
+    sink.echec_temporaire = pannes
+    sink.coupure_avant_donnees = pannes
+    sink.coupure_apres_donnees = pannes / 4
+    ea.fermer_pools_smtp()
+    sink.vider()
+    _vider_file(db)
+
+    db.mettre_emails_en_file([
+        {'type_envoi': 'quittance', 'locataire_id': paiement.locataire_id, 'paiement_id': paiement.id,
+         'payload': {'chemin_quittance': chemins[paiement.id]}, 'cle': ea.cle_quittance(paiement, chemins[paiement.id])}
+        for paiement, _, _, _ in lots
+    ])
+    debut = time.perf_counter()
+    passages = 0
+    while db.get_emails_en_file():
+        ea.traiter_file_emails(limite=len(lots))
+        passages += 1
+    duree = time.perf_counter() - debut
+
+    envois = db.get_emails_en_file('quittance', statuts=None)
+    par_message_id = {}
+    for message in sink.messages_analyses():
+        par_message_id[message['Message-ID']] = par_message_id.get(message['Message-ID'], 0) + 1
+
+    erreurs = [f"{mid} : reçu {nb} fois" for mid, nb in par_message_id.items() if nb > 1]
+    for envoi in envois:
+        recu = par_message_id.get(f"<locator.quittance.{envoi.id}@{config['sender'].rpartition('@')[2]}>", 0)
+        if envoi.statut == 'envoye' and recu != 1:
+            erreurs.append(f"envoi {envoi.id} marqué envoyé mais reçu {recu} fois")
+        elif envoi.statut == 'echec' and 'peut-être reçu' not in (envoi.derniere_erreur or '') and recu:
+            erreurs.append(f"envoi {envoi.id} abandonné mais reçu")
+
+    resultats.append({
+        'operation': 'file_envoi_avec_pannes',
+        'threads': 0,
+        'messages': len(sink.messages),
+        'duree_s': round(duree, 4),
+        'messages_par_s': round(len(sink.messages) / duree, 1) if duree else None,
+        'passages': passages,
+        'envois': {statut: sum(1 for e in envois if e.statut == statut) for statut in ('envoye', 'echec')},
+        'tentatives': sum(e.tentatives for e in envois),
+        'serveur': dict(sink.compteurs),
+    })
+    verifications['file_envoi_avec_pannes'] = erreurs[:20]
+    sink.echec_temporaire = sink.coupure_avant_donnees = sink.coupure_apres_donnees = 0
+
+
+def _compter_tentatives(ea):
+    """Compte les tentatives d'envoi (appels à _envoyer_mesure), pour vérifier qu'elles sont toutes mesurées"""
+    compteur = {'tentatives': 0}
+    verrou = threading.Lock()
+    envoyer_mesure = ea._envoyer_mesure
+
+    def envoyer_et_compter(*args, **kwargs):
+        with verrou:
+            compteur['tentatives'] += 1
+        return envoyer_mesure(*args, **kwargs)
+
+    ea._envoyer_mesure = envoyer_et_compter
+    return compteur
+
+
+def _mesures_envoi(db, ea, compteur, verifications):
+    """Centiles par phase et taux d'échec, tels qu'enregistrés par l'application pour chaque tentative"""
+    ea.vider_mesures_envoi()
+    statistiques = db.get_statistiques_envois()
+    enregistrees = statistiques['global']['tentatives']
+    verifications['mesures_envoi'] = [] if enregistrees == compteur['tentatives'] else [
+        f"{enregistrees} tentative(s) mesurée(s) sur {compteur['tentatives']}"
+    ]
+    return json.loads(json.dumps(statistiques['par_serveur'], default=str))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Banc d'essai de l'envoi des emails")
+    parser.add_argument('--locataires', type=int, default=100)
+    parser.add_argument('--impayes', type=int, default=3, help="Mois impayés par locataire")
+    parser.add_argument('--threads', type=int, nargs='+', default=[4, 8],
+                        help="Nombres de threads à mesurer (le séquentiel est toujours mesuré)")
+    parser.add_argument('--latence', type=float, default=0.01, help="Latence du serveur par message (s)")
+    parser.add_argument('--pannes', type=float, default=0.1,
+                        help="Probabilité de panne par message pour le scénario de la file d'envoi")
+    parser.add_argument('--graine', type=int, default=42)
+    parser.add_argument('--sortie', help="Fichier JSON de résultats (sortie standard par défaut)")
+    args = parser.parse_args()
+
+    sys.path.insert(0, PROJECT_DIR)
+    from smtp_sink import SMTPSink
+
+    sink = SMTPSink(latence=args.latence, graine=args.graine).demarrer()
+
+    # Serveur, base et dossiers de test, configurés avant les imports du projet
+    tmp_dir = tempfile.mkdtemp(prefix="locator-bench-emails-")
+    os.environ.update({
+        'LOCATOR_DB_PATH': os.path.join(tmp_dir, 'bench.db'),
+        'SMTP_SERVER': '127.0.0.1',
+        'SMTP_PORT': str(sink.port),
+        'SMTP_STARTTLS': '0',
+        'SMTP_EMAIL': 'bailleur@example.com',
+        'SMTP_PASSWORD': 'banc-d-essai',
+        'SMTP_DEBIT_MAX': '0',
+    })
+    sortie = os.path.abspath(args.sortie) if args.sortie else None
+    os.chdir(tmp_dir)
+
+    try:
+        from src import database as db
+        from src import email_alerts as ea
+        from src import quittance as qt
+
+        with contextlib.redirect_stdout(sys.stderr):
+            db.init_db()
+        annee = date.today().year - 1
+        lots, chemins = _creer_donnees(db, qt, args.locataires, args.impayes, annee)
+        config = ea.get_email_config()
+        threads_liste = [0] + args.threads
+        compteur = _compter_tentatives(ea)
+
+        resultats = []
+        verifications = {}
+        _bench_quittances(sink, lots, chemins, threads_liste, config, resultats, verifications)
+        _bench_alertes(sink, db, annee, threads_liste, config, resultats, verifications)
+        _bench_file_pannes(sink, db, lots, chemins, args.pannes, config, resultats, verifications)
+        for resultat in resultats:
+            print(f"{resultat['operation']:<30} threads={resultat['threads']:<2} "
+                  f"{resultat['messages_par_s']} messages/s", file=sys.stderr)
+
+        rapport = {
+            'parametres': {
+                'locataires': args.locataires,
+                'impayes': args.impayes,
+                'latence_s': args.latence,
+                'pannes': args.pannes,
+                'python': platform.python_version(),
+                'plateforme': platform.platform(),
+                'cpu': os.cpu_count(),
+            },
+            'resultats': resultats,
+            'mesures_envoi': _mesures_envoi(db, ea, compteur, verifications),
+            'verifications': {nom: {'ok': not erreurs, 'erreurs': erreurs} for nom, erreurs in verifications.items()},
+        }
+    finally:
+        sink.arreter()
+        os.chdir(PROJECT_DIR)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    texte = json.dumps(rapport, indent=2, ensure_ascii=False)
+    if sortie:
+        with open(sortie, 'w', encoding='utf-8') as f:
+            f.write(texte)
+    else:
+        print(texte)
+
+    return 0 if all(v['ok'] for v in rapport['verifications'].values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
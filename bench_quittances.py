@@ -0,0 +1,314 @@
+"""
+Mesure du débit et de la latence de génération des quittances
+
+Crée N locataires et paiements fictifs dans une base SQLite en mémoire, puis
+chronomètre generer_quittance_simple, generer_quittance_complete,
+generer_quittance_ooxml et l'assemblage MIME de l'email de quittance, en
+séquentiel puis sur 1, 2, 4 et 8 processus. Le résultat (p50/p95 par
+quittance, quittances par seconde) est écrit en JSON pour comparer les
+versions entre elles.
+
+Vérifie aussi que le rendu OOXML direct produit exactement les mêmes parties
+d'archive que le rendu python-docx de generer_quittance_complete.
+
+Usage :
+    python bench_quittances.py [--locataires 200] [--workers 1 2 4 8] [--format docx]
+                               [--template modele.docx] [--sortie resultats.json]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+OPERATIONS = (
+    'generer_quittance_simple',
+    'generer_quittance_complete',
+    'generer_quittance_ooxml',
+    'message_email',
+)
+
+# Configuration fictive : le message est assemblé mais jamais envoyé
+CONFIG_EMAIL = {
+    'sender': 'bailleur@example.com',
+    'password': '',
+    'smtp_server': 'localhost',
+    'smtp_port': 25,
+    'from_name': 'Gestion Locative',
+}
+
+
+def _template_synthetique(chemin):
+    """
+    Template couvrant les cas du moteur : variables coupées, tableau, en-tête,
+    pied de page, formateurs, et un signet et un champ nommés comme une variable
+    """
+    from docx import Document
+    from docx.oxml import OxmlElement
+    from docx.oxml.ns import qn
+
+    doc = Document()
+    doc.sections[0].header.paragraphs[0].text = 'Quittance - NOM_LOCATAIRE - {DATE_DEBUT_MOIS|mois}'
+    doc.sections[0].footer.paragraphs[0].text = 'ADRESSE_BIEN'
+    doc.add_heading('QUITTANCE DE LOYER', 0)
+    p = doc.add_paragraph()
+    p.add_run('Je soussigné, bailleur, déclare avoir reçu de ')
+    p.add_run('NOM_LOC').bold = True
+    p.add_run('ATAIRE').bold = True
+    p.add_run(' la somme de MT_LOYER ({MT_LOYER|lettres} euros)')
+    # Signet et champ de fusion : le nom de la variable n'apparaît que dans les attributs
+    p = doc.add_paragraph('Locataire : ')
+    debut = OxmlElement('w:bookmarkStart')
+    debut.set(qn('w:id'), '0')
+    debut.set(qn('w:name'), 'NOM_LOCATAIRE')
+    fin = OxmlElement('w:bookmarkEnd')
+    fin.set(qn('w:id'), '0')
+    champ = OxmlElement('w:fldSimple')
+    champ.set(qn('w:instr'), ' MERGEFIELD NOM_LOCATAIRE ')
+    p._p.append(debut)
+    p.add_run('NOM_LOCATAIRE')
+    p._p.append(fin)
+    p._p.append(champ)
+    doc.add_paragraph('Pour le logement situé ADRESSE_BIEN,')
+    doc.add_paragraph('au titre de la période du DATE_DEBUT_MOIS au {DATE_FIN_MOIS|long}.')
+    table = doc.add_table(rows=2, cols=2)
+    table.rows[0].cells[0].text = 'Loyer et charges'
+    table.rows[0].cells[1].text = 'MT_LOYER'
+    table.rows[1].cells[0].text = 'Prochaine échéance'
+    table.rows[1].cells[1].text = 'DATE_DEBUT_SUIVANT_MOIS - DATE_FIN_SUIVANT_MOIS'
+    for i in range(40):
+        doc.add_paragraph(f"Clause {i + 1} : texte sans variable, présent pour donner au document une taille réaliste.")
+    doc.save(chemin)
+
+
+def _creer_donnees(db, nb_locataires, mois, annee):
+    """Appartements, chambres, locataires et paiements payés, insérés en une transaction"""
+    from src.models import Appartement, Chambre, Locataire, Paiement
+
+    session = db.get_session()
+    try:
+        appartements = [
+            Appartement(adresse=f"{i + 1} rue du Banc d'Essai", ville='Paris', code_postal='75011', surface=80.0)
+            for i in range((nb_locataires + 3) // 4)
+        ]
+        session.add_all(appartements)
+        session.flush()
+        for i in range(nb_locataires):
+            chambre = Chambre(appartement_id=appartements[i // 4].id, numero=f"Chambre {i % 4 + 1}",
+                              loyer=450.0 + i % 7 * 25, charges=50.0, disponible=False)
+            locataire = Locataire(nom=f"Locataire {i:05d}", email=f"locataire{i}@example.com",
+                                  date_entree=date(annee - 1, 1, 1))
+            session.add_all([chambre, locataire])
+            session.flush()
+            session.add(Paiement(locataire_id=locataire.id, chambre_id=chambre.id, mois=mois, annee=annee,
+                                 montant=chambre.loyer + chambre.charges, date_paiement=date(annee, mois, 5),
+                                 statut='paye', mode_paiement='virement'))
+        session.commit()
+    finally:
+        session.close()
+
+
+def _prechauffer(nb_locataires=None, mois=None, annee=None):
+    """
+    Prépare un processus de mesure, hors chronométrage
+
+    Charge le template (et sa version OOXML). Un processus lancé sans fork part
+    d'une base en mémoire vide : les mêmes données y sont recréées pour que
+    l'index des documents puisse y être écrit.
+    """
+    from sqlalchemy import inspect
+    from src import database as db
+    from src import quittance as qt
+
+    if nb_locataires is not None and not inspect(db.engine).has_table('paiements'):
+        with contextlib.redirect_stdout(sys.stderr):
+            db.init_db()
+        _creer_donnees(db, nb_locataires, mois, annee)
+
+    template = qt.get_template_quittance()
+    if template is not None:
+        template.ooxml()
+
+
+def _demarrer(_):
+    return os.getpid()
+
+
+def _executer(args):
+    """Une quittance : retourne (durée en secondes, chemin produit)"""
+    from src import email_alerts as ea
+    from src import quittance as qt
+
+    operation, (paiement, locataire, chambre, appartement), format, chemin = args
+    debut = time.perf_counter()
+    if operation == 'generer_quittance_simple':
+        chemin = qt.generer_quittance_simple(locataire, chambre, appartement, paiement,
+                                             paiement.mois, paiement.annee, format=format)
+    elif operation == 'generer_quittance_complete':
+        chemin = qt.generer_quittance_complete(locataire, None, chambre, appartement, paiement,
+                                               paiement.mois, paiement.annee, format=format)
+    elif operation == 'generer_quittance_ooxml':
+        chemin = qt.generer_quittance_ooxml(locataire, None, chambre, appartement, paiement,
+                                            paiement.mois, paiement.annee)
+    else:
+        ea.construire_message_quittance(locataire, paiement, chambre, appartement, chemin, CONFIG_EMAIL).as_bytes()
+    return time.perf_counter() - debut, chemin
+
+
+def _mesurer(operation, lots, format, chemins, workers):
+    """Chronomètre une opération sur tous les lots, en séquentiel (workers=0) ou sur un pool"""
+    import numpy as np
+
+    taches = [(operation, lot, format, chemins.get(lot[0].id)) for lot in lots]
+
+    if workers == 0:
+        _prechauffer()
+        debut = time.perf_counter()
+        resultats = [_executer(tache) for tache in taches]
+        duree = time.perf_counter() - debut
+    else:
+        paiement = lots[0][0]
+        with ProcessPoolExecutor(max_workers=workers, initializer=_prechauffer,
+                                 initargs=(len(lots), paiement.mois, paiement.annee)) as executor:
+            # Démarrer les processus avant de lancer le chronomètre
+            list(executor.map(_demarrer, range(workers)))
+            debut = time.perf_counter()
+            resultats = list(executor.map(_executer, taches, chunksize=max(1, len(taches) // (workers * 8))))
+            duree = time.perf_counter() - debut
+
+    latences = np.array([latence for latence, _ in resultats]) * 1000
+    for lot, (_, chemin) in zip(lots, resultats):
+        chemins[lot[0].id] = chemin
+
+    return {
+        'operation': operation,
+        'workers': workers,
+        'quittances': len(taches),
+        'duree_s': round(duree, 4),
+        'quittances_par_s': round(len(taches) / duree, 1) if duree else None,
+        'latence_ms': {
+            'p50': round(float(np.percentile(latences, 50)), 3),
+            'p95': round(float(np.percentile(latences, 95)), 3),
+        },
+    }
+
+
+def _verifier_equivalence_ooxml(lots, nb):
+    """
+    Compare, membre par membre, les archives des rendus python-docx et OOXML direct
+
+    Un locataire supplémentaire, non enregistré, porte un nom avec guillemets et
+    esperluette à échapper dans le texte comme dans les attributs.
+    """
+    from src import quittance as qt
+    from src.models import Locataire
+
+    paiement, locataire, chambre, appartement = lots[0]
+    echappement = (paiement, Locataire(nom='Jean "Jo" Dupont & fils', email=locataire.email), chambre, appartement)
+    template = qt.get_template_quittance()
+
+    differences = []
+    for paiement, locataire, chambre, appartement in lots[:nb] + [echappement]:
+        buffer = io.BytesIO()
+        template.rendre(qt._valeurs_quittance(locataire, appartement, paiement, paiement.mois,
+                                              paiement.annee)).save(buffer)
+        with zipfile.ZipFile(buffer) as archive:
+            attendu = {nom: archive.read(nom) for nom in archive.namelist()}
+        contenu = qt.render_quittance(locataire, None, chambre, appartement, paiement, paiement.mois, paiement.annee)
+        with zipfile.ZipFile(io.BytesIO(contenu)) as archive:
+            obtenu = {nom: archive.read(nom) for nom in archive.namelist()}
+        membres = sorted(nom for nom in set(attendu) | set(obtenu) if attendu.get(nom) != obtenu.get(nom))
+        if membres:
+            differences.append({'paiement_id': paiement.id, 'locataire': locataire.nom, 'membres': membres})
+    return {'verifiees': min(nb, len(lots)) + 1, 'differences': differences}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Banc d'essai de génération des quittances")
+    parser.add_argument('--locataires', type=int, default=200)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8],
+                        help="Tailles de pool à mesurer (le séquentiel est toujours mesuré)")
+    parser.add_argument('--operations', nargs='+', choices=OPERATIONS, default=list(OPERATIONS))
+    parser.add_argument('--format', choices=['docx', 'pdf'], default='docx')
+    parser.add_argument('--template', help="Template .docx à utiliser (template synthétique par défaut)")
+    parser.add_argument('--verifications', type=int, default=20,
+                        help="Nombre de quittances comparées entre rendu OOXML et python-docx")
+    parser.add_argument('--sortie', help="Fichier JSON de résultats (sortie standard par défaut)")
+    args = parser.parse_args()
+
+    # Base en mémoire et répertoire de travail temporaire, configurés avant les imports du projet
+    os.environ['LOCATOR_DB_PATH'] = ':memory:'
+    sys.path.insert(0, PROJECT_DIR)
+    template = os.path.abspath(args.template) if args.template else None
+    sortie = os.path.abspath(args.sortie) if args.sortie else None
+    tmp_dir = tempfile.mkdtemp(prefix="locator-bench-")
+    os.chdir(tmp_dir)
+
+    try:
+        from src import database as db
+        from src import quittance as qt
+
+        os.makedirs(qt.TEMPLATE_DIR)
+        if template:
+            shutil.copy(template, os.path.join(qt.TEMPLATE_DIR, os.path.basename(template)))
+        else:
+            _template_synthetique(os.path.join(qt.TEMPLATE_DIR, 'modele.docx'))
+
+        aujourd_hui = date.today()
+        with contextlib.redirect_stdout(sys.stderr):
+            db.init_db()
+        _creer_donnees(db, args.locataires, aujourd_hui.month, aujourd_hui.year)
+        lots = db.get_paiements_a_quittancer(aujourd_hui.month, aujourd_hui.year)
+
+        resultats = []
+        chemins = {}
+        for operation in args.operations:
+            if operation == 'message_email' and not chemins:
+                # Le message a besoin d'une quittance déjà générée en pièce jointe
+                _mesurer('generer_quittance_ooxml', lots, args.format, chemins, 0)
+            if operation == 'generer_quittance_ooxml' and args.format != 'docx':
+                continue
+            for workers in [0] + args.workers:
+                resultats.append(_mesurer(operation, lots, args.format, chemins, workers))
+                print(f"{operation:<28} workers={workers:<2} {resultats[-1]['quittances_par_s']} quittances/s",
+                      file=sys.stderr)
+
+        rapport = {
+            'parametres': {
+                'locataires': args.locataires,
+                'format': args.format,
+                'template': os.path.basename(template) if template else 'synthetique',
+                'python': platform.python_version(),
+                'plateforme': platform.platform(),
+                'cpu': os.cpu_count(),
+            },
+            'resultats': resultats,
+            'equivalence_ooxml': _verifier_equivalence_ooxml(lots, args.verifications),
+        }
+    finally:
+        os.chdir(PROJECT_DIR)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    texte = json.dumps(rapport, indent=2, ensure_ascii=False)
+    if sortie:
+        with open(sortie, 'w', encoding='utf-8') as f:
+            f.write(texte)
+    else:
+        print(texte)
+
+    return 1 if rapport['equivalence_ooxml']['differences'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,212 @@
+"""
+Serveur SMTP local qui reçoit les emails sans les remettre
+
+Remplace le vrai serveur (smtp.gmail.com...) pour tester l'envoi hors ligne :
+les messages sont gardés en mémoire (et affichés en mode autonome). Une
+latence par message et des pannes peuvent être injectées pour reproduire un
+fournisseur lent ou instable.
+
+Usage autonome :
+    python smtp_sink.py [--port 1025] [--latence 0.05] [--echec-temporaire 0.1]
+
+puis lancer l'application avec :
+    SMTP_SERVER=localhost SMTP_PORT=1025 SMTP_STARTTLS=0 SMTP_EMAIL=moi@example.com SMTP_PASSWORD=x
+"""
+
+import argparse
+import random
+import socketserver
+import threading
+import time
+from email import message_from_bytes, policy
+
+
+class _SessionSink(socketserver.StreamRequestHandler):
+    """Dialogue SMTP minimal : EHLO, AUTH PLAIN, MAIL, RCPT, DATA, RSET, NOOP, QUIT"""
+
+    def repondre(self, ligne):
+        # Les réponses SMTP sont en ASCII
+        self.wfile.write(f"{ligne}\r\n".encode('ascii'))
+        self.wfile.flush()
+
+    def handle(self):
+        sink = self.server
+        sink.compter('connexions')
+        self.repondre("220 locator-sink ESMTP")
+        expediteur, destinataires = None, []
+
+        while True:
+            self.connection.settimeout(sink.inactivite_max)
+            try:
+                ligne = self.rfile.readline()
+            except OSError:
+                return
+            if not ligne:
+                return
+            commande = ligne.decode('utf-8', 'replace').strip()
+            verbe = commande[:4].upper()
+
+            if verbe in ('EHLO', 'HELO'):
+                self.wfile.write(b"250-locator-sink\r\n250-AUTH PLAIN\r\n250-8BITMIME\r\n250 SMTPUTF8\r\n")
+                self.wfile.flush()
+            elif verbe == 'AUTH':
+                sink.compter('logins')
+                self.repondre("235 2.7.0 Authentication successful")
+            elif verbe == 'NOOP':
+                sink.compter('noops')
+                self.repondre("250 OK")
+            elif verbe == 'RSET':
+                expediteur, destinataires = None, []
+                self.repondre("250 OK")
+            elif verbe == 'MAIL':
+                if sink.tirer(sink.coupure_avant_donnees):
+                    # Panne avant transmission : l'émetteur peut renvoyer sans risque
+                    sink.compter('coupures_avant_donnees')
+                    return
+                expediteur, destinataires = commande[10:].strip(), []
+                self.repondre("250 OK")
+            elif verbe == 'RCPT':
+                if sink.tirer(sink.refus):
+                    sink.compter('refus')
+                    self.repondre("550 5.1.1 Unknown recipient")
+                else:
+                    destinataires.append(commande[8:].strip())
+                    self.repondre("250 OK")
+            elif verbe == 'DATA':
+                self.repondre("354 End data with <CR><LF>.<CR><LF>")
+                lignes = []
+                while True:
+                    ligne = self.rfile.readline()
+                    if not ligne or ligne in (b".\r\n", b".\n"):
+                        break
+                    # Transparence SMTP : un point doublé en début de ligne
+                    lignes.append(ligne[1:] if ligne.startswith(b"..") else ligne)
+                if sink.latence:
+                    time.sleep(sink.latence)
+                if sink.tirer(sink.echec_temporaire):
+                    sink.compter('echecs_temporaires')
+                    self.repondre("451 4.3.0 Temporary failure, try again later")
+                    continue
+                sink.recevoir(expediteur, destinataires, b"".join(lignes))
+                if sink.tirer(sink.coupure_apres_donnees):
+                    # Message accepté mais la réponse n'arrive jamais à l'émetteur
+                    sink.compter('coupures_apres_donnees')
+                    return
+                self.repondre("250 2.0.0 Message accepted")
+                expediteur, destinataires = None, []
+            elif verbe == 'QUIT':
+                self.repondre("221 Bye")
+                return
+            else:
+                self.repondre("502 5.5.1 Command not implemented")
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    """
+    Serveur SMTP en mémoire, démarré dans un thread
+
+    Args:
+        port: Port d'écoute (0 = port libre choisi par le système)
+        latence: Secondes d'attente avant de répondre à chaque message
+        echec_temporaire: Probabilité de répondre 451 à un message (non reçu)
+        refus: Probabilité de refuser un destinataire (550)
+        coupure_avant_donnees: Probabilité de couper la connexion au MAIL FROM
+        coupure_apres_donnees: Probabilité de couper la connexion après avoir reçu un message
+        inactivite_max: Secondes d'inactivité avant fermeture d'une connexion
+        graine: Graine du tirage des pannes, pour des essais reproductibles
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port=0, latence=0.0, echec_temporaire=0.0, refus=0.0, coupure_avant_donnees=0.0,
+                 coupure_apres_donnees=0.0, inactivite_max=300.0, graine=None):
+        super().__init__(('127.0.0.1', port), _SessionSink)
+        self.latence = latence
+        self.echec_temporaire = echec_temporaire
+        self.refus = refus
+        self.coupure_avant_donnees = coupure_avant_donnees
+        self.coupure_apres_donnees = coupure_apres_donnees
+        self.inactivite_max = inactivite_max
+        self.messages = []
+        self.compteurs = {}
+        self._aleatoire = random.Random(graine)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def demarrer(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='smtp-sink', daemon=True)
+        self._thread.start()
+        return self
+
+    def arreter(self):
+        self.shutdown()
+        self.server_close()
+
+    def tirer(self, probabilite):
+        if probabilite <= 0:
+            return False
+        with self._lock:
+            return self._aleatoire.random() < probabilite
+
+    def compter(self, cle):
+        with self._lock:
+            self.compteurs[cle] = self.compteurs.get(cle, 0) + 1
+
+    def recevoir(self, expediteur, destinataires, donnees):
+        with self._lock:
+            self.messages.append({
+                'expediteur': expediteur,
+                'destinataires': list(destinataires),
+                'donnees': donnees,
+                'recu_a': time.time(),
+            })
+
+    def messages_analyses(self):
+        """Messages reçus, analysés en objets email.message.EmailMessage"""
+        with self._lock:
+            messages = list(self.messages)
+        return [message_from_bytes(m['donnees'], policy=policy.default) for m in messages]
+
+    def vider(self):
+        with self._lock:
+            self.messages.clear()
+            self.compteurs.clear()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serveur SMTP local de test")
+    parser.add_argument('--port', type=int, default=1025)
+    parser.add_argument('--latence', type=float, default=0.0, help="Secondes par message")
+    parser.add_argument('--echec-temporaire', type=float, default=0.0, help="Probabilité de répondre 451")
+    parser.add_argument('--refus', type=float, default=0.0, help="Probabilité de refuser un destinataire")
+    parser.add_argument('--coupure-avant-donnees', type=float, default=0.0)
+    parser.add_argument('--coupure-apres-donnees', type=float, default=0.0)
+    args = parser.parse_args()
+
+    sink = SMTPSink(args.port, args.latence, args.echec_temporaire, args.refus,
+                    args.coupure_avant_donnees, args.coupure_apres_donnees)
+    sink.recevoir = _afficher(sink.recevoir)
+    print(f"Serveur SMTP de test sur 127.0.0.1:{sink.port} (Ctrl+C pour arrêter)")
+    try:
+        sink.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sink.server_close()
+
+
+def _afficher(recevoir):
+    def recevoir_et_afficher(expediteur, destinataires, donnees):
+        recevoir(expediteur, destinataires, donnees)
+        message = message_from_bytes(donnees, policy=policy.default)
+        print(f"{time.strftime('%H:%M:%S')} {', '.join(destinataires)} : {message['Subject']}")
+    return recevoir_et_afficher
+
+
+if __name__ == "__main__":
+    main()
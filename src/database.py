@@ -2,21 +2,161 @@
 Module de gestion de la base de données
 """
 
-from sqlalchemy import create_engine, and_, or_
+from sqlalchemy import create_engine, event, and_, or_, case, distinct, func, select
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import sessionmaker, scoped_session
-from datetime import datetime, date
-from .models import Base, Appartement, Chambre, Bail, Locataire, Paiement, Facture, AlerteEmail, HistoriqueLoyer
+from concurrent.futures import Future
+from datetime import datetime, date, timedelta
+from functools import wraps
+from .models import Base, Appartement, Chambre, Bail, Locataire, Paiement, Facture, AlerteEmail, HistoriqueLoyer, DocumentFichier, EmailOutbox, MesureEnvoiEmail
+import json
+import numpy as np
 import os
+import queue
+import random
+import threading
+import time
+import uuid
 
 # Configuration de la base de données
 # Utiliser le chemin du fichier actuel pour déterminer le dossier du projet
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 PROJECT_DIR = os.path.dirname(SCRIPT_DIR)
-DB_PATH = os.path.join(PROJECT_DIR, "locator.db")
-engine = create_engine(f'sqlite:///{DB_PATH}', echo=False)
+DB_PATH = os.getenv('LOCATOR_DB_PATH', os.path.join(PROJECT_DIR, "locator.db"))
+
+# Attente maximale (en secondes) du verrou SQLite avant de lever "database is locked"
+SQLITE_TIMEOUT = float(os.getenv('LOCATOR_DB_TIMEOUT', '5'))
+
+# Nouvelles tentatives en cas de verrou : délai exponentiel borné
+RETRY_MAX_TENTATIVES = int(os.getenv('LOCATOR_DB_RETRY_MAX', '6'))
+RETRY_DELAI_BASE = 0.05  # secondes
+RETRY_DELAI_MAX = 2.0  # secondes
+
+engine = create_engine(f'sqlite:///{DB_PATH}', echo=False, connect_args={'timeout': SQLITE_TIMEOUT})
 Session = scoped_session(sessionmaker(bind=engine, expire_on_commit=False))
 
 
+@event.listens_for(engine, "connect")
+def _configurer_connexion_sqlite(dbapi_connection, connection_record):
+    """
+    Active le mode WAL pour que les lectures ne bloquent pas les écritures,
+    et les clés étrangères pour que SQLite applique les ON DELETE CASCADE
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA foreign_keys=ON")
+    finally:
+        cursor.close()
+
+
+# ==================== ÉCRITURES CONCURRENTES ====================
+
+def _est_erreur_verrou(exc):
+    """Indique si l'exception correspond à une base SQLite verrouillée"""
+    if not isinstance(exc, OperationalError):
+        return False
+    message = str(exc).lower()
+    return 'database is locked' in message or 'database table is locked' in message
+
+
+def _executer_avec_retry(func, args, kwargs):
+    """Exécute une écriture en la relançant avec un délai exponentiel si la base est verrouillée"""
+    for tentative in range(RETRY_MAX_TENTATIVES):
+        try:
+            return func(*args, **kwargs)
+        except OperationalError as e:
+            if not _est_erreur_verrou(e) or tentative == RETRY_MAX_TENTATIVES - 1:
+                raise
+            delai = min(RETRY_DELAI_MAX, RETRY_DELAI_BASE * (2 ** tentative))
+            # Un peu d'aléa pour éviter que les sessions ne se relancent en même temps
+            time.sleep(delai * random.uniform(0.5, 1.0))
+
+
+class SingleWriter:
+    """
+    Thread unique qui sérialise toutes les écritures de l'application.
+    
+    Les fonctions décorées par write_operation lui soumettent leur travail
+    et attendent le résultat ; une seule transaction d'écriture est donc
+    ouverte à la fois, quel que soit le nombre de sessions Streamlit.
+    """
+    
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._boucle, name="locator-db-writer", daemon=True)
+        self._thread.start()
+    
+    def _boucle(self):
+        while True:
+            tache = self._queue.get()
+            if tache is None:
+                break
+            future, func, args, kwargs = tache
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(_executer_avec_retry(func, args, kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                # Libérer la session propre au thread d'écriture
+                Session.remove()
+    
+    def est_thread_ecriture(self):
+        return threading.current_thread() is self._thread
+    
+    def soumettre(self, func, args, kwargs):
+        """Place une écriture dans la file et attend son résultat"""
+        future = Future()
+        self._queue.put((future, func, args, kwargs))
+        return future.result()
+    
+    def arreter(self):
+        self._queue.put(None)
+        self._thread.join()
+
+
+_single_writer = None
+_single_writer_lock = threading.Lock()
+
+
+def enable_single_writer():
+    """Active la file d'écriture unique (idempotent)"""
+    global _single_writer
+    with _single_writer_lock:
+        if _single_writer is None:
+            _single_writer = SingleWriter()
+        return _single_writer
+
+
+def disable_single_writer():
+    """Arrête la file d'écriture unique ; les écritures redeviennent directes"""
+    global _single_writer
+    with _single_writer_lock:
+        writer, _single_writer = _single_writer, None
+    if writer is not None:
+        writer.arreter()
+
+
+def write_operation(func):
+    """
+    Décorateur des fonctions d'écriture : relance en cas de verrou SQLite et,
+    si la file d'écriture unique est active, y exécute la fonction.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        writer = _single_writer
+        if writer is not None and not writer.est_thread_ecriture():
+            return writer.soumettre(func, args, kwargs)
+        return _executer_avec_retry(func, args, kwargs)
+    return wrapper
+
+
+if os.getenv('LOCATOR_SINGLE_WRITER', '').lower() in ('1', 'true', 'oui'):
+    enable_single_writer()
+
+
 def init_db():
     """Initialise la base de données"""
     Base.metadata.create_all(engine)
@@ -47,16 +187,101 @@ def migrate_db():
                 cursor.execute("ALTER TABLE paiements ADD COLUMN date_envoi_quittance DATETIME")
                 print("✅ Colonne date_envoi_quittance ajoutée")
             
+            if 'empreinte_quittance' not in colonnes:
+                cursor.execute("ALTER TABLE paiements ADD COLUMN empreinte_quittance VARCHAR(64)")
+                print("✅ Colonne empreinte_quittance ajoutée")
+            
+            # Clé d'idempotence de la file d'envoi
+            cursor.execute("PRAGMA table_info(outbox)")
+            if 'cle' not in [col[1] for col in cursor.fetchall()]:
+                cursor.execute("ALTER TABLE outbox ADD COLUMN cle VARCHAR(120)")
+                cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS ux_outbox_cle ON outbox (cle)")
+                print("✅ Colonne cle ajoutée à la file d'envoi")
+            
             conn.commit()
         finally:
             conn.close()
         
+        migrate_foreign_keys()
+        
         print("Migration de la base de données effectuée avec succès")
     except Exception as e:
         print(f"Erreur lors de la migration : {e}")
         raise e
 
 
+def _tables_a_reconstruire(cursor):
+    """Liste les tables dont les clés étrangères n'ont pas l'action ON DELETE attendue"""
+    a_reconstruire = []
+    for table in Base.metadata.sorted_tables:
+        attendu = {
+            (fk.parent.name, fk.column.table.name): (fk.ondelete or 'NO ACTION').upper()
+            for fk in table.foreign_keys
+        }
+        if not attendu:
+            continue
+        cursor.execute(f"PRAGMA foreign_key_list({table.name})")
+        # Colonnes : id, seq, table, from, to, on_update, on_delete, match
+        existant = {(row[3], row[2]): row[6].upper() for row in cursor.fetchall()}
+        if any(existant.get(cle) != action for cle, action in attendu.items()):
+            a_reconstruire.append(table)
+    return a_reconstruire
+
+
+def migrate_foreign_keys():
+    """
+    Reconstruit les tables créées avant l'ajout des ON DELETE CASCADE.
+    
+    SQLite ne permet pas de modifier une clé étrangère : chaque table concernée
+    est recréée avec le schéma actuel puis ses données sont recopiées, selon la
+    procédure recommandée par SQLite (clés étrangères désactivées le temps de la copie).
+    """
+    from sqlalchemy.schema import CreateTable, CreateIndex
+    import sqlite3
+    
+    conn = sqlite3.connect(DB_PATH, isolation_level=None)
+    cursor = conn.cursor()
+    
+    try:
+        tables = _tables_a_reconstruire(cursor)
+        if not tables:
+            return
+        
+        cursor.execute("PRAGMA foreign_keys=OFF")
+        cursor.execute("BEGIN")
+        try:
+            for table in tables:
+                nom_temp = f"{table.name}_new"
+                ddl = str(CreateTable(table).compile(engine)).strip()
+                ddl = ddl.replace(f"CREATE TABLE {table.name} (", f"CREATE TABLE {nom_temp} (", 1)
+                cursor.execute(ddl)
+                
+                # Ne recopier que les colonnes présentes dans les deux schémas
+                cursor.execute(f"PRAGMA table_info({table.name})")
+                colonnes_existantes = {col[1] for col in cursor.fetchall()}
+                colonnes = ", ".join(c.name for c in table.columns if c.name in colonnes_existantes)
+                cursor.execute(f"INSERT INTO {nom_temp} ({colonnes}) SELECT {colonnes} FROM {table.name}")
+                
+                cursor.execute(f"DROP TABLE {table.name}")
+                cursor.execute(f"ALTER TABLE {nom_temp} RENAME TO {table.name}")
+                for index in table.indexes:
+                    cursor.execute(str(CreateIndex(index).compile(engine)))
+                print(f"✅ Table {table.name} reconstruite avec ON DELETE CASCADE")
+            
+            cursor.execute("PRAGMA foreign_key_check")
+            violations = cursor.fetchall()
+            if violations:
+                print(f"⚠️ {len(violations)} ligne(s) orpheline(s) détectée(s) après reconstruction")
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        finally:
+            cursor.execute("PRAGMA foreign_keys=ON")
+    finally:
+        conn.close()
+
+
 def get_session():
     """Retourne une session de base de données"""
     return Session()
@@ -64,6 +289,7 @@ def get_session():
 
 # ==================== APPARTEMENTS ====================
 
+@write_operation
 def create_appartement(adresse, ville, code_postal, surface, date_acquisition=None, notes=""):
     """Crée un nouvel appartement"""
     session = get_session()
@@ -104,6 +330,7 @@ def get_appartement_by_id(appartement_id):
         session.close()
 
 
+@write_operation
 def update_appartement(appartement_id, **kwargs):
     """Met à jour un appartement"""
     session = get_session()
@@ -122,16 +349,15 @@ def update_appartement(appartement_id, **kwargs):
         session.close()
 
 
+@write_operation
 def delete_appartement(appartement_id):
     """Supprime un appartement"""
     session = get_session()
     try:
-        appartement = session.query(Appartement).filter(Appartement.id == appartement_id).first()
-        if appartement:
-            session.delete(appartement)
-            session.commit()
-            return True
-        return False
+        # Chambres, baux, paiements et factures sont supprimés par SQLite (ON DELETE CASCADE)
+        nb = session.query(Appartement).filter(Appartement.id == appartement_id).delete(synchronize_session=False)
+        session.commit()
+        return nb > 0
     except Exception as e:
         session.rollback()
         raise e
@@ -141,6 +367,7 @@ def delete_appartement(appartement_id):
 
 # ==================== CHAMBRES ====================
 
+@write_operation
 def create_chambre(appartement_id, numero, loyer, charges=0.0, surface=None, est_appartement_complet=False):
     """Crée une nouvelle chambre"""
     session = get_session()
@@ -190,6 +417,7 @@ def get_all_chambres():
         session.close()
 
 
+@write_operation
 def update_chambre(chambre_id, **kwargs):
     """Met à jour une chambre"""
     session = get_session()
@@ -208,16 +436,14 @@ def update_chambre(chambre_id, **kwargs):
         session.close()
 
 
+@write_operation
 def delete_chambre(chambre_id):
     """Supprime une chambre"""
     session = get_session()
     try:
-        chambre = session.query(Chambre).filter(Chambre.id == chambre_id).first()
-        if chambre:
-            session.delete(chambre)
-            session.commit()
-            return True
-        return False
+        nb = session.query(Chambre).filter(Chambre.id == chambre_id).delete(synchronize_session=False)
+        session.commit()
+        return nb > 0
     except Exception as e:
         session.rollback()
         raise e
@@ -227,6 +453,7 @@ def delete_chambre(chambre_id):
 
 # ==================== BAUX ====================
 
+@write_operation
 def create_bail(chambre_id, date_debut, loyer_total, charges_total=0.0, date_fin=None, notes=""):
     """Crée un nouveau bail"""
     session = get_session()
@@ -287,6 +514,7 @@ def get_all_bails(actifs_seulement=False):
         session.close()
 
 
+@write_operation
 def update_bail(bail_id, **kwargs):
     """Met à jour un bail"""
     session = get_session()
@@ -305,14 +533,15 @@ def update_bail(bail_id, **kwargs):
         session.close()
 
 
+@write_operation
 def delete_bail(bail_id):
     """Supprime un bail"""
     session = get_session()
     try:
-        bail = session.query(Bail).filter(Bail.id == bail_id).first()
-        if bail:
-            chambre_id = bail.chambre_id
-            session.delete(bail)
+        chambre_id = session.query(Bail.chambre_id).filter(Bail.id == bail_id).scalar()
+        if chambre_id is not None:
+            # L'historique est supprimé et les locataires détachés par SQLite
+            session.query(Bail).filter(Bail.id == bail_id).delete(synchronize_session=False)
             session.commit()
             
             # Libérer la chambre
@@ -329,6 +558,7 @@ def delete_bail(bail_id):
 
 # ==================== LOCATAIRES ====================
 
+@write_operation
 def create_locataire(nom, email, telephone, date_entree, bail_id=None, depot_garantie=0.0, part_loyer=None, notes=""):
     """Crée un nouveau locataire"""
     session = get_session()
@@ -376,6 +606,7 @@ def get_locataire_by_id(locataire_id):
         session.close()
 
 
+@write_operation
 def update_locataire(locataire_id, **kwargs):
     """Met à jour un locataire"""
     session = get_session()
@@ -396,16 +627,14 @@ def update_locataire(locataire_id, **kwargs):
         session.close()
 
 
+@write_operation
 def delete_locataire(locataire_id):
     """Supprime un locataire"""
     session = get_session()
     try:
-        locataire = session.query(Locataire).filter(Locataire.id == locataire_id).first()
-        if locataire:
-            session.delete(locataire)
-            session.commit()
-            return True
-        return False
+        nb = session.query(Locataire).filter(Locataire.id == locataire_id).delete(synchronize_session=False)
+        session.commit()
+        return nb > 0
     except Exception as e:
         session.rollback()
         raise e
@@ -415,6 +644,7 @@ def delete_locataire(locataire_id):
 
 # ==================== PAIEMENTS ====================
 
+@write_operation
 def create_paiement(locataire_id, chambre_id, mois, annee, montant, date_paiement=None, 
                     statut='impaye', mode_paiement=None, notes=""):
     """Crée un nouveau paiement"""
@@ -477,6 +707,51 @@ def get_paiements_impayés():
         session.close()
 
 
+def get_paiements_a_relancer(mois, annee, depuis):
+    """
+    Sélectionne en une requête les impayés à relancer
+    
+    Paiements impayés de la période donnée ou antérieurs, avec leur locataire,
+    leur chambre et leur appartement, sans alerte enregistrée depuis `depuis`
+    ni alerte déjà dans la file d'envoi (anti-jointures NOT EXISTS).
+    
+    Args:
+        mois: Mois de la période courante
+        annee: Année de la période courante
+        depuis: Date à partir de laquelle une alerte déjà envoyée compte
+    
+    Returns:
+        Liste de tuples (paiement, locataire, chambre, appartement)
+    """
+    alerte_recente = select(AlerteEmail.id).where(
+        AlerteEmail.paiement_id == Paiement.id,
+        AlerteEmail.date_envoi >= depuis
+    ).exists()
+    alerte_en_file = select(EmailOutbox.id).where(
+        EmailOutbox.paiement_id == Paiement.id,
+        EmailOutbox.type_envoi == 'alerte',
+        EmailOutbox.statut.in_(STATUTS_OUTBOX_ACTIFS)
+    ).exists()
+    
+    session = get_session()
+    try:
+        query = session.query(Paiement, Locataire, Chambre, Appartement).join(
+            Locataire, Paiement.locataire_id == Locataire.id
+        ).join(
+            Chambre, Paiement.chambre_id == Chambre.id
+        ).join(
+            Appartement, Chambre.appartement_id == Appartement.id
+        ).filter(
+            Paiement.statut == 'impaye',
+            or_(Paiement.annee < annee, and_(Paiement.annee == annee, Paiement.mois <= mois)),
+            ~alerte_recente,
+            ~alerte_en_file
+        )
+        return [tuple(row) for row in query.order_by(Paiement.annee, Paiement.mois, Locataire.nom).all()]
+    finally:
+        session.close()
+
+
 def get_paiements_by_mois_annee(mois, annee):
     """Récupère tous les paiements pour un mois et une année donnés"""
     session = get_session()
@@ -488,6 +763,7 @@ def get_paiements_by_mois_annee(mois, annee):
         session.close()
 
 
+@write_operation
 def update_paiement(paiement_id, **kwargs):
     """Met à jour un paiement. Si date_paiement est fournie, le statut passe automatiquement à 'paye'"""
     session = get_session()
@@ -513,16 +789,241 @@ def update_paiement(paiement_id, **kwargs):
         session.close()
 
 
+def get_paiements_a_quittancer(mois, annee, appartement_id=None, seulement_sans_quittance=True):
+    """
+    Récupère les paiements payés d'une période, par défaut ceux sans quittance
+    
+    Args:
+        mois: Mois de la période
+        annee: Année de la période
+        appartement_id: Limiter à un appartement (optionnel)
+        seulement_sans_quittance: Exclure les paiements ayant déjà une quittance
+    
+    Returns:
+        Liste de tuples (paiement, locataire, chambre, appartement)
+    """
+    session = get_session()
+    try:
+        query = session.query(Paiement, Locataire, Chambre, Appartement).join(
+            Locataire, Paiement.locataire_id == Locataire.id
+        ).join(
+            Chambre, Paiement.chambre_id == Chambre.id
+        ).join(
+            Appartement, Chambre.appartement_id == Appartement.id
+        ).filter(
+            Paiement.mois == mois,
+            Paiement.annee == annee,
+            Paiement.statut == 'paye'
+        )
+        if seulement_sans_quittance:
+            query = query.filter(or_(
+                Paiement.quittance_generee == False,
+                Paiement.quittance_generee == None,
+                Paiement.chemin_quittance == None
+            ))
+        if appartement_id is not None:
+            query = query.filter(Appartement.id == appartement_id)
+        return [tuple(row) for row in query.order_by(Locataire.nom).all()]
+    finally:
+        session.close()
+
+
+def get_paiements_details(paiement_ids):
+    """
+    Charge en une requête les paiements et leurs locataire, chambre et appartement
+    
+    Returns:
+        dict paiement_id -> (paiement, locataire, chambre, appartement)
+    """
+    if not paiement_ids:
+        return {}
+    session = get_session()
+    try:
+        query = session.query(Paiement, Locataire, Chambre, Appartement).join(
+            Locataire, Paiement.locataire_id == Locataire.id
+        ).join(
+            Chambre, Paiement.chambre_id == Chambre.id
+        ).join(
+            Appartement, Chambre.appartement_id == Appartement.id
+        ).filter(Paiement.id.in_(list(paiement_ids)))
+        return {row[0].id: tuple(row) for row in query.all()}
+    finally:
+        session.close()
+
+
+def get_recapitulatif_annuel(annee, locataire_id=None):
+    """
+    Récapitulatif annuel des loyers payés, par locataire et par mois
+    
+    Les montants, dates et modes de paiement sont agrégés par une seule requête
+    groupée sur les paiements (locataire, chambre, mois) ; le regroupement par
+    locataire et les totaux sont faits ensuite en mémoire.
+    
+    Args:
+        annee: Année du récapitulatif
+        locataire_id: Limiter à un locataire (optionnel)
+    
+    Returns:
+        Liste de dicts, un par locataire (triés par nom) :
+        {'locataire', 'appartement', 'chambre', 'mois': [{'mois', 'montant',
+        'date_paiement', 'mode_paiement'}], 'total', 'nb_mois'}
+    """
+    session = get_session()
+    try:
+        query = session.query(
+            Locataire,
+            Chambre,
+            Appartement,
+            Paiement.mois,
+            func.sum(Paiement.montant),
+            func.max(Paiement.date_paiement),
+            func.group_concat(distinct(Paiement.mode_paiement))
+        ).join(
+            Locataire, Paiement.locataire_id == Locataire.id
+        ).join(
+            Chambre, Paiement.chambre_id == Chambre.id
+        ).join(
+            Appartement, Chambre.appartement_id == Appartement.id
+        ).filter(
+            Paiement.annee == annee,
+            Paiement.statut == 'paye'
+        )
+        if locataire_id is not None:
+            query = query.filter(Paiement.locataire_id == locataire_id)
+        lignes = query.group_by(
+            Paiement.locataire_id, Paiement.chambre_id, Paiement.mois
+        ).order_by(Locataire.nom, Locataire.id, Paiement.mois).all()
+        
+        recapitulatifs = {}
+        for locataire, chambre, appartement, mois, montant, date_paiement, modes in lignes:
+            recap = recapitulatifs.setdefault(locataire.id, {
+                'locataire': locataire,
+                'mois': [],
+                'total': 0.0,
+            })
+            # Le logement retenu est celui du dernier mois payé
+            recap['chambre'] = chambre
+            recap['appartement'] = appartement
+            recap['mois'].append({
+                'mois': mois,
+                'montant': montant or 0.0,
+                'date_paiement': date_paiement,
+                'mode_paiement': modes.replace(',', ', ') if modes else None,
+            })
+            recap['total'] += montant or 0.0
+        
+        for recap in recapitulatifs.values():
+            recap['nb_mois'] = len({ligne['mois'] for ligne in recap['mois']})
+        return list(recapitulatifs.values())
+    finally:
+        session.close()
+
+
+@write_operation
+def marquer_quittances_generees(chemins_par_paiement, empreintes=None, date_quittance=None):
+    """
+    Enregistre en une seule mise à jour groupée les quittances générées
+    
+    Args:
+        chemins_par_paiement: dict {paiement_id: chemin_quittance}
+        empreintes: dict {paiement_id: empreinte_quittance} (optionnel)
+        date_quittance: Date de génération (aujourd'hui par défaut)
+    
+    Returns:
+        Nombre de paiements mis à jour
+    """
+    if not chemins_par_paiement:
+        return 0
+    date_quittance = date_quittance or date.today()
+    session = get_session()
+    try:
+        empreintes = empreintes or {}
+        session.bulk_update_mappings(Paiement, [
+            {
+                'id': paiement_id,
+                'quittance_generee': True,
+                'chemin_quittance': chemin,
+                'date_quittance': date_quittance,
+                'empreinte_quittance': empreintes.get(paiement_id),
+            }
+            for paiement_id, chemin in chemins_par_paiement.items()
+        ])
+        session.commit()
+        return len(chemins_par_paiement)
+    except Exception as e:
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+
+@write_operation
 def delete_paiement(paiement_id):
     """Supprime un paiement"""
     session = get_session()
     try:
-        paiement = session.query(Paiement).filter(Paiement.id == paiement_id).first()
-        if paiement:
-            session.delete(paiement)
-            session.commit()
-            return True
-        return False
+        nb = session.query(Paiement).filter(Paiement.id == paiement_id).delete(synchronize_session=False)
+        session.commit()
+        return nb > 0
+    except Exception as e:
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+
+@write_operation
+def marquer_quittances_envoyees(paiement_ids, date_envoi=None):
+    """
+    Marque un lot de quittances comme envoyées par email, en une seule mise à jour
+    
+    Returns:
+        Nombre de paiements mis à jour
+    """
+    if not paiement_ids:
+        return 0
+    session = get_session()
+    try:
+        nb = session.query(Paiement).filter(Paiement.id.in_(list(paiement_ids))).update({
+            Paiement.quittance_envoyee: True,
+            Paiement.date_envoi_quittance: date_envoi or datetime.now(),
+        }, synchronize_session=False)
+        session.commit()
+        return nb
+    except Exception as e:
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+
+@write_operation
+def enregistrer_alertes(alertes):
+    """
+    Enregistre un lot d'alertes email en une seule insertion
+    
+    Args:
+        alertes: Liste de dicts avec 'locataire_id', 'paiement_id', 'statut'
+                 et éventuellement 'message_erreur' et 'date_envoi'
+    
+    Returns:
+        Nombre d'alertes enregistrées
+    """
+    from sqlalchemy import insert
+    
+    if not alertes:
+        return 0
+    maintenant = datetime.now()
+    lignes = [
+        {'locataire_id': a['locataire_id'], 'paiement_id': a['paiement_id'], 'statut': a['statut'],
+         'message_erreur': a.get('message_erreur'), 'date_envoi': a.get('date_envoi') or maintenant}
+        for a in alertes
+    ]
+    session = get_session()
+    try:
+        session.execute(insert(AlerteEmail), lignes)
+        session.commit()
+        return len(lignes)
     except Exception as e:
         session.rollback()
         raise e
@@ -532,6 +1033,7 @@ def delete_paiement(paiement_id):
 
 # ==================== FACTURES ====================
 
+@write_operation
 def create_facture(appartement_id, categorie, montant, date_facture, fournisseur="", 
                    description="", fichier_path="", statut='impaye'):
     """Crée une nouvelle facture"""
@@ -584,6 +1086,7 @@ def get_factures_by_categorie(categorie):
         session.close()
 
 
+@write_operation
 def update_facture(facture_id, **kwargs):
     """Met à jour une facture"""
     session = get_session()
@@ -602,6 +1105,7 @@ def update_facture(facture_id, **kwargs):
         session.close()
 
 
+@write_operation
 def delete_facture(facture_id):
     """Supprime une facture"""
     session = get_session()
@@ -619,6 +1123,696 @@ def delete_facture(facture_id):
         session.close()
 
 
+# ==================== DOCUMENTS ====================
+
+CHAMPS_DOCUMENT = ('type_document', 'locataire_id', 'appartement_id', 'paiement_id', 'annee', 'mois', 'taille', 'empreinte')
+
+
+def _upsert_document():
+    """Insertion ou mise à jour d'une ligne de l'index, par chemin, construite une seule fois"""
+    from sqlalchemy.dialects.sqlite import insert
+    
+    requete = insert(DocumentFichier.__table__)
+    return requete.on_conflict_do_update(
+        index_elements=['chemin'],
+        set_={champ: requete.excluded[champ] for champ in CHAMPS_DOCUMENT + ('created_at',)}
+    ).returning(DocumentFichier.__table__.c.id)
+
+
+# Une seule instruction paramétrée : pas de lecture préalable, et deux
+# écritures simultanées du même chemin ne se heurtent pas à l'unicité
+_UPSERT_DOCUMENT = _upsert_document()
+
+
+@write_operation
+def enregistrer_document(chemin, type_document, taille, empreinte, locataire_id=None, appartement_id=None,
+                         paiement_id=None, annee=None, mois=None, publier=None):
+    """
+    Enregistre un fichier dans l'index des documents (ou met à jour sa ligne)
+    
+    Si publier est fourni (renommage du fichier temporaire en fichier final),
+    il est appelé dans la transaction, juste avant le commit. S'il échoue, la
+    transaction est annulée ; si c'est le commit qui échoue, publier.annuler()
+    (s'il existe) remet les fichiers dans leur état d'avant. Après le commit,
+    publier.valider() (s'il existe) est appelé : fichier et ligne apparaissent
+    ensemble.
+    
+    Args:
+        chemin: Chemin du fichier
+        type_document: 'quittance', 'attestation' ou 'facture'
+        taille: Taille en octets
+        empreinte: SHA-256 du contenu
+        locataire_id, appartement_id, paiement_id: Entités propriétaires (optionnel)
+        annee, mois: Période du document (optionnel)
+        publier: Fonction appelée avant le commit, avec éventuellement des
+            méthodes annuler() et valider() (optionnel)
+    
+    Returns:
+        Identifiant de la ligne
+    """
+    ligne = {
+        'chemin': os.path.normpath(chemin), 'type_document': type_document, 'locataire_id': locataire_id,
+        'appartement_id': appartement_id, 'paiement_id': paiement_id, 'annee': annee, 'mois': mois,
+        'taille': taille, 'empreinte': empreinte, 'created_at': datetime.now(),
+    }
+    session = get_session()
+    try:
+        document_id = session.connection().execute(_UPSERT_DOCUMENT, ligne).scalar_one()
+        if publier is not None:
+            publier()
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        if hasattr(publier, 'annuler'):
+            publier.annuler()
+        raise e
+    finally:
+        session.close()
+    
+    if hasattr(publier, 'valider'):
+        publier.valider()
+    return document_id
+
+
+@write_operation
+def enregistrer_documents(documents):
+    """
+    Enregistre un lot de fichiers dans l'index en une seule instruction
+    
+    Args:
+        documents: Liste de dicts avec 'chemin' et les champs de CHAMPS_DOCUMENT
+    
+    Returns:
+        Nombre de documents enregistrés
+    """
+    from sqlalchemy.dialects.sqlite import insert
+    
+    if not documents:
+        return 0
+    maintenant = datetime.now()
+    lignes = [
+        dict({champ: document.get(champ) for champ in CHAMPS_DOCUMENT},
+             chemin=os.path.normpath(document['chemin']), created_at=maintenant)
+        for document in documents
+    ]
+    requete = insert(DocumentFichier)
+    requete = requete.on_conflict_do_update(
+        index_elements=[DocumentFichier.chemin],
+        set_={champ: requete.excluded[champ] for champ in CHAMPS_DOCUMENT + ('created_at',)}
+    )
+    session = get_session()
+    try:
+        session.execute(requete, lignes)
+        session.commit()
+        return len(lignes)
+    except Exception as e:
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+
+def get_documents(type_document=None, locataire_id=None, appartement_id=None, annee=None, mois=None):
+    """
+    Recherche des fichiers dans l'index des documents
+    
+    Returns:
+        Liste d'objets DocumentFichier, du plus ancien au plus récent par période
+    """
+    session = get_session()
+    try:
+        query = session.query(DocumentFichier)
+        if type_document is not None:
+            query = query.filter(DocumentFichier.type_document == type_document)
+        if locataire_id is not None:
+            query = query.filter(DocumentFichier.locataire_id == locataire_id)
+        if appartement_id is not None:
+            query = query.filter(DocumentFichier.appartement_id == appartement_id)
+        if annee is not None:
+            query = query.filter(DocumentFichier.annee == annee)
+        if mois is not None:
+            query = query.filter(DocumentFichier.mois == mois)
+        return query.order_by(DocumentFichier.annee, DocumentFichier.mois, DocumentFichier.chemin).all()
+    finally:
+        session.close()
+
+
+@write_operation
+def supprimer_documents(chemins):
+    """Retire des fichiers de l'index des documents"""
+    if not chemins:
+        return 0
+    session = get_session()
+    try:
+        nb = session.query(DocumentFichier).filter(
+            DocumentFichier.chemin.in_([os.path.normpath(chemin) for chemin in chemins])
+        ).delete(synchronize_session=False)
+        session.commit()
+        return nb
+    except Exception as e:
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+
+# ==================== FILE D'ENVOI DES EMAILS ====================
+
+# Nombre maximal de tentatives d'envoi d'un email avant abandon
+OUTBOX_TENTATIVES_MAX = int(os.getenv('LOCATOR_OUTBOX_TENTATIVES_MAX', '6'))
+OUTBOX_DELAI_BASE = 30  # secondes, doublé à chaque échec
+OUTBOX_DELAI_MAX = 3600  # secondes
+# Un envoi réservé depuis plus longtemps (worker arrêté en cours d'envoi) est repris
+OUTBOX_RESERVATION_MAX = 600  # secondes
+
+STATUTS_OUTBOX_ACTIFS = ('en_attente', 'en_cours')
+
+
+def _delai_outbox(tentatives):
+    """Délai avant la prochaine tentative, exponentiel avec un peu d'aléa"""
+    delai = min(OUTBOX_DELAI_MAX, OUTBOX_DELAI_BASE * (2 ** max(0, tentatives - 1)))
+    return timedelta(seconds=delai * random.uniform(0.8, 1.2))
+
+
+def mettre_email_en_file(type_envoi, locataire_id, paiement_id=None, payload=None, cle=None):
+    """
+    Ajoute un email à la file d'envoi
+    
+    Voir mettre_emails_en_file pour le traitement des doublons.
+    
+    Args:
+        type_envoi: 'quittance' ou 'alerte'
+        locataire_id: ID du locataire destinataire
+        paiement_id: ID du paiement concerné (optionnel)
+        payload: dict des données nécessaires à l'envoi (sérialisé en JSON)
+        cle: Clé d'idempotence de l'envoi (optionnelle)
+    
+    Returns:
+        Objet EmailOutbox (statut 'envoye' si cet envoi a déjà été fait)
+    """
+    outbox_id, = mettre_emails_en_file([{'type_envoi': type_envoi, 'locataire_id': locataire_id,
+                                         'paiement_id': paiement_id, 'payload': payload, 'cle': cle}])
+    session = get_session()
+    try:
+        return session.get(EmailOutbox, outbox_id)
+    finally:
+        session.close()
+
+
+@write_operation
+def mettre_emails_en_file(envois):
+    """
+    Ajoute un lot d'emails à la file d'envoi en une transaction
+    
+    Un envoi dont la clé d'idempotence existe déjà n'est jamais dupliqué : déjà
+    envoyé, il est ignoré ; en échec, il est remis en file ; encore en file, ses
+    données sont mises à jour. Sans clé connue, un envoi déjà en file pour le
+    même paiement et le même type est mis à jour (et prend la nouvelle clé).
+    Les mises à jour et les insertions sont faites chacune en une seule
+    instruction ; l'index unique sur la clé départage deux sessions qui
+    ajouteraient le même envoi en même temps.
+    
+    Args:
+        envois: Liste de dicts avec 'type_envoi', 'locataire_id', 'paiement_id',
+                'payload' (optionnel), 'cle' (optionnelle) et
+                'prochaine_tentative' (optionnelle, maintenant par défaut)
+    
+    Returns:
+        Liste des IDs des envois, dans l'ordre de la liste
+    """
+    from sqlalchemy import update
+    from sqlalchemy.dialects.sqlite import insert
+    
+    if not envois:
+        return []
+    maintenant = datetime.now()
+    cles = [e['cle'] for e in envois if e.get('cle')]
+    paiement_ids = list({e['paiement_id'] for e in envois if e.get('paiement_id') is not None})
+    
+    def par_cle(session):
+        if not cles:
+            return {}
+        return {
+            cle: (outbox_id, statut)
+            for outbox_id, cle, statut in session.query(
+                EmailOutbox.id, EmailOutbox.cle, EmailOutbox.statut
+            ).filter(EmailOutbox.cle.in_(cles))
+        }
+    
+    def actifs(session):
+        return {
+            (type_envoi, paiement_id): (outbox_id, statut)
+            for outbox_id, type_envoi, paiement_id, statut in session.query(
+                EmailOutbox.id, EmailOutbox.type_envoi, EmailOutbox.paiement_id, EmailOutbox.statut
+            ).filter(
+                EmailOutbox.paiement_id.in_(paiement_ids),
+                EmailOutbox.statut.in_(STATUTS_OUTBOX_ACTIFS)
+            )
+        }
+    
+    session = get_session()
+    try:
+        connus = par_cle(session)
+        existants = actifs(session)
+        mises_a_jour = {}
+        nouveaux = {}
+        for e in envois:
+            cle = e.get('cle')
+            payload = json.dumps(e.get('payload') or {}, ensure_ascii=False)
+            if cle in connus:
+                outbox_id, statut = connus[cle]
+                if statut == 'envoye':
+                    continue
+                ligne = {'id': outbox_id, 'payload': payload}
+                if statut == 'echec':
+                    ligne.update(statut='en_attente', tentatives=0)
+            elif (e['type_envoi'], e.get('paiement_id')) in existants:
+                outbox_id, statut = existants[(e['type_envoi'], e.get('paiement_id'))]
+                ligne = {'id': outbox_id, 'payload': payload}
+                if cle:
+                    ligne['cle'] = cle
+            else:
+                nouveaux[cle or (e['type_envoi'], e.get('paiement_id'))] = {
+                    'type_envoi': e['type_envoi'], 'locataire_id': e['locataire_id'],
+                    'paiement_id': e.get('paiement_id'), 'cle': cle, 'payload': payload, 'statut': 'en_attente',
+                    'tentatives': 0, 'prochaine_tentative': e.get('prochaine_tentative', maintenant),
+                    'created_at': maintenant
+                }
+                continue
+            if statut != 'en_cours':
+                ligne['prochaine_tentative'] = e.get('prochaine_tentative', maintenant)
+            mises_a_jour[outbox_id] = ligne
+        
+        # Regrouper par jeu de colonnes pour que chaque UPDATE reste une seule instruction
+        groupes = {}
+        for ligne in mises_a_jour.values():
+            groupes.setdefault(frozenset(ligne), []).append(ligne)
+        for lignes in groupes.values():
+            session.execute(update(EmailOutbox), lignes)
+        if nouveaux:
+            session.execute(insert(EmailOutbox).on_conflict_do_nothing(index_elements=['cle']),
+                            list(nouveaux.values()))
+        
+        connus = {cle: outbox_id for cle, (outbox_id, _) in par_cle(session).items()}
+        ids = {cle: outbox_id for cle, (outbox_id, _) in actifs(session).items()}
+        session.commit()
+        return [connus[e['cle']] if e.get('cle') else ids[(e['type_envoi'], e['paiement_id'])] for e in envois]
+    except Exception as e:
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+
+def get_statut_envoi(cle):
+    """Statut de l'envoi portant cette clé d'idempotence (None s'il n'existe pas), en lecture seule"""
+    session = get_session()
+    try:
+        return session.query(EmailOutbox.statut).filter(EmailOutbox.cle == cle).scalar()
+    finally:
+        session.close()
+
+
+@write_operation
+def reserver_envoi(cle, type_envoi, locataire_id, paiement_id=None, payload=None):
+    """
+    Réserve un envoi immédiat (hors worker) identifié par sa clé d'idempotence
+    
+    L'envoi est créé directement « en cours » ; s'il existe déjà, il n'est
+    repris que s'il attend dans la file, a échoué, ou si sa réservation a
+    expiré. Une même demande répétée (double clic, relance de la page, autre
+    session) ne réserve donc rien et l'appelant n'ouvre pas de session SMTP.
+    
+    Args:
+        cle: Clé d'idempotence de l'envoi
+        type_envoi: 'quittance', 'alerte' ou 'recapitulatif'
+        locataire_id: ID du locataire destinataire
+        paiement_id: ID du paiement concerné (optionnel)
+        payload: dict des données nécessaires à l'envoi (sérialisé en JSON)
+    
+    Returns:
+        tuple (outbox_id, statut, tentatives, jeton) : outbox_id et jeton valent
+        None si l'envoi n'a pas été réservé, statut est alors celui de l'envoi
+        existant ('envoye', 'en_cours') ; tentatives compte la tentative en
+        cours ; jeton identifie la réservation (voir terminer_email)
+    """
+    from sqlalchemy.dialects.sqlite import insert
+    
+    maintenant = datetime.now()
+    jeton = uuid.uuid4().hex
+    session = get_session()
+    try:
+        session.execute(insert(EmailOutbox).values(
+            type_envoi=type_envoi, locataire_id=locataire_id, paiement_id=paiement_id, cle=cle,
+            payload=json.dumps(payload or {}, ensure_ascii=False), statut='en_cours', tentatives=1,
+            prochaine_tentative=maintenant, reserve_par=jeton, reserve_a=maintenant, created_at=maintenant
+        ).on_conflict_do_nothing(index_elements=['cle']))
+        session.query(EmailOutbox).filter(
+            EmailOutbox.cle == cle,
+            or_(EmailOutbox.statut.in_(['en_attente', 'echec']),
+                and_(EmailOutbox.statut == 'en_cours',
+                     EmailOutbox.reserve_a < maintenant - timedelta(seconds=OUTBOX_RESERVATION_MAX)))
+        ).update({
+            EmailOutbox.statut: 'en_cours',
+            EmailOutbox.reserve_par: jeton,
+            EmailOutbox.reserve_a: maintenant,
+            EmailOutbox.tentatives: EmailOutbox.tentatives + 1,
+        }, synchronize_session=False)
+        outbox_id, statut, reserve_par, tentatives = session.query(
+            EmailOutbox.id, EmailOutbox.statut, EmailOutbox.reserve_par, EmailOutbox.tentatives
+        ).filter(EmailOutbox.cle == cle).one()
+        session.commit()
+        if reserve_par != jeton:
+            return None, statut, tentatives, None
+        return outbox_id, statut, tentatives, jeton
+    except Exception as e:
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+
+@write_operation
+def reserver_emails(limite=20, outbox_ids=None):
+    """
+    Réserve les prochains emails à envoyer pour le worker appelant
+    
+    La réservation est faite par une seule instruction UPDATE : deux workers
+    ne peuvent pas réserver le même envoi. Les envois restés « en cours » plus
+    de OUTBOX_RESERVATION_MAX secondes sont repris.
+    
+    Args:
+        limite: Nombre maximal d'envois réservés
+        outbox_ids: Réserve ces envois en attente, même si leur prochaine
+                    tentative n'est pas encore due (envoi groupé immédiat)
+    
+    Returns:
+        Liste d'objets EmailOutbox passés à 'en_cours' (tentatives déjà
+        incrémentées, reserve_par contient le jeton de la réservation)
+    """
+    maintenant = datetime.now()
+    jeton = uuid.uuid4().hex
+    if outbox_ids is not None:
+        disponibles = select(EmailOutbox.id).where(
+            EmailOutbox.id.in_(list(outbox_ids)),
+            EmailOutbox.statut == 'en_attente'
+        ).limit(limite)
+    else:
+        disponibles = select(EmailOutbox.id).where(or_(
+            and_(EmailOutbox.statut == 'en_attente', EmailOutbox.prochaine_tentative <= maintenant),
+            and_(EmailOutbox.statut == 'en_cours',
+                 EmailOutbox.reserve_a < maintenant - timedelta(seconds=OUTBOX_RESERVATION_MAX))
+        )).order_by(EmailOutbox.prochaine_tentative).limit(limite)
+    
+    session = get_session()
+    try:
+        session.query(EmailOutbox).filter(EmailOutbox.id.in_(disponibles)).update({
+            EmailOutbox.statut: 'en_cours',
+            EmailOutbox.reserve_par: jeton,
+            EmailOutbox.reserve_a: maintenant,
+            EmailOutbox.tentatives: EmailOutbox.tentatives + 1,
+        }, synchronize_session=False)
+        session.commit()
+        return session.query(EmailOutbox).filter(EmailOutbox.reserve_par == jeton).order_by(EmailOutbox.id).all()
+    except Exception as e:
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+
+@write_operation
+def renouveler_reservation(outbox_id, jeton):
+    """
+    Vérifie qu'un envoi est toujours réservé par le jeton donné et repousse l'expiration de la réservation
+    
+    À appeler juste avant de transmettre le message : une réservation expirée
+    a pu être reprise par un autre worker, qui l'enverra lui-même.
+    
+    Returns:
+        True si la réservation est toujours détenue
+    """
+    session = get_session()
+    try:
+        renouvelees = session.query(EmailOutbox).filter(
+            EmailOutbox.id == outbox_id,
+            EmailOutbox.statut == 'en_cours',
+            EmailOutbox.reserve_par == jeton
+        ).update({EmailOutbox.reserve_a: datetime.now()}, synchronize_session=False)
+        session.commit()
+        return renouvelees == 1
+    except Exception as e:
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+
+@write_operation
+def terminer_email(outbox_id, erreur=None, definitif=False, suivi=True, jeton=None):
+    """
+    Enregistre le résultat d'un envoi réservé
+    
+    En cas de succès, le paiement est marqué comme envoyé (quittance) ou
+    l'alerte est enregistrée. En cas d'échec, l'envoi est reprogrammé avec un
+    délai croissant, sauf si l'erreur est définitive ou si le nombre maximal
+    de tentatives est atteint (statut 'echec').
+    
+    Args:
+        outbox_id: ID de l'envoi
+        erreur: Message d'erreur (None si l'envoi a réussi)
+        definitif: True si une nouvelle tentative ne peut pas réussir
+        suivi: False si l'appelant enregistre lui-même le résultat (quittance
+               envoyée, alerte) : seul l'envoi est mis à jour
+        jeton: Jeton de la réservation ; si l'envoi a été repris depuis par un
+               autre worker, rien n'est enregistré
+    
+    Returns:
+        Objet EmailOutbox mis à jour, ou None si l'envoi n'existe plus ou n'est
+        plus réservé par ce jeton
+    """
+    session = get_session()
+    try:
+        envoi = session.get(EmailOutbox, outbox_id)
+        if envoi is None or (jeton is not None and envoi.reserve_par != jeton):
+            return None
+        maintenant = datetime.now()
+        envoi.reserve_par = None
+        envoi.reserve_a = None
+        envoi.derniere_erreur = erreur
+        
+        if erreur is None:
+            envoi.statut = 'envoye'
+            envoi.date_envoi = maintenant
+            if suivi and envoi.type_envoi == 'quittance' and envoi.paiement_id is not None:
+                session.query(Paiement).filter(Paiement.id == envoi.paiement_id).update({
+                    Paiement.quittance_envoyee: True,
+                    Paiement.date_envoi_quittance: maintenant,
+                }, synchronize_session=False)
+            elif suivi and envoi.type_envoi == 'alerte':
+                session.add(AlerteEmail(locataire_id=envoi.locataire_id, paiement_id=envoi.paiement_id,
+                                        date_envoi=maintenant, statut='envoye'))
+        elif definitif or envoi.tentatives >= OUTBOX_TENTATIVES_MAX:
+            envoi.statut = 'echec'
+            if suivi and envoi.type_envoi == 'alerte':
+                session.add(AlerteEmail(locataire_id=envoi.locataire_id, paiement_id=envoi.paiement_id,
+                                        date_envoi=maintenant, statut='erreur', message_erreur=erreur))
+        else:
+            envoi.statut = 'en_attente'
+            envoi.prochaine_tentative = maintenant + _delai_outbox(envoi.tentatives)
+        
+        session.commit()
+        return envoi
+    except Exception as e:
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+
+def get_emails_en_file(type_envoi=None, paiement_ids=None, statuts=STATUTS_OUTBOX_ACTIFS):
+    """
+    Liste les envois de la file
+    
+    Args:
+        type_envoi: 'quittance' ou 'alerte' (optionnel)
+        paiement_ids: Restreint aux paiements donnés (optionnel)
+        statuts: Statuts retenus (en attente et en cours par défaut, None pour tous)
+    
+    Returns:
+        Liste d'objets EmailOutbox, du plus ancien au plus récent
+    """
+    session = get_session()
+    try:
+        query = session.query(EmailOutbox)
+        if type_envoi is not None:
+            query = query.filter(EmailOutbox.type_envoi == type_envoi)
+        if paiement_ids is not None:
+            query = query.filter(EmailOutbox.paiement_id.in_(list(paiement_ids)))
+        if statuts is not None:
+            query = query.filter(EmailOutbox.statut.in_(statuts))
+        return query.order_by(EmailOutbox.created_at, EmailOutbox.id).all()
+    finally:
+        session.close()
+
+
+def get_etat_outbox():
+    """Nombre d'envois par statut dans la file"""
+    session = get_session()
+    try:
+        lignes = session.query(EmailOutbox.statut, func.count(EmailOutbox.id)).group_by(EmailOutbox.statut).all()
+        etat = {statut: 0 for statut in ('en_attente', 'en_cours', 'envoye', 'echec')}
+        etat.update(dict(lignes))
+        return etat
+    finally:
+        session.close()
+
+
+@write_operation
+def relancer_emails_en_echec():
+    """Remet en file les envois abandonnés, avec un compteur de tentatives remis à zéro"""
+    session = get_session()
+    try:
+        nb = session.query(EmailOutbox).filter(EmailOutbox.statut == 'echec').update({
+            EmailOutbox.statut: 'en_attente',
+            EmailOutbox.tentatives: 0,
+            EmailOutbox.prochaine_tentative: datetime.now(),
+        }, synchronize_session=False)
+        session.commit()
+        return nb
+    except Exception as e:
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+
+# ==================== MESURES DES ENVOIS ====================
+
+@write_operation
+def enregistrer_mesures_envoi(mesures):
+    """
+    Enregistre un lot de mesures de tentatives d'envoi en une seule insertion
+    
+    Les mesures sont écrites par lots, après coup : l'envoi ou le paiement
+    mesuré a pu être supprimé entre-temps. Sa référence est alors effacée
+    (comme le ferait ON DELETE SET NULL) plutôt que de faire rejeter tout le
+    lot par la contrainte de clé étrangère.
+    
+    Args:
+        mesures: Liste de dicts aux colonnes de MesureEnvoiEmail
+    
+    Returns:
+        Nombre de mesures enregistrées
+    """
+    from sqlalchemy import insert
+    
+    if not mesures:
+        return 0
+    outbox_ids = {m['outbox_id'] for m in mesures if m.get('outbox_id') is not None}
+    paiement_ids = {m['paiement_id'] for m in mesures if m.get('paiement_id') is not None}
+    session = get_session()
+    try:
+        if outbox_ids:
+            outbox_ids = {row[0] for row in session.query(EmailOutbox.id).filter(EmailOutbox.id.in_(outbox_ids))}
+        if paiement_ids:
+            paiement_ids = {row[0] for row in session.query(Paiement.id).filter(Paiement.id.in_(paiement_ids))}
+        lignes = [
+            dict(m, outbox_id=m.get('outbox_id') if m.get('outbox_id') in outbox_ids else None,
+                 paiement_id=m.get('paiement_id') if m.get('paiement_id') in paiement_ids else None)
+            for m in mesures
+        ]
+        session.execute(insert(MesureEnvoiEmail), lignes)
+        session.commit()
+        return len(mesures)
+    except Exception as e:
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+
+def _centiles(valeurs):
+    """p50, p95 et p99 (ms) d'une série, en ignorant les valeurs absentes"""
+    valeurs = np.array([v for v in valeurs if v is not None], dtype=float)
+    if valeurs.size == 0:
+        return {'p50': None, 'p95': None, 'p99': None}
+    p50, p95, p99 = np.percentile(valeurs, [50, 95, 99])
+    return {'p50': round(float(p50), 1), 'p95': round(float(p95), 1), 'p99': round(float(p99), 1)}
+
+
+def get_statistiques_envois(depuis=None):
+    """
+    Latences et taux d'échec des tentatives d'envoi d'email
+    
+    Les centiles sont calculés avec NumPy sur les mesures de la période
+    (SQLite n'a pas de fonction de centile).
+    
+    Args:
+        depuis: Date de début (7 derniers jours par défaut)
+    
+    Returns:
+        dict avec 'global' et 'par_serveur' (nombre de tentatives, échecs, taux
+        d'échec, centiles de durée totale, de transfert et d'ouverture de
+        session), 'codes' ({code SMTP: nombre}), 'par_jour' et 'echecs_recents'
+    """
+    depuis = depuis or datetime.now() - timedelta(days=7)
+    session = get_session()
+    try:
+        mesures = session.query(
+            MesureEnvoiEmail.serveur, MesureEnvoiEmail.type_envoi, MesureEnvoiEmail.date_envoi,
+            MesureEnvoiEmail.succes, MesureEnvoiEmail.code_smtp, MesureEnvoiEmail.erreur,
+            MesureEnvoiEmail.tentative, MesureEnvoiEmail.taille, MesureEnvoiEmail.attente_ms,
+            MesureEnvoiEmail.connexion_ms, MesureEnvoiEmail.tls_ms, MesureEnvoiEmail.auth_ms,
+            MesureEnvoiEmail.transfert_ms, MesureEnvoiEmail.duree_ms
+        ).filter(MesureEnvoiEmail.date_envoi >= depuis).order_by(MesureEnvoiEmail.date_envoi).all()
+    finally:
+        session.close()
+    
+    def resumer(lignes):
+        nb = len(lignes)
+        echecs = sum(1 for m in lignes if not m.succes)
+        ouvertures = [
+            (m.connexion_ms or 0) + (m.tls_ms or 0) + (m.auth_ms or 0)
+            for m in lignes if m.connexion_ms is not None
+        ]
+        return {
+            'tentatives': nb,
+            'echecs': echecs,
+            'taux_echec': round(echecs / nb * 100, 1) if nb else 0.0,
+            'duree_ms': _centiles([m.duree_ms for m in lignes]),
+            'transfert_ms': _centiles([m.transfert_ms for m in lignes]),
+            'ouverture_ms': _centiles(ouvertures),
+            'attente_ms': _centiles([m.attente_ms for m in lignes]),
+            'taille_moyenne': round(float(np.mean([m.taille for m in lignes if m.taille])), 0)
+            if any(m.taille for m in lignes) else None,
+        }
+    
+    par_serveur = {}
+    par_jour = {}
+    codes = {}
+    for m in mesures:
+        par_serveur.setdefault((m.serveur, m.type_envoi), []).append(m)
+        par_jour.setdefault(m.date_envoi.date(), []).append(m)
+        if m.code_smtp is not None:
+            codes[m.code_smtp] = codes.get(m.code_smtp, 0) + 1
+    
+    return {
+        'global': resumer(mesures),
+        'par_serveur': [
+            dict(resumer(lignes), serveur=serveur, type_envoi=type_envoi)
+            for (serveur, type_envoi), lignes in sorted(par_serveur.items(), key=lambda e: (e[0][0] or '', e[0][1]))
+        ],
+        'par_jour': [dict(resumer(lignes), jour=jour) for jour, lignes in sorted(par_jour.items())],
+        'codes': dict(sorted(codes.items())),
+        'echecs_recents': [
+            {'date_envoi': m.date_envoi, 'serveur': m.serveur, 'type_envoi': m.type_envoi,
+             'tentative': m.tentative, 'code_smtp': m.code_smtp, 'erreur': m.erreur}
+            for m in mesures if not m.succes
+        ][-10:],
+    }
+
+
 # ==================== STATISTIQUES ====================
 
 def get_statistiques():
@@ -628,7 +1822,6 @@ def get_statistiques():
         stats = {
             'nb_appartements': session.query(Appartement).count(),
             'nb_chambres': session.query(Chambre).count(),
-            'nb_chambres_disponibles': session.query(Chambre).filter(Chambre.disponible == True).count(),
             'nb_locataires_actifs': session.query(Locataire).filter(Locataire.actif == True).count(),
             'nb_paiements_impayés': session.query(Paiement).filter(Paiement.statut == 'impaye').count(),
             'nb_factures_impayées': session.query(Facture).filter(Facture.statut == 'impaye').count(),
@@ -648,13 +1841,21 @@ def get_statistiques():
         
         stats['revenus_mois_actuel'] = sum([p.montant for p in paiements_mois])
         
-        # Montant total des loyers attendus ce mois
-        chambres_occupees = session.query(Chambre).filter(Chambre.disponible == False).all()
+        # Occupation du mois en cours, déduite des dates de bail plutôt que du drapeau disponible
+        aujourd_hui = date.today()
+        occupation = get_occupation_mensuelle(aujourd_hui, aujourd_hui)
+        ids_occupees = occupation['chambre_ids'][occupation['matrice'][:, 0]].tolist() if stats['nb_chambres'] > 0 else []
+        nb_chambres_occupees = len(ids_occupees)
+        
+        # Montant total des loyers attendus ce mois, sur les mêmes chambres occupées
+        chambres_occupees = session.query(Chambre).filter(Chambre.id.in_(ids_occupees)).all() if ids_occupees else []
         stats['loyers_attendus'] = sum([c.loyer + c.charges for c in chambres_occupees])
         
+        stats['nb_chambres_disponibles'] = stats['nb_chambres'] - nb_chambres_occupees
+        
         # Taux d'occupation
         if stats['nb_chambres'] > 0:
-            stats['taux_occupation'] = ((stats['nb_chambres'] - stats['nb_chambres_disponibles']) / stats['nb_chambres']) * 100
+            stats['taux_occupation'] = (nb_chambres_occupees / stats['nb_chambres']) * 100
         else:
             stats['taux_occupation'] = 0
         
@@ -663,8 +1864,180 @@ def get_statistiques():
         session.close()
 
 
+def _index_mois(d):
+    """Numéro de mois absolu (année * 12 + mois - 1) d'une date"""
+    return d.year * 12 + d.month - 1
+
+
+def get_occupation_mensuelle(date_debut, date_fin, chambre_ids=None):
+    """
+    Matrice d'occupation chambres × mois déduite des dates de bail.
+    
+    Une chambre est occupée un mois donné si au moins un bail couvre une partie
+    de ce mois. Un bail sans date de fin court jusqu'à la fin de la période s'il
+    est actif ; un bail inactif sans date de fin est ignoré. La couverture est
+    calculée avec NumPy par différences cumulées, sans boucle sur les mois.
+    
+    Args:
+        date_debut: Date incluse dans le premier mois de la période
+        date_fin: Date incluse dans le dernier mois de la période
+        chambre_ids: Liste de chambres à considérer (toutes par défaut)
+    
+    Returns:
+        dict avec 'chambre_ids' (ndarray), 'mois' (liste de (annee, mois)) et
+        'matrice' (ndarray booléen de forme (nb_chambres, nb_mois))
+    """
+    debut = _index_mois(date_debut)
+    nb_mois = max(_index_mois(date_fin) - debut + 1, 0)
+    mois = [((debut + i) // 12, (debut + i) % 12 + 1) for i in range(nb_mois)]
+    
+    session = get_session()
+    try:
+        query_chambres = session.query(Chambre.id).order_by(Chambre.id)
+        if chambre_ids is not None:
+            query_chambres = query_chambres.filter(Chambre.id.in_(chambre_ids))
+        ids = np.array([row[0] for row in query_chambres.all()], dtype=np.int64)
+        
+        premier_jour = date(mois[0][0], mois[0][1], 1) if mois else date_debut
+        dernier_mois_suivant = _index_mois(date_fin) + 1
+        limite = date(dernier_mois_suivant // 12, dernier_mois_suivant % 12 + 1, 1)
+        
+        query_bails = session.query(Bail.chambre_id, Bail.date_debut, Bail.date_fin).filter(
+            Bail.date_debut < limite,
+            or_(Bail.date_fin >= premier_jour, and_(Bail.date_fin == None, Bail.actif == True))
+        )
+        if chambre_ids is not None:
+            query_bails = query_bails.filter(Bail.chambre_id.in_(chambre_ids))
+        bails = query_bails.all()
+    finally:
+        session.close()
+    
+    matrice = np.zeros((len(ids), nb_mois), dtype=bool)
+    if not bails or len(ids) == 0 or nb_mois == 0:
+        return {'chambre_ids': ids, 'mois': mois, 'matrice': matrice}
+    
+    chambres_bail = np.array([b[0] for b in bails], dtype=np.int64)
+    debuts = np.array([_index_mois(b[1]) for b in bails], dtype=np.int64) - debut
+    fins = np.array([_index_mois(b[2]) if b[2] else debut + nb_mois for b in bails], dtype=np.int64) - debut + 1
+    
+    lignes = np.searchsorted(ids, chambres_bail)
+    connues = (lignes < len(ids)) & (ids[np.minimum(lignes, len(ids) - 1)] == chambres_bail)
+    lignes, debuts, fins = lignes[connues], debuts[connues], fins[connues]
+    
+    # +1 au premier mois couvert, -1 après le dernier ; la somme cumulée donne le nombre de baux actifs
+    differences = np.zeros((len(ids), nb_mois + 1), dtype=np.int32)
+    np.add.at(differences, (lignes, np.clip(debuts, 0, nb_mois)), 1)
+    np.add.at(differences, (lignes, np.clip(fins, 0, nb_mois)), -1)
+    matrice = np.cumsum(differences[:, :-1], axis=1) > 0
+    
+    return {'chambre_ids': ids, 'mois': mois, 'matrice': matrice}
+
+
+def get_taux_occupation(date_debut, date_fin, chambre_ids=None):
+    """
+    Taux d'occupation (en %) sur une période : mois-chambres occupés / mois-chambres totaux
+    
+    Returns:
+        dict avec 'taux' (global) et 'par_mois' (liste de ((annee, mois), taux))
+    """
+    occupation = get_occupation_mensuelle(date_debut, date_fin, chambre_ids)
+    matrice = occupation['matrice']
+    if matrice.size == 0:
+        return {'taux': 0.0, 'par_mois': [(m, 0.0) for m in occupation['mois']]}
+    par_mois = matrice.mean(axis=0) * 100
+    return {
+        'taux': float(matrice.mean() * 100),
+        'par_mois': list(zip(occupation['mois'], par_mois.tolist())),
+    }
+
+
+# Tranches d'ancienneté des impayés : (clé, libellé, borne basse, borne haute) en jours
+TRANCHES_ANCIENNETE = [
+    ('j_0_30', '0-30 jours', 0, 30),
+    ('j_31_60', '31-60 jours', 31, 60),
+    ('j_61_90', '61-90 jours', 61, 90),
+    ('j_90_plus', '90+ jours', 91, None),
+]
+
+
+def get_anciennete_impayes(date_reference=None):
+    """
+    Balance âgée des loyers impayés et partiels, par locataire et par appartement.
+    
+    L'ancienneté est le nombre de jours entre le 1er du mois du paiement et la
+    date de référence ; la répartition par tranche est faite par SQLite en une
+    seule requête groupée. Les périodes futures ne sont pas comptées.
+    
+    Args:
+        date_reference: Date de calcul (aujourd'hui par défaut)
+    
+    Returns:
+        dict avec 'lignes' (par locataire et appartement), 'par_appartement' et 'totaux'
+    """
+    date_reference = date_reference or date.today()
+    session = get_session()
+    try:
+        echeance = func.printf('%04d-%02d-01', Paiement.annee, Paiement.mois)
+        jours = func.julianday(date_reference.isoformat()) - func.julianday(echeance)
+        
+        colonnes_tranches = []
+        for cle, _, borne_basse, borne_haute in TRANCHES_ANCIENNETE:
+            condition = jours >= borne_basse if borne_haute is None else and_(jours >= borne_basse, jours < borne_haute + 1)
+            colonnes_tranches.append(func.sum(case((condition, Paiement.montant), else_=0.0)).label(cle))
+        
+        resultats = session.query(
+            Locataire.id.label('locataire_id'),
+            Locataire.nom.label('locataire'),
+            Appartement.id.label('appartement_id'),
+            Appartement.adresse.label('adresse'),
+            Appartement.ville.label('ville'),
+            *colonnes_tranches,
+            func.sum(Paiement.montant).label('total'),
+            func.count(Paiement.id).label('nb_paiements'),
+        ).join(
+            Locataire, Paiement.locataire_id == Locataire.id
+        ).join(
+            Chambre, Paiement.chambre_id == Chambre.id
+        ).join(
+            Appartement, Chambre.appartement_id == Appartement.id
+        ).filter(
+            Paiement.statut.in_(['impaye', 'partiel']),
+            jours >= 0
+        ).group_by(
+            Locataire.id, Appartement.id
+        ).order_by(
+            func.sum(Paiement.montant).desc()
+        ).all()
+        
+        lignes = [dict(r._mapping) for r in resultats]
+        cles = [t[0] for t in TRANCHES_ANCIENNETE] + ['total', 'nb_paiements']
+        
+        # Les agrégats ci-dessous portent sur les lignes déjà groupées, pas sur les paiements
+        par_appartement = {}
+        for ligne in lignes:
+            appt = par_appartement.setdefault(ligne['appartement_id'], {
+                'appartement_id': ligne['appartement_id'],
+                'adresse': ligne['adresse'],
+                'ville': ligne['ville'],
+                **{cle: 0 for cle in cles}
+            })
+            for cle in cles:
+                appt[cle] += ligne[cle]
+        
+        totaux = {cle: sum(ligne[cle] for ligne in lignes) for cle in cles}
+        
+        return {
+            'lignes': lignes,
+            'par_appartement': list(par_appartement.values()),
+            'totaux': totaux,
+        }
+    finally:
+        session.close()
+
+
 # ==================== HISTORIQUE DES LOYERS ====================
 
+@write_operation
 def create_historique_loyer(bail_id, ancien_loyer, nouveau_loyer, anciennes_charges, nouvelles_charges, date_application, notes=""):
     """Crée un historique de changement de loyer"""
     session = get_session()
@@ -700,6 +2073,7 @@ def get_historique_by_bail(bail_id):
         session.close()
 
 
+@write_operation
 def update_bail_loyer(bail_id, nouveau_loyer, nouvelles_charges, date_application, notes=""):
     """
     Met à jour le loyer d'un bail et crée un historique.
@@ -3,13 +3,21 @@ Module d'envoi d'alertes email pour les loyers impayés
 """
 
 import smtplib
+from contextlib import contextmanager
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from email.mime.base import MIMEBase
-from email import encoders
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import lru_cache
+import atexit
+import base64
+import hashlib
+import json
 import os
+import threading
+import time
 from dotenv import load_dotenv
+from jinja2 import ChoiceLoader, Environment, FileSystemBytecodeCache, FileSystemLoader, select_autoescape
 
 # Charger les variables d'environnement
 load_dotenv()
@@ -22,7 +30,9 @@ def get_email_config():
         'password': os.getenv('SMTP_PASSWORD', ''),
         'smtp_server': os.getenv('SMTP_SERVER', 'smtp.gmail.com'),
         'smtp_port': int(os.getenv('SMTP_PORT', '587')),
-        'from_name': os.getenv('SMTP_FROM_NAME', 'Gestion Locative')
+        'from_name': os.getenv('SMTP_FROM_NAME', 'Gestion Locative'),
+        # STARTTLS désactivable pour un serveur local sans chiffrement (smtp_sink.py)
+        'starttls': os.getenv('SMTP_STARTTLS', '1').lower() not in ('0', 'false', 'non')
     }
 
 
@@ -32,15 +42,536 @@ def verifier_config_email():
     return bool(config['sender'] and config['password'])
 
 
-def envoyer_alerte_loyer_impaye(locataire, paiement, chambre, appartement):
+# ==================== POOL DE CONNEXIONS SMTP ====================
+
+# Connexions authentifiées gardées ouvertes par serveur / compte
+SMTP_POOL_TAILLE = int(os.getenv('SMTP_POOL_TAILLE', '4'))
+# Inactivité (secondes) au-delà de laquelle une connexion est vérifiée par NOOP avant usage
+SMTP_NOOP_APRES = float(os.getenv('SMTP_NOOP_APRES', '15'))
+# Durée de vie maximale d'une connexion (secondes), les serveurs coupant les sessions longues
+SMTP_DUREE_MAX = float(os.getenv('SMTP_DUREE_MAX', '300'))
+SMTP_TIMEOUT = float(os.getenv('SMTP_TIMEOUT', '30'))
+# Débit maximal par serveur SMTP (emails par seconde, 0 = illimité) et rafale autorisée
+SMTP_DEBIT_MAX = float(os.getenv('SMTP_DEBIT_MAX', '2'))
+SMTP_RAFALE = int(os.getenv('SMTP_RAFALE', '10'))
+
+
+class LimiteurDebit:
+    """
+    Seau à jetons : au plus `capacite` envois d'affilée, puis `debit` envois par seconde.
+    
+    Partagé par tous les threads qui envoient vers le même fournisseur, pour
+    rester sous les limites d'envoi qu'il impose.
+    """
+    
+    def __init__(self, debit, capacite):
+        self.debit = debit
+        self.capacite = max(1, capacite)
+        self._jetons = float(self.capacite)
+        self._mis_a_jour = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def acquerir(self):
+        """Attend qu'un jeton soit disponible et le consomme"""
+        if self.debit <= 0:
+            return
+        while True:
+            with self._lock:
+                maintenant = time.monotonic()
+                self._jetons = min(self.capacite, self._jetons + (maintenant - self._mis_a_jour) * self.debit)
+                self._mis_a_jour = maintenant
+                if self._jetons >= 1:
+                    self._jetons -= 1
+                    return
+                attente = (1 - self._jetons) / self.debit
+            time.sleep(attente)
+
+
+class EnvoiIncertain(smtplib.SMTPException):
+    """
+    La connexion a été perdue après la transmission du message, avant la
+    réponse du serveur : le message a peut-être été accepté. Il n'est pas
+    renvoyé automatiquement, pour ne pas risquer un doublon.
+    """
+
+
+class _SessionSMTP(smtplib.SMTP):
+    """
+    Session SMTP qui note si le contenu d'un message a commencé à être
+    transmis, sa taille et la réponse du serveur
+    """
+    
+    donnees_transmises = False
+    taille_donnees = None
+    dernier_code = None
+    # Durées d'ouverture (connexion, TLS, login), rapportées par le premier envoi de la session
+    durees_ouverture = None
+    
+    def data(self, msg):
+        self.donnees_transmises = True
+        self.taille_donnees = len(msg)
+        code, reponse = super().data(msg)
+        self.dernier_code = code
+        return code, reponse
+
+
+class PoolSMTP:
+    """
+    Pool de sessions SMTP authentifiées, partagé par tous les envois.
+    
+    Une session n'est ouverte (connexion, STARTTLS, login) que si aucune
+    session libre n'est disponible. Une session restée inactive est vérifiée
+    par NOOP avant d'être réutilisée, et une session coupée par le serveur est
+    remplacée sans que l'appelant ne le voie. Au plus `taille` sessions sont
+    ouvertes en même temps : les envois suivants attendent qu'une se libère.
+    """
+    
+    def __init__(self, config, taille=SMTP_POOL_TAILLE, limiteur=None):
+        self.config = config
+        self.taille = taille
+        self.limiteur = limiteur
+        self._libres = []  # (serveur, ouverte_a, utilisee_a)
+        self._lock = threading.Lock()
+        self._places = threading.BoundedSemaphore(taille)
+    
+    def _ouvrir(self):
+        debut = time.perf_counter()
+        serveur = _SessionSMTP(self.config['smtp_server'], self.config['smtp_port'], timeout=SMTP_TIMEOUT)
+        durees = {'connexion_ms': (time.perf_counter() - debut) * 1000}
+        try:
+            if self.config.get('starttls', True):
+                debut = time.perf_counter()
+                serveur.starttls()
+                durees['tls_ms'] = (time.perf_counter() - debut) * 1000
+            debut = time.perf_counter()
+            serveur.login(self.config['sender'], self.config['password'])
+            durees['auth_ms'] = (time.perf_counter() - debut) * 1000
+        except Exception:
+            _fermer_session(serveur)
+            raise
+        serveur.durees_ouverture = durees
+        return serveur
+    
+    def _prendre(self):
+        """Retourne une session utilisable : libre et vérifiée, ou nouvelle"""
+        while True:
+            with self._lock:
+                if not self._libres:
+                    break
+                serveur, ouverte_a, utilisee_a = self._libres.pop()
+            maintenant = time.monotonic()
+            if maintenant - ouverte_a > SMTP_DUREE_MAX:
+                _fermer_session(serveur)
+                continue
+            if maintenant - utilisee_a < SMTP_NOOP_APRES or _session_vivante(serveur):
+                return serveur, ouverte_a
+            _fermer_session(serveur)
+        return self._ouvrir(), time.monotonic()
+    
+    @contextmanager
+    def session(self):
+        """
+        Emprunte une session SMTP authentifiée
+        
+        La session est rendue au pool à la sortie du bloc, sauf si la
+        connexion a été perdue (elle est alors fermée).
+        """
+        self._places.acquire()
+        try:
+            serveur, ouverte_a = self._prendre()
+            try:
+                yield serveur
+            except (smtplib.SMTPResponseException, smtplib.SMTPRecipientsRefused) as e:
+                # Le serveur a refusé ce message mais la session reste valable (sauf 421 : fermeture)
+                if getattr(e, 'smtp_code', None) == 421:
+                    _fermer_session(serveur)
+                else:
+                    self._rendre(serveur, ouverte_a)
+                raise
+            except BaseException:
+                # Connexion perdue ou état inconnu : la session n'est pas réutilisée
+                _fermer_session(serveur)
+                raise
+            else:
+                self._rendre(serveur, ouverte_a)
+        finally:
+            self._places.release()
+    
+    def _rendre(self, serveur, ouverte_a):
+        with self._lock:
+            self._libres.append((serveur, ouverte_a, time.monotonic()))
+    
+    def envoyer(self, message, mesure=None):
+        """
+        Envoie un message sur une session du pool
+        
+        Si le serveur a coupé la session avant que le message ne soit
+        transmis, il est renvoyé une fois sur une session neuve. Si la coupure
+        survient après la transmission, EnvoiIncertain est levée.
+        
+        Args:
+            message: Message à envoyer
+            mesure: dict complété, même en cas d'erreur, par les durées (ms)
+                    d'attente, d'ouverture de session et de transfert, la
+                    taille transmise et le code de réponse du serveur
+        """
+        mesure = {} if mesure is None else mesure
+        if self.limiteur is not None:
+            debut = time.perf_counter()
+            self.limiteur.acquerir()
+            mesure['attente_ms'] = (time.perf_counter() - debut) * 1000
+        for tentative in range(2):
+            serveur = None
+            try:
+                with self.session() as serveur:
+                    serveur.donnees_transmises = False
+                    serveur.taille_donnees = serveur.dernier_code = None
+                    mesure['session_reutilisee'] = serveur.durees_ouverture is None
+                    mesure.update(serveur.durees_ouverture or {})
+                    serveur.durees_ouverture = None
+                    debut = time.perf_counter()
+                    try:
+                        return serveur.send_message(message)
+                    finally:
+                        mesure['transfert_ms'] = (time.perf_counter() - debut) * 1000
+                        mesure['taille'] = serveur.taille_donnees
+                        mesure['code_smtp'] = serveur.dernier_code
+            except smtplib.SMTPServerDisconnected as e:
+                if serveur is not None and serveur.donnees_transmises:
+                    raise EnvoiIncertain(f"Connexion perdue pendant l'envoi, message peut-être reçu : {e}") from e
+                if tentative == 1:
+                    raise
+    
+    def fermer(self):
+        """Ferme toutes les sessions libres"""
+        with self._lock:
+            libres, self._libres = self._libres, []
+        for serveur, _, _ in libres:
+            _fermer_session(serveur)
+
+
+def _session_vivante(serveur):
+    """Vérifie par NOOP qu'une session est toujours ouverte côté serveur"""
+    try:
+        return serveur.noop()[0] == 250
+    except (smtplib.SMTPException, OSError):
+        return False
+
+
+def _fermer_session(serveur):
+    try:
+        serveur.quit()
+    except (smtplib.SMTPException, OSError):
+        serveur.close()
+
+
+_pools = {}
+_limiteurs = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool_smtp(config=None):
+    """
+    Retourne le pool SMTP partagé pour une configuration (un pool par serveur et compte)
+    
+    Args:
+        config: Configuration email (get_email_config() par défaut)
+    """
+    config = config or get_email_config()
+    cle = (config['smtp_server'], config['smtp_port'], config['sender'], config['password'],
+           config.get('starttls', True))
+    with _pools_lock:
+        if cle not in _pools:
+            # Un seul seau à jetons par fournisseur, partagé entre les comptes
+            if config['smtp_server'] not in _limiteurs:
+                _limiteurs[config['smtp_server']] = LimiteurDebit(SMTP_DEBIT_MAX, SMTP_RAFALE)
+            _pools[cle] = PoolSMTP(config, limiteur=_limiteurs[config['smtp_server']])
+        return _pools[cle]
+
+
+@atexit.register
+def fermer_pools_smtp():
+    """Ferme les sessions SMTP ouvertes (appelé à la sortie du processus)"""
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.fermer()
+
+
+# ==================== MESURES DES ENVOIS ====================
+
+# Les mesures sont écrites par lots, pour ne pas ajouter une transaction à chaque envoi
+MESURES_LOT = 50
+MESURES_DELAI = 5.0  # secondes au plus entre deux écritures, tant que des envois ont lieu
+
+_mesures = []
+_mesures_lock = threading.Lock()
+_mesures_videes_a = time.monotonic()
+
+
+def _code_smtp(exc):
+    """Code de réponse SMTP porté par une exception (premier destinataire refusé le cas échéant)"""
+    if isinstance(exc, smtplib.SMTPRecipientsRefused) and exc.recipients:
+        return next(iter(exc.recipients.values()))[0]
+    return getattr(exc, 'smtp_code', None)
+
+
+def _envoyer_mesure(config, message, type_envoi, outbox_id=None, paiement_id=None, tentative=1):
+    """
+    Envoie un message sur le pool partagé en notant les mesures de la tentative
+    (durées, taille, code de réponse, erreur)
+    """
+    mesure = {}
+    date_envoi = datetime.now()
+    debut = time.perf_counter()
+    erreur = None
+    try:
+        return get_pool_smtp(config).envoyer(message, mesure)
+    except Exception as e:
+        erreur = e
+        raise
+    finally:
+        mesure.update(
+            type_envoi=type_envoi, outbox_id=outbox_id, paiement_id=paiement_id, tentative=tentative,
+            serveur=config['smtp_server'], date_envoi=date_envoi, succes=erreur is None,
+            duree_ms=(time.perf_counter() - debut) * 1000,
+            erreur=(str(erreur) or type(erreur).__name__)[:500] if erreur is not None else None,
+        )
+        if erreur is not None and mesure.get('code_smtp') is None:
+            mesure['code_smtp'] = _code_smtp(erreur)
+        _noter_mesure(mesure)
+
+
+def _noter_mesure(mesure):
+    with _mesures_lock:
+        _mesures.append(mesure)
+        a_ecrire = len(_mesures) >= MESURES_LOT or time.monotonic() - _mesures_videes_a >= MESURES_DELAI
+    if a_ecrire:
+        vider_mesures_envoi()
+
+
+@atexit.register
+def vider_mesures_envoi():
+    """Écrit en base les mesures d'envoi en attente"""
+    global _mesures_videes_a
+    from .database import enregistrer_mesures_envoi
+    
+    with _mesures_lock:
+        lot = _mesures[:]
+        _mesures.clear()
+        _mesures_videes_a = time.monotonic()
+    if not lot:
+        return 0
+    try:
+        return enregistrer_mesures_envoi(lot)
+    except Exception as e:
+        # Les mesures ne doivent jamais faire échouer un envoi
+        print(f"⚠️ Mesures d'envoi non enregistrées : {e}")
+        return 0
+
+
+# ==================== MODÈLES D'EMAILS ====================
+
+# Modèles fournis avec l'application ; un dossier LOCATOR_EMAIL_TEMPLATES peut
+# en remplacer tout ou partie (fichiers de même nom)
+EMAIL_TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'emails')
+
+MOIS_NOMS = ["Janvier", "Février", "Mars", "Avril", "Mai", "Juin",
+             "Juillet", "Août", "Septembre", "Octobre", "Novembre", "Décembre"]
+
+
+def _periode(mois, annee):
+    return f"{MOIS_NOMS[mois - 1] if 1 <= mois <= 12 else mois} {annee}"
+
+
+@lru_cache(maxsize=None)
+def _environnement_emails(dossier_personnalise):
+    """
+    Environnement Jinja2 des emails, créé une fois par processus et par dossier
+    
+    Les modèles compilés restent en mémoire (auto_reload désactivé) et leur
+    bytecode est mis en cache sur disque pour les processus suivants.
+    """
+    dossiers = [dossier_personnalise, EMAIL_TEMPLATE_DIR] if dossier_personnalise else [EMAIL_TEMPLATE_DIR]
+    environnement = Environment(
+        loader=ChoiceLoader([FileSystemLoader(dossier) for dossier in dossiers]),
+        autoescape=select_autoescape(['html']),
+        bytecode_cache=FileSystemBytecodeCache(),
+        auto_reload=False,
+        trim_blocks=True,
+        lstrip_blocks=True,
+        keep_trailing_newline=True,
+    )
+    environnement.filters['euros'] = lambda montant: f"{montant:.2f} €"
+    return environnement
+
+
+def get_environnement_emails():
+    """Environnement Jinja2 des emails (dossier LOCATOR_EMAIL_TEMPLATES prioritaire s'il est défini)"""
+    return _environnement_emails(os.getenv('LOCATOR_EMAIL_TEMPLATES') or None)
+
+
+def rendre_email(nom, **contexte):
+    """
+    Rend les versions texte et HTML d'un modèle d'email
+    
+    Le sujet est défini dans le modèle texte ({% set sujet = ... %}).
+    
+    Args:
+        nom: Nom du modèle ('alerte', 'quittance', 'recapitulatif')
+        **contexte: Variables passées aux modèles
+    
+    Returns:
+        tuple (sujet, texte, html)
+    """
+    environnement = get_environnement_emails()
+    module = environnement.get_template(f"{nom}.txt").make_module(contexte)
+    sujet = getattr(module, 'sujet', '')
+    html = environnement.get_template(f"{nom}.html").render(contexte, sujet=sujet)
+    return sujet, str(module).lstrip('\n'), html
+
+
+def _assembler_message(config, destinataire, sujet, texte, html, pieces_jointes=()):
+    """
+    Message multipart/alternative (texte et HTML), dans un multipart/mixed
+    s'il y a des pièces jointes
+    """
+    corps = MIMEMultipart('alternative')
+    corps.attach(MIMEText(texte, 'plain', 'utf-8'))
+    corps.attach(MIMEText(html, 'html', 'utf-8'))
+    
+    if pieces_jointes:
+        message = MIMEMultipart('mixed')
+        message.attach(corps)
+        for piece_jointe in pieces_jointes:
+            message.attach(piece_jointe)
+    else:
+        message = corps
+    
+    message['From'] = f"{config['from_name']} <{config['sender']}>"
+    message['To'] = destinataire
+    message['Subject'] = sujet
+    return message
+
+
+# ==================== IDEMPOTENCE DES ENVOIS ====================
+
+def cle_envoi(type_envoi, paiement_id, periode, *contenu):
+    """
+    Clé d'idempotence d'un envoi : type, paiement, période et empreinte du contenu
+    
+    Deux demandes d'envoi du même contenu (double clic, relance de la page
+    Streamlit, nouvelle tentative) ont la même clé ; la file d'envoi n'accepte
+    qu'un envoi par clé (index unique).
+    """
+    empreinte = hashlib.sha256("\x1f".join(str(element) for element in contenu).encode('utf-8')).hexdigest()
+    return f"{type_envoi}:{'-' if paiement_id is None else paiement_id}:{periode}:{empreinte[:16]}"
+
+
+def cle_quittance(paiement, chemin_quittance):
+    """Clé de l'envoi d'une quittance : une nouvelle version du fichier peut être renvoyée"""
+    return cle_envoi('quittance', paiement.id, f"{paiement.annee:04d}-{paiement.mois:02d}",
+                     _empreinte_fichier(chemin_quittance))
+
+
+def cle_alerte(paiement, date_reference=None):
+    """Clé d'une alerte d'impayé : au plus une par paiement et par mois de relance"""
+    date_reference = date_reference or datetime.now()
+    return cle_envoi('alerte', paiement.id, f"{date_reference.year:04d}-{date_reference.month:02d}",
+                     paiement.mois, paiement.annee, f"{paiement.montant:.2f}")
+
+
+def _empreinte_fichier(chemin):
+    etat = os.stat(chemin)
+    return _sha256_fichier(chemin, etat.st_mtime_ns, etat.st_size)
+
+
+@lru_cache(maxsize=1024)
+def _sha256_fichier(chemin, mtime_ns, taille):
+    sha = hashlib.sha256()
+    with open(chemin, 'rb') as f:
+        for bloc in iter(lambda: f.read(65536), b''):
+            sha.update(bloc)
+    return sha.hexdigest()
+
+
+def _message_id(type_envoi, outbox_id, config):
+    # Même Message-ID à chaque tentative : les doublons éventuels sont reconnaissables
+    domaine = config['sender'].rpartition('@')[2] or 'locator'
+    return f"<locator.{type_envoi}.{outbox_id}@{domaine}>"
+
+
+# Réponses de _envoyer_une_fois quand rien n'a été transmis
+DEJA_ENVOYE = "Email déjà envoyé"
+DEJA_EN_COURS = "Email déjà en cours d'envoi"
+
+
+def _envoyer_une_fois(cle, type_envoi, locataire_id, paiement_id, construire, config, payload=None, suivi=False):
+    """
+    Envoie aussitôt un email, au plus une fois par clé d'idempotence
+    
+    L'envoi est d'abord réservé dans la file (reserver_envoi) : si la même clé
+    a déjà été envoyée ou est en cours d'envoi ailleurs, rien n'est construit
+    ni transmis. Les erreurs d'envoi sont enregistrées puis propagées.
+    
+    Args:
+        construire: Fonction sans argument retournant le message à envoyer
+        suivi: Voir terminer_email
+    
+    Returns:
+        tuple (success: bool, message: str) : message vaut DEJA_ENVOYE ou
+        DEJA_EN_COURS si rien n'a été transmis
+    """
+    from .database import get_statut_envoi, reserver_envoi, terminer_email
+    
+    # Cas le plus fréquent d'une demande répétée : simple lecture, sans transaction d'écriture
+    if get_statut_envoi(cle) == 'envoye':
+        return True, DEJA_ENVOYE
+    
+    outbox_id, statut, tentative, jeton = reserver_envoi(cle, type_envoi, locataire_id, paiement_id, payload)
+    if outbox_id is None:
+        return True, DEJA_ENVOYE if statut == 'envoye' else DEJA_EN_COURS
+    
+    try:
+        message = construire()
+        message['Message-ID'] = _message_id(type_envoi, outbox_id, config)
+        _envoyer_mesure(config, message, type_envoi, outbox_id, paiement_id, tentative)
+    except Exception as e:
+        terminer_email(outbox_id, str(e) or type(e).__name__, definitif=True, suivi=suivi, jeton=jeton)
+        raise
+    terminer_email(outbox_id, suivi=suivi, jeton=jeton)
+    return True, "Email envoyé avec succès"
+
+
+def construire_message_alerte(locataire, paiement, chambre, appartement, config=None):
+    """
+    Construit l'email d'alerte de loyer impayé sans l'envoyer
+    
+    Returns:
+        MIMEMultipart prêt à être envoyé
+    """
+    if config is None:
+        config = get_email_config()
+    
+    sujet, texte, html = rendre_email(
+        'alerte', locataire=locataire, paiement=paiement, chambre=chambre, appartement=appartement,
+        periode=_periode(paiement.mois, paiement.annee), signature=config['from_name']
+    )
+    return _assembler_message(config, locataire.email, sujet, texte, html)
+
+
+def envoyer_alerte_loyer_impaye(locataire, paiement, chambre, appartement, date_reference=None):
     """
     Envoie un email d'alerte pour un loyer impayé
     
+    Une même alerte (même paiement, même mois de relance) n'est envoyée qu'une fois.
+    
     Args:
         locataire: Objet Locataire
         paiement: Objet Paiement
         chambre: Objet Chambre
         appartement: Objet Appartement
+        date_reference: Date de la relance (aujourd'hui par défaut)
     
     Returns:
         tuple (success: bool, error_message: str)
@@ -54,73 +585,53 @@ def envoyer_alerte_loyer_impaye(locataire, paiement, chambre, appartement):
         return False, "Configuration email incomplète"
     
     try:
-        # Noms des mois
-        mois_noms = [
-            "Janvier", "Février", "Mars", "Avril", "Mai", "Juin",
-            "Juillet", "Août", "Septembre", "Octobre", "Novembre", "Décembre"
-        ]
-        mois_nom = mois_noms[paiement.mois - 1] if 1 <= paiement.mois <= 12 else str(paiement.mois)
-        
-        # Créer le message
-        message = MIMEMultipart()
-        message['From'] = config['sender']
-        message['To'] = locataire.email
-        message['Subject'] = f'Rappel - Loyer impayé pour {mois_nom} {paiement.annee}'
-        
-        # Corps du message
-        body = f"""
-Bonjour {locataire.nom},
-
-Nous vous informons que le loyer du mois de {mois_nom} {paiement.annee} n'a pas encore été réglé.
-
-Détails :
-- Appartement : {appartement.adresse}, {appartement.code_postal} {appartement.ville}
-- Chambre : {chambre.numero}
-- Montant dû : {paiement.montant:.2f} €
-- Période : {mois_nom} {paiement.annee}
-
-Nous vous remercions de bien vouloir régulariser votre situation dans les plus brefs délais.
-
-Cordialement,
-
-[Votre nom]
-        """
-        
-        message.attach(MIMEText(body, 'plain'))
-        
-        # Connexion au serveur SMTP
-        server = smtplib.SMTP(config['smtp_server'], config['smtp_port'])
-        server.starttls()
-        server.login(config['sender'], config['password'])
-        
-        # Envoi du message
-        server.send_message(message)
-        server.quit()
-        
-        return True, "Email envoyé avec succès"
+        # Envoi sur une session SMTP partagée ; l'appelant enregistre l'alerte
+        return _envoyer_une_fois(
+            cle_alerte(paiement, date_reference), 'alerte', locataire.id, paiement.id,
+            lambda: construire_message_alerte(locataire, paiement, chambre, appartement, config), config
+        )
     
     except Exception as e:
         return False, str(e)
 
 
-def verifier_et_envoyer_alertes(session):
+def verifier_et_envoyer_alertes(session, en_file=False, date_reference=None, recapitulatif=False,
+                                joindre_quittances=False):
     """
     Vérifie tous les paiements impayés et envoie des alertes si nécessaire
     À exécuter quotidiennement à partir du 8 du mois
     
+    Les paiements à relancer (impayés jusqu'au mois en cours, sans alerte ce
+    mois-ci) sont sélectionnés en une seule requête avec leur locataire, leur
+    chambre et leur appartement.
+    
     Args:
         session: Session de base de données
+        en_file: Mettre les alertes dans la file d'envoi au lieu de les envoyer
+                 (l'alerte est enregistrée par le worker une fois envoyée)
+        date_reference: Date du passage (aujourd'hui par défaut)
+        recapitulatif: Un seul email par locataire regroupant tous ses impayés
+                       (voir envoyer_recapitulatifs), envoyé directement :
+                       incompatible avec en_file
+        joindre_quittances: Avec recapitulatif, joindre aussi les quittances
+                            du mois générées mais pas encore envoyées
     
     Returns:
         dict avec les statistiques d'envoi
+    
+    Raises:
+        ValueError: si recapitulatif et en_file sont demandés ensemble
     """
-    from .database import get_paiements_impayés, get_locataire_by_id, get_chambre_by_id
-    from .models import Appartement, AlerteEmail
+    from .database import get_paiements_a_relancer, get_paiements_a_quittancer, mettre_emails_en_file, enregistrer_alertes
+    
+    if recapitulatif and en_file:
+        raise ValueError("Le récapitulatif est envoyé directement : il ne peut pas passer par la file d'envoi")
     
     # Vérifier si on est après le 8 du mois
-    jour_actuel = datetime.now().day
-    mois_actuel = datetime.now().month
-    annee_actuelle = datetime.now().year
+    date_reference = date_reference or datetime.now()
+    jour_actuel = date_reference.day
+    mois_actuel = date_reference.month
+    annee_actuelle = date_reference.year
     
     if jour_actuel < 8:
         return {'total': 0, 'envoyes': 0, 'erreurs': 0, 'message': 'Pas encore le 8 du mois'}
@@ -129,49 +640,61 @@ def verifier_et_envoyer_alertes(session):
         'total': 0,
         'envoyes': 0,
         'erreurs': 0,
+        'deja_envoyes': 0,
+        'en_file': 0,
         'details': []
     }
     
-    # Récupérer tous les paiements impayés
-    paiements_impayés = get_paiements_impayés()
+    # Impayés du mois en cours ou précédents, sans alerte depuis le 1er du mois
+    a_relancer = get_paiements_a_relancer(mois_actuel, annee_actuelle, datetime(annee_actuelle, mois_actuel, 1))
+    stats['total'] = len(a_relancer)
     
-    for paiement in paiements_impayés:
-        # Ne traiter que les paiements du mois en cours ou précédents
-        if paiement.annee > annee_actuelle or (paiement.annee == annee_actuelle and paiement.mois > mois_actuel):
-            continue
-        
-        stats['total'] += 1
-        
-        # Vérifier si une alerte a déjà été envoyée ce mois
-        alerte_existe = session.query(AlerteEmail).filter(
-            AlerteEmail.paiement_id == paiement.id,
-            AlerteEmail.date_envoi >= datetime(annee_actuelle, mois_actuel, 1)
-        ).first()
-        
-        if alerte_existe:
-            continue
-        
-        # Récupérer les informations
-        locataire = get_locataire_by_id(paiement.locataire_id)
-        chambre = get_chambre_by_id(paiement.chambre_id)
-        appartement = session.query(Appartement).filter(Appartement.id == chambre.appartement_id).first()
-        
+    if recapitulatif:
+        quittances = []
+        if joindre_quittances:
+            quittances = [
+                lot for lot in get_paiements_a_quittancer(mois_actuel, annee_actuelle, seulement_sans_quittance=False)
+                if not lot[0].quittance_envoyee and lot[0].chemin_quittance
+            ]
+        stats.update(envoyer_recapitulatifs(a_relancer, quittances, date_reference=date_reference))
+        return stats
+    
+    if en_file:
+        mettre_emails_en_file([
+            {'type_envoi': 'alerte', 'locataire_id': locataire.id, 'paiement_id': paiement.id,
+             'cle': cle_alerte(paiement, date_reference)}
+            for paiement, locataire, _, _ in a_relancer
+        ])
+        _reveiller_worker()
+        stats['en_file'] = len(a_relancer)
+        stats['details'] = [
+            {'locataire': locataire.nom, 'success': True, 'message': "Alerte mise en file d'envoi"}
+            for _, locataire, _, _ in a_relancer
+        ]
+        return stats
+    
+    alertes = []
+    for paiement, locataire, chambre, appartement in a_relancer:
         # Envoyer l'alerte
-        success, message = envoyer_alerte_loyer_impaye(locataire, paiement, chambre, appartement)
-        
-        # Enregistrer l'alerte
-        alerte = AlerteEmail(
-            locataire_id=locataire.id,
-            paiement_id=paiement.id,
-            statut='envoye' if success else 'erreur',
-            message_erreur=message if not success else None
-        )
-        session.add(alerte)
+        success, message = envoyer_alerte_loyer_impaye(locataire, paiement, chambre, appartement, date_reference)
         
-        if success:
-            stats['envoyes'] += 1
+        if message in (DEJA_ENVOYE, DEJA_EN_COURS):
+            # Rien n'a été transmis : l'alerte est enregistrée par l'envoi qui l'a faite
+            stats['deja_envoyes'] += 1
         else:
-            stats['erreurs'] += 1
+            # Enregistrer l'alerte
+            alertes.append({
+                'locataire_id': locataire.id,
+                'paiement_id': paiement.id,
+                'date_envoi': datetime.now(),
+                'statut': 'envoye' if success else 'erreur',
+                'message_erreur': message if not success else None
+            })
+            
+            if success:
+                stats['envoyes'] += 1
+            else:
+                stats['erreurs'] += 1
         
         stats['details'].append({
             'locataire': locataire.nom,
@@ -179,11 +702,193 @@ def verifier_et_envoyer_alertes(session):
             'message': message
         })
     
-    session.commit()
+    # Toutes les alertes en une seule insertion
+    enregistrer_alertes(alertes)
+    vider_mesures_envoi()
+    
+    return stats
+
+
+# ==================== RÉCAPITULATIF PAR LOCATAIRE ====================
+
+def construire_message_recapitulatif(locataire, impayes, quittances, config=None, date_reference=None):
+    """
+    Construit un email unique pour un locataire : tableau récapitulatif de ses
+    loyers impayés et de ses quittances, celles-ci en pièces jointes
+    
+    Args:
+        locataire: Objet Locataire
+        impayes: Liste de tuples (paiement, chambre, appartement) à relancer
+        quittances: Liste de tuples (paiement, chambre, appartement, chemin_quittance) à joindre
+        config: Configuration email (get_email_config() par défaut)
+        date_reference: Date du récapitulatif (aujourd'hui par défaut)
+    
+    Returns:
+        MIMEMultipart prêt à être envoyé
+    """
+    if config is None:
+        config = get_email_config()
+    
+    lignes = [(paiement, chambre, "Loyer impayé") for paiement, chambre, _ in impayes]
+    lignes += [(paiement, chambre, "Quittance jointe") for paiement, chambre, _, _ in quittances]
+    lignes.sort(key=lambda ligne: (ligne[0].annee, ligne[0].mois))
+    
+    sujet, texte, html = rendre_email(
+        'recapitulatif', locataire=locataire, signature=config['from_name'],
+        date_reference=date_reference or datetime.now(),
+        lignes=[{'periode': _periode(paiement.mois, paiement.annee), 'logement': chambre.numero,
+                 'montant': paiement.montant, 'objet': objet} for paiement, chambre, objet in lignes],
+        nb_impayes=len(impayes), nb_quittances=len(quittances),
+        total_du=sum(paiement.montant for paiement, _, _ in impayes)
+    )
+    pieces_jointes = [_piece_jointe_quittance(chemin_quittance) for _, _, _, chemin_quittance in quittances]
+    return _assembler_message(config, locataire.email, sujet, texte, html, pieces_jointes)
+
+
+def envoyer_recapitulatifs(impayes, quittances=(), date_reference=None, max_workers=None):
+    """
+    Envoie un seul email par locataire, regroupant ses impayés et ses quittances
+    
+    Un locataire avec plusieurs mois impayés reçoit un message au lieu d'un
+    par paiement. Une alerte AlerteEmail est tout de même enregistrée par
+    paiement relancé (en une seule insertion), et les quittances jointes sont
+    marquées comme envoyées (en une seule mise à jour). Un récapitulatif déjà
+    envoyé ou en cours d'envoi ailleurs n'est ni renvoyé ni réenregistré.
+    
+    Args:
+        impayes: Liste de tuples (paiement, locataire, chambre, appartement) à relancer
+        quittances: Liste de tuples (paiement, locataire, chambre, appartement) dont
+                    la quittance (paiement.chemin_quittance) est à joindre
+        date_reference: Date du récapitulatif (aujourd'hui par défaut)
+        max_workers: Envois simultanés (SMTP_POOL_TAILLE par défaut)
+    
+    Returns:
+        dict avec 'emails', 'envoyes', 'erreurs' et 'deja_envoyes' (en
+        paiements relancés), 'quittances_envoyees' et 'details' (un par locataire)
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from .database import enregistrer_alertes, marquer_quittances_envoyees
+    
+    stats = {'emails': 0, 'envoyes': 0, 'erreurs': 0, 'deja_envoyes': 0, 'quittances_envoyees': 0, 'details': []}
+    config = get_email_config()
+    
+    # Regroupement par locataire
+    par_locataire = {}
+    for paiement, locataire, chambre, appartement in impayes:
+        groupe = par_locataire.setdefault(locataire.id, (locataire, [], []))
+        groupe[1].append((paiement, chambre, appartement))
+    for paiement, locataire, chambre, appartement in quittances:
+        if paiement.chemin_quittance and os.path.exists(paiement.chemin_quittance):
+            groupe = par_locataire.setdefault(locataire.id, (locataire, [], []))
+            groupe[2].append((paiement, chambre, appartement, paiement.chemin_quittance))
+    
+    def envoyer(groupe):
+        locataire, impayes_locataire, quittances_locataire = groupe
+        if not locataire.email:
+            return False, "Le locataire n'a pas d'adresse email"
+        if not config['sender'] or not config['password']:
+            return False, "Configuration email incomplète"
+        reference = date_reference or datetime.now()
+        cle = cle_envoi(
+            'recapitulatif', None, f"{reference.year:04d}-{reference.month:02d}", locataire.id,
+            *sorted((paiement.id, f"{paiement.montant:.2f}") for paiement, _, _ in impayes_locataire),
+            *sorted((paiement.id, _empreinte_fichier(chemin)) for paiement, _, _, chemin in quittances_locataire)
+        )
+        try:
+            return _envoyer_une_fois(
+                cle, 'recapitulatif', locataire.id, None,
+                lambda: construire_message_recapitulatif(locataire, impayes_locataire, quittances_locataire,
+                                                         config, date_reference),
+                config
+            )
+        except Exception as e:
+            return False, str(e)
+    
+    groupes = list(par_locataire.values())
+    with ThreadPoolExecutor(max_workers=max_workers or SMTP_POOL_TAILLE) as executor:
+        resultats = list(executor.map(envoyer, groupes))
+    
+    alertes = []
+    quittances_envoyees = []
+    maintenant = datetime.now()
+    for (locataire, impayes_locataire, quittances_locataire), (success, message) in zip(groupes, resultats):
+        stats['details'].append({'locataire': locataire.nom, 'success': success, 'message': message,
+                                 'impayes': len(impayes_locataire), 'quittances': len(quittances_locataire)})
+        if message in (DEJA_ENVOYE, DEJA_EN_COURS):
+            # Rien n'a été transmis : alertes et quittances sont enregistrées par l'envoi qui l'a fait
+            stats['deja_envoyes'] += len(impayes_locataire)
+            continue
+        for paiement, _, _ in impayes_locataire:
+            alertes.append({'locataire_id': locataire.id, 'paiement_id': paiement.id, 'date_envoi': maintenant,
+                            'statut': 'envoye' if success else 'erreur',
+                            'message_erreur': message if not success else None})
+        if success:
+            stats['emails'] += 1
+            stats['envoyes'] += len(impayes_locataire)
+            quittances_envoyees.extend(paiement.id for paiement, _, _, _ in quittances_locataire)
+        else:
+            stats['erreurs'] += len(impayes_locataire)
+    
+    enregistrer_alertes(alertes)
+    stats['quittances_envoyees'] = marquer_quittances_envoyees(quittances_envoyees, maintenant)
+    vider_mesures_envoi()
     
     return stats
 
 
+def construire_message_quittance(locataire, paiement, chambre, appartement, chemin_quittance, config=None):
+    """
+    Construit l'email de quittance (texte et pièce jointe) sans l'envoyer
+    
+    Args:
+        locataire: Objet Locataire
+        paiement: Objet Paiement
+        chambre: Objet Chambre
+        appartement: Objet Appartement
+        chemin_quittance: Chemin vers le fichier de quittance
+        config: Configuration email (get_email_config() par défaut)
+    
+    Returns:
+        MIMEMultipart prêt à être envoyé
+    """
+    if config is None:
+        config = get_email_config()
+    
+    sujet, texte, html = rendre_email(
+        'quittance', locataire=locataire, paiement=paiement, chambre=chambre, appartement=appartement,
+        periode=_periode(paiement.mois, paiement.annee), signature=config['from_name']
+    )
+    return _assembler_message(config, locataire.email, sujet, texte, html, [_piece_jointe_quittance(chemin_quittance)])
+
+
+def _piece_jointe_quittance(chemin_quittance):
+    """Pièce jointe MIME (Word ou PDF) d'un fichier de quittance"""
+    nom_fichier = os.path.basename(chemin_quittance)
+    etat = os.stat(chemin_quittance)
+    
+    if nom_fichier.lower().endswith('.pdf'):
+        piece_jointe = MIMEBase('application', 'pdf')
+    else:
+        piece_jointe = MIMEBase('application', 'vnd.openxmlformats-officedocument.wordprocessingml.document')
+    piece_jointe['Content-Transfer-Encoding'] = 'base64'
+    piece_jointe.set_payload(_contenu_base64(chemin_quittance, etat.st_mtime_ns, etat.st_size))
+    piece_jointe.add_header('Content-Disposition', f'attachment; filename="{nom_fichier}"')
+    return piece_jointe
+
+
+@lru_cache(maxsize=256)
+def _contenu_base64(chemin, mtime_ns, taille):
+    """
+    Contenu encodé d'un fichier joint, mis en cache tant que le fichier ne
+    change pas (mtime et taille font partie de la clé) : une nouvelle tentative
+    ou un récapitulatif qui rejoint la même quittance ne la réencode pas
+    """
+    with open(chemin, 'rb') as f:
+        contenu = f.read()
+    # Même découpage en lignes de 76 caractères que email.encoders.encode_base64
+    return base64.encodebytes(contenu).decode('ascii')
+
+
 def envoyer_quittance_email(locataire, paiement, chambre, appartement, chemin_quittance):
     """
     Envoie la quittance par email au locataire
@@ -210,53 +915,12 @@ def envoyer_quittance_email(locataire, paiement, chambre, appartement, chemin_qu
         return False, "Configuration email incomplète. Vérifiez le fichier .env"
     
     try:
-        # Noms des mois
-        mois_noms = ['', 'Janvier', 'Février', 'Mars', 'Avril', 'Mai', 'Juin',
-                     'Juillet', 'Août', 'Septembre', 'Octobre', 'Novembre', 'Décembre']
-        
-        mois_nom = mois_noms[paiement.mois]
-        
-        # Création du message
-        msg = MIMEMultipart()
-        msg['From'] = f"{config['from_name']} <{config['sender']}>"
-        msg['To'] = locataire.email
-        msg['Subject'] = f"Quittance de loyer - {mois_nom} {paiement.annee}"
-        
-        # Corps du message
-        corps = f"""
-Bonjour {locataire.nom},
-
-Veuillez trouver ci-joint votre quittance de loyer pour le mois de {mois_nom} {paiement.annee}.
-
-Détails :
-- Adresse : {appartement.adresse}, {appartement.code_postal} {appartement.ville}
-- Logement : {chambre.numero}
-- Montant : {paiement.montant:.2f} €
-- Période : {mois_nom} {paiement.annee}
-
-Cordialement,
-{config['from_name']}
-"""
-        
-        msg.attach(MIMEText(corps, 'plain', 'utf-8'))
-        
-        # Ajout de la pièce jointe
-        nom_fichier = os.path.basename(chemin_quittance)
-        
-        with open(chemin_quittance, 'rb') as f:
-            piece_jointe = MIMEBase('application', 'vnd.openxmlformats-officedocument.wordprocessingml.document')
-            piece_jointe.set_payload(f.read())
-            encoders.encode_base64(piece_jointe)
-            piece_jointe.add_header('Content-Disposition', f'attachment; filename="{nom_fichier}"')
-            msg.attach(piece_jointe)
-        
-        # Envoi de l'email
-        with smtplib.SMTP(config['smtp_server'], config['smtp_port']) as server:
-            server.starttls()
-            server.login(config['sender'], config['password'])
-            server.send_message(msg)
-        
-        return True, "Email envoyé avec succès"
+        # Envoi de l'email sur une session SMTP partagée, une seule fois par version de la quittance
+        return _envoyer_une_fois(
+            cle_quittance(paiement, chemin_quittance), 'quittance', locataire.id, paiement.id,
+            lambda: construire_message_quittance(locataire, paiement, chambre, appartement, chemin_quittance, config),
+            config, payload={'chemin_quittance': chemin_quittance}, suivi=True
+        )
     
     except smtplib.SMTPAuthenticationError:
         return False, "Erreur d'authentification SMTP. Vérifiez vos identifiants dans le fichier .env"
@@ -264,3 +928,440 @@ Cordialement,
         return False, f"Erreur SMTP: {str(e)}"
     except Exception as e:
         return False, f"Erreur lors de l'envoi de l'email: {str(e)}"
+
+
+# ==================== FILE D'ENVOI ====================
+
+# Délai (secondes) entre deux passages du worker quand la file est vide
+OUTBOX_INTERVALLE = float(os.getenv('LOCATOR_OUTBOX_INTERVALLE', '5'))
+OUTBOX_LOT = 20  # emails réservés par passage
+
+
+def mettre_quittance_en_file(paiement, chemin_quittance):
+    """
+    Programme l'envoi de la quittance d'un paiement, sans attendre le serveur SMTP
+    
+    Le worker d'envoi marque le paiement comme envoyé une fois l'email parti.
+    Redemander l'envoi du même fichier ne crée pas de second envoi.
+    
+    Returns:
+        Objet EmailOutbox (statut 'envoye' si ce fichier a déjà été envoyé)
+    """
+    from .database import mettre_email_en_file
+    
+    envoi = mettre_email_en_file('quittance', paiement.locataire_id, paiement.id,
+                                 {'chemin_quittance': chemin_quittance}, cle=cle_quittance(paiement, chemin_quittance))
+    _reveiller_worker()
+    return envoi
+
+
+def mettre_alerte_en_file(paiement):
+    """Programme l'envoi d'une alerte de loyer impayé (enregistrée dans AlerteEmail une fois traitée)"""
+    from .database import mettre_email_en_file
+    
+    envoi = mettre_email_en_file('alerte', paiement.locataire_id, paiement.id, cle=cle_alerte(paiement))
+    _reveiller_worker()
+    return envoi
+
+
+def _erreur_definitive(exc):
+    """Indique si une erreur SMTP se reproduira à coup sûr (destinataire refusé, erreur 5xx)"""
+    if isinstance(exc, (smtplib.SMTPRecipientsRefused, EnvoiIncertain)):
+        # EnvoiIncertain : un nouvel essai pourrait envoyer l'email en double
+        return True
+    if isinstance(exc, smtplib.SMTPAuthenticationError):
+        # Les identifiants peuvent être corrigés dans le .env : on retente
+        return False
+    return isinstance(exc, smtplib.SMTPResponseException) and 500 <= exc.smtp_code < 600
+
+
+def _preparer_envoi(envoi, details, config):
+    """
+    Construit le message d'un envoi de la file
+    
+    Returns:
+        tuple (message, erreur) : erreur est renseignée si l'envoi est impossible
+    """
+    if details is None:
+        return None, "Paiement introuvable"
+    paiement, locataire, chambre, appartement = details
+    if not locataire.email:
+        return None, "Le locataire n'a pas d'adresse email"
+    
+    if envoi.type_envoi == 'quittance':
+        chemin_quittance = json.loads(envoi.payload or '{}').get('chemin_quittance') or paiement.chemin_quittance
+        if not chemin_quittance or not os.path.exists(chemin_quittance):
+            return None, "Le fichier de quittance n'existe pas"
+        message = construire_message_quittance(locataire, paiement, chambre, appartement, chemin_quittance, config)
+    elif envoi.type_envoi == 'alerte':
+        message = construire_message_alerte(locataire, paiement, chambre, appartement, config)
+    else:
+        return None, f"Type d'envoi inconnu : {envoi.type_envoi}"
+    
+    message['Message-ID'] = _message_id(envoi.type_envoi, envoi.id, config)
+    return message, None
+
+
+def traiter_file_emails(limite=OUTBOX_LOT, config=None):
+    """
+    Envoie un lot d'emails de la file d'envoi
+    
+    Chaque email réservé est envoyé sur le pool SMTP ; un échec temporaire
+    est reprogrammé avec un délai croissant, un échec définitif est abandonné.
+    
+    Args:
+        limite: Nombre maximal d'emails traités
+        config: Configuration email (get_email_config() par défaut)
+    
+    Returns:
+        dict avec les nombres d'emails 'envoyes', 'reprogrammes', 'echecs' et
+        'repris' (réservation expirée, reprise par un autre worker)
+    """
+    from .database import reserver_emails, get_paiements_details
+    
+    stats = {'envoyes': 0, 'reprogrammes': 0, 'echecs': 0, 'repris': 0}
+    config = config or get_email_config()
+    if not config['sender'] or not config['password']:
+        # Rien n'est réservé : les emails attendent que la configuration soit complète
+        return stats
+    
+    envois = reserver_emails(limite)
+    if not envois:
+        return stats
+    details = get_paiements_details({envoi.paiement_id for envoi in envois if envoi.paiement_id is not None})
+    
+    for envoi in envois:
+        resultat, _ = _traiter_envoi(envoi, details.get(envoi.paiement_id), config)
+        stats[resultat] += 1
+    
+    return stats
+
+
+def _traiter_envoi(envoi, details, config, renouveler=True):
+    """
+    Envoie un email réservé et enregistre le résultat dans la file
+    
+    Juste avant la transmission, la réservation est vérifiée et prolongée
+    (renouveler_reservation) : un envoi dont la réservation a expiré et a été
+    reprise par un autre worker n'est pas envoyé une seconde fois.
+    
+    Args:
+        renouveler: False si l'envoi vient d'être réservé par l'appelant
+    
+    Returns:
+        tuple (resultat, erreur) : resultat vaut 'envoyes', 'reprogrammes',
+        'echecs' ou 'repris'
+    """
+    from .database import renouveler_reservation, terminer_email
+    
+    message, erreur = _preparer_envoi(envoi, details, config)
+    definitif = erreur is not None
+    if message is not None:
+        if renouveler and not renouveler_reservation(envoi.id, envoi.reserve_par):
+            return 'repris', None
+        try:
+            _envoyer_mesure(config, message, envoi.type_envoi, envoi.id, envoi.paiement_id, envoi.tentatives)
+        except Exception as e:
+            erreur = str(e) or type(e).__name__
+            definitif = _erreur_definitive(e)
+    
+    envoi_termine = terminer_email(envoi.id, erreur, definitif=definitif, jeton=envoi.reserve_par)
+    if erreur is None:
+        return 'envoyes', None
+    if envoi_termine is not None and envoi_termine.statut == 'echec':
+        return 'echecs', erreur
+    return 'reprogrammes', erreur
+
+
+def envoyer_quittances_mois(mois, annee, appartement_id=None, format='docx', max_workers=None, progression=None):
+    """
+    Envoie d'un coup les quittances d'un mois à tous les locataires qui ne l'ont pas reçue
+    
+    Les quittances manquantes ou périmées sont d'abord générées, puis chaque
+    paiement payé et non envoyé est placé dans la file d'envoi et envoyé
+    aussitôt par un pool de threads borné. Le débit vers le serveur SMTP est
+    limité par son seau à jetons. Les échecs temporaires restent dans la file
+    et sont retentés par le worker d'envoi.
+    
+    Chaque thread ne réserve son envoi qu'au moment de le traiter : les envois
+    qui attendent leur tour restent « en attente » et ne peuvent pas voir leur
+    réservation expirer pendant un long lot (sinon le worker d'envoi les
+    reprendrait et les enverrait une seconde fois). Ils sont mis en file avec
+    une prochaine tentative différée de OUTBOX_RESERVATION_MAX secondes, pour
+    que le worker ne les prenne que si le lot est interrompu ou dure plus
+    longtemps ; un envoi pris par le worker est compté dans 'repris'.
+    
+    Args:
+        mois: Mois de la période
+        annee: Année de la période
+        appartement_id: Limiter à un appartement (optionnel)
+        format: 'docx' (par défaut) ou 'pdf'
+        max_workers: Envois simultanés (SMTP_POOL_TAILLE par défaut)
+        progression: Fonction appelée après chaque envoi avec
+                     (faits, total, locataire, erreur), depuis le thread appelant
+    
+    Returns:
+        dict avec 'total', 'envoyes', 'reprogrammes', 'echecs', 'repris',
+        'sans_email', 'erreurs_generation' ({paiement_id: message}) et 'details'
+    """
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+    from .database import OUTBOX_RESERVATION_MAX, get_paiements_a_quittancer, mettre_emails_en_file, reserver_emails
+    from .quittance import generer_quittances_mois
+    
+    stats = {'total': 0, 'envoyes': 0, 'reprogrammes': 0, 'echecs': 0, 'repris': 0, 'sans_email': 0,
+             'erreurs_generation': {}, 'details': []}
+    config = get_email_config()
+    if not config['sender'] or not config['password']:
+        stats['message'] = "Configuration email incomplète. Vérifiez le fichier .env"
+        return stats
+    
+    stats['erreurs_generation'] = generer_quittances_mois(mois, annee, appartement_id, format=format)['erreurs']
+    
+    details = {}
+    for paiement, locataire, chambre, appartement in get_paiements_a_quittancer(
+            mois, annee, appartement_id, seulement_sans_quittance=False):
+        if paiement.quittance_envoyee or paiement.id in stats['erreurs_generation'] or not paiement.chemin_quittance:
+            continue
+        if not locataire.email:
+            stats['sans_email'] += 1
+            continue
+        details[paiement.id] = (paiement, locataire, chambre, appartement)
+    
+    reprise = datetime.now() + timedelta(seconds=OUTBOX_RESERVATION_MAX)
+    ids = mettre_emails_en_file([
+        {'type_envoi': 'quittance', 'locataire_id': paiement.locataire_id, 'paiement_id': paiement.id,
+         'payload': {'chemin_quittance': paiement.chemin_quittance},
+         'cle': cle_quittance(paiement, paiement.chemin_quittance), 'prochaine_tentative': reprise}
+        for paiement, _, _, _ in details.values()
+    ])
+    stats['total'] = len(ids)
+    
+    def envoyer(outbox_id, paiement_id):
+        envois = reserver_emails(1, outbox_ids=[outbox_id])
+        if not envois:
+            return 'repris', None
+        return _traiter_envoi(envois[0], details[paiement_id], config, renouveler=False)
+    
+    with ThreadPoolExecutor(max_workers=max_workers or SMTP_POOL_TAILLE) as executor:
+        futures = {
+            executor.submit(envoyer, outbox_id, paiement_id): paiement_id
+            for outbox_id, paiement_id in zip(ids, details)
+        }
+        for faits, future in enumerate(as_completed(futures), start=1):
+            resultat, erreur = future.result()
+            stats[resultat] += 1
+            locataire = details[futures[future]][1]
+            message = "Envoi pris en charge par la file d'envoi" if resultat == 'repris' else "Email envoyé avec succès"
+            stats['details'].append({'locataire': locataire.nom, 'success': erreur is None,
+                                     'message': erreur or message})
+            if progression is not None:
+                progression(faits, stats['total'], locataire, erreur)
+    
+    vider_mesures_envoi()
+    return stats
+
+
+class WorkerEmails(threading.Thread):
+    """
+    Thread d'arrière-plan qui vide la file d'envoi
+    
+    Les lots sont enchaînés tant que la file en fournit ; quand elle est vide,
+    le worker attend OUTBOX_INTERVALLE secondes ou d'être réveillé par une
+    mise en file.
+    """
+    
+    def __init__(self, intervalle=OUTBOX_INTERVALLE):
+        super().__init__(name='locator-emails', daemon=True)
+        self.intervalle = intervalle
+        self._arret = threading.Event()
+        self._reveil = threading.Event()
+    
+    def run(self):
+        while not self._arret.is_set():
+            try:
+                stats = traiter_file_emails()
+            except Exception as e:
+                print(f"⚠️ Erreur de la file d'envoi : {e}")
+                stats = None
+            if stats and any(stats.values()):
+                continue
+            # File vide : les mesures des derniers envois sont écrites avant l'attente
+            vider_mesures_envoi()
+            self._reveil.wait(self.intervalle)
+            self._reveil.clear()
+    
+    def reveiller(self):
+        self._reveil.set()
+    
+    def arreter(self):
+        self._arret.set()
+        self._reveil.set()
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def demarrer_worker_emails():
+    """Démarre le worker d'envoi du processus s'il ne tourne pas déjà"""
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = WorkerEmails()
+            _worker.start()
+        return _worker
+
+
+def _reveiller_worker():
+    worker = _worker
+    if worker is not None:
+        worker.reveiller()
+
+
+# ==================== EXÉCUTION PLANIFIÉE ====================
+
+def _chemin_verrou_alertes():
+    """Fichier verrou des alertes, à côté de la base (LOCATOR_ALERTES_VERROU pour le changer)"""
+    from .database import DB_PATH, PROJECT_DIR
+    
+    dossier = PROJECT_DIR if DB_PATH == ':memory:' else os.path.dirname(os.path.abspath(DB_PATH))
+    return os.getenv('LOCATOR_ALERTES_VERROU', os.path.join(dossier, '.locator-alertes.lock'))
+
+
+@contextmanager
+def verrou_exclusif(chemin):
+    """
+    Verrou de fichier non bloquant, libéré par le système si le processus meurt
+    
+    Yields:
+        True si le verrou est obtenu, False si un autre processus le détient
+    """
+    f = open(chemin, 'a+')
+    try:
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            if os.name == 'nt':
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    finally:
+        f.close()
+
+
+def executer_alertes(en_file=False, recapitulatif=False, joindre_quittances=False):
+    """
+    Passage planifié des alertes de loyers impayés (cron, tâche planifiée Windows...)
+    
+    Un verrou de fichier empêche deux passages de se chevaucher : le second
+    s'arrête aussitôt sans rien envoyer.
+    
+    Args:
+        en_file: Mettre les alertes dans la file d'envoi au lieu de les envoyer
+        recapitulatif, joindre_quittances: Voir verifier_et_envoyer_alertes
+    
+    Returns:
+        dict résumé : 'statut' ('termine' ou 'deja_en_cours'), horodatages,
+        durée et statistiques de verifier_et_envoyer_alertes
+    """
+    from .database import get_session
+    
+    debut = datetime.now()
+    resume = {'statut': 'deja_en_cours', 'debut': debut.isoformat(timespec='seconds')}
+    with verrou_exclusif(_chemin_verrou_alertes()) as obtenu:
+        if obtenu:
+            session = get_session()
+            try:
+                resume.update(verifier_et_envoyer_alertes(session, en_file=en_file, recapitulatif=recapitulatif,
+                                                          joindre_quittances=joindre_quittances))
+            finally:
+                session.close()
+            resume['statut'] = 'termine'
+    fin = datetime.now()
+    resume['fin'] = fin.isoformat(timespec='seconds')
+    resume['duree_s'] = round((fin - debut).total_seconds(), 3)
+    return resume
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    
+    parser = argparse.ArgumentParser(description="Envoi des emails de Locator")
+    commandes = parser.add_subparsers(dest='commande', required=True)
+    run = commandes.add_parser('run', help="Envoie les alertes de loyers impayés (à planifier chaque jour)")
+    run.add_argument('--en-file', action='store_true',
+                     help="Met les alertes dans la file d'envoi au lieu de les envoyer")
+    run.add_argument('--recapitulatif', action='store_true',
+                     help="Un seul email par locataire regroupant tous ses impayés")
+    run.add_argument('--avec-quittances', action='store_true',
+                     help="Avec --recapitulatif, joint les quittances du mois non envoyées")
+    run.add_argument('--details', action='store_true', help="Inclut le détail par locataire dans le résumé")
+    outbox = commandes.add_parser('outbox', help="Envoie les emails de la file d'envoi")
+    outbox.add_argument('--une-fois', action='store_true',
+                        help="Vide la file puis s'arrête (sinon tourne en continu)")
+    outbox.add_argument('--intervalle', type=float, default=OUTBOX_INTERVALLE,
+                        help="Secondes entre deux passages quand la file est vide")
+    quittances = commandes.add_parser('quittances', help="Envoie les quittances d'un mois à tous les locataires")
+    quittances.add_argument('--mois', type=int, default=datetime.now().month)
+    quittances.add_argument('--annee', type=int, default=datetime.now().year)
+    quittances.add_argument('--appartement', type=int, help="ID de l'appartement (tous par défaut)")
+    quittances.add_argument('--format', choices=['docx', 'pdf'], default='docx')
+    quittances.add_argument('--workers', type=int, default=SMTP_POOL_TAILLE, help="Envois simultanés")
+    args = parser.parse_args()
+    if args.commande == 'run' and args.en_file and args.recapitulatif:
+        parser.error("--recapitulatif envoie directement les emails : il ne peut pas être combiné avec --en-file")
+    
+    # Les messages de migration vont sur stderr : stdout ne contient que le résumé JSON
+    from contextlib import redirect_stdout
+    from .database import migrate_db
+    with redirect_stdout(sys.stderr):
+        migrate_db()
+    
+    if args.commande == 'run':
+        resume = executer_alertes(en_file=args.en_file, recapitulatif=args.recapitulatif,
+                                  joindre_quittances=args.avec_quittances)
+        if not args.details:
+            resume.pop('details', None)
+        print(json.dumps(resume, indent=2, ensure_ascii=False))
+        sys.exit(1 if resume.get('erreurs') else 0)
+    
+    elif args.commande == 'quittances':
+        def afficher(faits, total, locataire, erreur):
+            print(f"[{faits}/{total}] {locataire.nom} : {erreur or 'envoyée'}", file=sys.stderr)
+        
+        stats = envoyer_quittances_mois(args.mois, args.annee, args.appartement, args.format,
+                                        max_workers=args.workers, progression=afficher)
+        stats.pop('details')
+        print(json.dumps(stats, indent=2, ensure_ascii=False))
+    
+    elif args.commande == 'outbox':
+        if args.une_fois:
+            total = {'envoyes': 0, 'reprogrammes': 0, 'echecs': 0, 'repris': 0}
+            while True:
+                stats = traiter_file_emails()
+                for cle, valeur in stats.items():
+                    total[cle] += valeur
+                if not any(stats.values()):
+                    break
+            print(json.dumps(total, indent=2, ensure_ascii=False))
+        else:
+            worker = WorkerEmails(args.intervalle)
+            worker.start()
+            try:
+                while worker.is_alive():
+                    worker.join(1)
+            except KeyboardInterrupt:
+                worker.arreter()
@@ -2,14 +2,27 @@
 Module de gestion des fichiers et répertoires
 """
 
+import hashlib
 import os
 from pathlib import Path
 import shutil
+import tempfile
+import zipfile
 
 
 BASE_DIR = "documents"
 APPARTEMENTS_DIR = os.path.join(BASE_DIR, "appartements")
 LOCATAIRES_DIR = os.path.join(BASE_DIR, "locataires")
+EXPORTS_DIR = os.path.join(BASE_DIR, "exports")
+
+# Taille des blocs copiés lors de l'enregistrement d'un fichier importé
+COPIE_BLOC = 1024 * 1024
+# Taille maximale d'une facture importée
+FACTURE_TAILLE_MAX = int(float(os.getenv('LOCATOR_FACTURE_TAILLE_MAX_MO', '50')) * 1024 * 1024)
+
+
+class FichierTropVolumineux(ValueError):
+    """Le fichier importé dépasse la taille maximale autorisée"""
 
 
 def init_directories():
@@ -48,18 +61,30 @@ def get_locataire_dir(nom, annee, mois):
     return path
 
 
-def save_facture_file(source_file, appartement_adresse, annee, filename=None):
+def save_facture_file(source_file, appartement_adresse, annee, filename=None, appartement_id=None,
+                      taille_max=FACTURE_TAILLE_MAX, ecraser=False):
     """
     Sauvegarde un fichier de facture dans le répertoire approprié
     
+    Le fichier est copié par blocs (voir ecrire_flux_atomique) : la mémoire
+    utilisée ne dépend pas de sa taille. Un fichier existant du même nom n'est
+    pas remplacé : s'il a le même contenu, il est réutilisé, sinon la facture
+    est enregistrée sous un nom libre (« facture (2).pdf »).
+    
     Args:
         source_file: Chemin du fichier source ou objet file-like (de Streamlit)
         appartement_adresse: Adresse de l'appartement
         annee: Année de la facture
         filename: Nom du fichier de destination (optionnel)
+        appartement_id: Appartement propriétaire, pour l'index des documents (optionnel)
+        taille_max: Taille maximale en octets (LOCATOR_FACTURE_TAILLE_MAX_MO, 50 Mo par défaut)
+        ecraser: Remplacer un fichier existant du même nom
     
     Returns:
         Chemin complet du fichier sauvegardé
+    
+    Raises:
+        FichierTropVolumineux: si le fichier dépasse taille_max (rien n'est écrit)
     """
     dest_dir = get_appartement_dir(appartement_adresse, annee)
     
@@ -71,136 +96,454 @@ def save_facture_file(source_file, appartement_adresse, annee, filename=None):
             filename = os.path.basename(source_file)
     
     dest_path = os.path.join(dest_dir, filename)
+    document = {'type_document': 'facture', 'appartement_id': appartement_id, 'annee': annee}
     
-    # Copier le fichier
     if hasattr(source_file, 'read'):
-        # C'est un objet file-like (Streamlit UploadedFile)
-        with open(dest_path, 'wb') as f:
-            f.write(source_file.read())
-    else:
-        # C'est un chemin de fichier
-        shutil.copy2(source_file, dest_path)
+        # C'est un objet file-like (Streamlit UploadedFile), relu depuis le début
+        if hasattr(source_file, 'seek'):
+            source_file.seek(0)
+        return ecrire_flux_atomique(source_file, dest_path, document=document, taille_max=taille_max, ecraser=ecraser)
+    
+    # C'est un chemin de fichier
+    with open(source_file, 'rb') as f:
+        return ecrire_flux_atomique(f, dest_path, document=document, taille_max=taille_max, ecraser=ecraser)
+
+
+def ecrire_fichier_atomique(contenu, dest_path, document=None):
+    """
+    Écrit un contenu en mémoire dans un fichier de façon atomique
+    
+    Le contenu est écrit dans un fichier temporaire du même répertoire, forcé
+    sur disque puis renommé : un lecteur voit l'ancien fichier ou le nouveau,
+    jamais un fichier partiellement écrit.
+    
+    Args:
+        contenu: bytes à écrire
+        dest_path: Chemin de destination
+        document: Champs d'index (type_document, locataire_id, annee...) : si
+            fourni, la ligne de la table documents est écrite dans la même
+            transaction que le renommage du fichier (optionnel)
     
+    Returns:
+        Chemin de destination
+    """
+    dest_dir = os.path.dirname(dest_path) or "."
+    os.makedirs(dest_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dest_dir, prefix=".tmp-", suffix=os.path.splitext(dest_path)[1])
+    
+    publier = _Publication(tmp_path, dest_path)
+    
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(contenu)
+            f.flush()
+            os.fsync(f.fileno())
+        if document is None:
+            publier()
+            publier.valider()
+        else:
+            from .database import enregistrer_document
+            enregistrer_document(dest_path, taille=len(contenu), empreinte=hashlib.sha256(contenu).hexdigest(),
+                                 publier=publier, **document)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
     return dest_path
 
 
-def save_quittance_file(file_path, nom, annee, mois):
+class _EcritureEmpreinte:
+    """Fichier en écriture qui compte les octets et calcule leur SHA-256 au passage"""
+    
+    def __init__(self, fichier, taille_max=None):
+        self.fichier = fichier
+        self.taille_max = taille_max
+        self.taille = 0
+        self.sha = hashlib.sha256()
+    
+    def write(self, bloc):
+        self.taille += len(bloc)
+        if self.taille_max is not None and self.taille > self.taille_max:
+            raise FichierTropVolumineux(f"Fichier trop volumineux (maximum {self.taille_max / (1024 * 1024):g} Mo)")
+        self.sha.update(bloc)
+        return self.fichier.write(bloc)
+
+
+def ecrire_flux_atomique(source, dest_path, document=None, taille_max=None, ecraser=True):
+    """
+    Copie un flux dans un fichier de façon atomique, par blocs de COPIE_BLOC octets
+    
+    Comme ecrire_fichier_atomique, mais sans charger le contenu en mémoire :
+    le flux est copié par shutil.copyfileobj dans un fichier temporaire du
+    même répertoire, dont la taille et le SHA-256 sont calculés pendant la
+    copie, puis forcé sur disque et renommé.
+    
+    Args:
+        source: Objet file-like ouvert en lecture binaire
+        dest_path: Chemin de destination
+        document: Champs d'index (voir ecrire_fichier_atomique) (optionnel)
+        taille_max: Taille maximale en octets ; au-delà, la copie est
+            interrompue et FichierTropVolumineux est levée (optionnel)
+        ecraser: Remplacer un fichier existant. Sinon, un fichier de même
+            contenu est réutilisé et un contenu différent est écrit sous un
+            nom libre ; la création du nom est exclusive, deux imports
+            simultanés ne peuvent pas s'écraser
+    
+    Returns:
+        Chemin du fichier écrit
+    """
+    taille_annoncee = getattr(source, 'size', None)
+    if taille_max is not None and taille_annoncee is not None and taille_annoncee > taille_max:
+        raise FichierTropVolumineux(f"Fichier trop volumineux (maximum {taille_max / (1024 * 1024):g} Mo)")
+    
+    dest_dir = os.path.dirname(dest_path) or "."
+    os.makedirs(dest_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dest_dir, prefix=".tmp-", suffix=os.path.splitext(dest_path)[1])
+    
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            ecriture = _EcritureEmpreinte(f, taille_max)
+            shutil.copyfileobj(source, ecriture, COPIE_BLOC)
+            f.flush()
+            os.fsync(f.fileno())
+        index = dict(document or {}, taille=ecriture.taille, empreinte=ecriture.sha.hexdigest())
+        
+        for chemin in [dest_path] if ecraser else _noms_libres(dest_path):
+            if not ecraser and os.path.exists(chemin):
+                if _empreinte_fichier(chemin) != (index['taille'], index['empreinte']):
+                    continue
+                # Même contenu déjà présent (import répété) : rien à écrire
+                os.remove(tmp_path)
+                if document is not None:
+                    from .database import enregistrer_document
+                    enregistrer_document(chemin, **index)
+                return chemin
+            
+            publier = _Publication(tmp_path, chemin, ecraser)
+            try:
+                if document is None:
+                    publier()
+                    publier.valider()
+                else:
+                    from .database import enregistrer_document
+                    enregistrer_document(chemin, publier=publier, **index)
+                return chemin
+            except FileExistsError:
+                # Nom pris entre-temps par un autre import : essayer le suivant
+                continue
+        raise FileExistsError(f"Aucun nom libre pour {dest_path}")
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _noms_libres(dest_path, nb_max=1000):
+    """Candidats pour dest_path : lui-même, puis « nom (2).ext », « nom (3).ext »..."""
+    base, extension = os.path.splitext(dest_path)
+    yield dest_path
+    for i in range(2, nb_max + 1):
+        yield f"{base} ({i}){extension}"
+
+
+class _Publication:
     """
-    Sauvegarde une quittance dans le répertoire approprié
+    Renommage d'un fichier temporaire en fichier final, annulable jusqu'au commit de son index
+    
+    enregistrer_document l'appelle juste avant le commit, puis appelle
+    annuler() si le commit échoue : le fichier redevient temporaire (une
+    nouvelle tentative le republiera) et le fichier qu'il remplaçait est remis
+    en place. valider() supprime ce fichier remplacé une fois le commit fait.
+    
+    Sans ecraser, la destination est créée par un lien physique, qui échoue
+    (FileExistsError) si le nom existe déjà : pas de fenêtre entre la
+    vérification et le renommage.
+    """
+    
+    def __init__(self, tmp_path, dest_path, ecraser=True):
+        self.tmp_path = tmp_path
+        self.dest_path = dest_path
+        self.ecraser = ecraser
+        self.ancien_path = None
+        self.publie = False
+    
+    def __call__(self):
+        # Sans effet si une tentative précédente a déjà publié le fichier
+        if self.publie:
+            return
+        if self.ecraser:
+            if os.path.exists(self.dest_path):
+                # Garder le fichier remplacé (second nom du même fichier) pour pouvoir le remettre
+                try:
+                    os.link(self.dest_path, self.tmp_path + ".ancien")
+                    self.ancien_path = self.tmp_path + ".ancien"
+                except OSError:
+                    self.ancien_path = None
+            os.replace(self.tmp_path, self.dest_path)
+        else:
+            try:
+                os.link(self.tmp_path, self.dest_path)
+            except OSError as e:
+                if isinstance(e, FileExistsError):
+                    raise
+                # Système de fichiers sans liens physiques
+                if os.path.exists(self.dest_path):
+                    raise FileExistsError(self.dest_path)
+                os.replace(self.tmp_path, self.dest_path)
+            else:
+                os.remove(self.tmp_path)
+        self.publie = True
+    
+    def annuler(self):
+        if not self.publie:
+            return
+        os.replace(self.dest_path, self.tmp_path)
+        if self.ancien_path is not None:
+            os.replace(self.ancien_path, self.dest_path)
+            self.ancien_path = None
+        self.publie = False
+    
+    def valider(self):
+        if self.ancien_path is not None:
+            try:
+                os.remove(self.ancien_path)
+            except OSError:
+                pass
+            self.ancien_path = None
+
+
+def save_quittance_file(contenu, filename, nom, annee, mois, document=None):
+    """
+    Sauvegarde une quittance rendue en mémoire dans le répertoire approprié
     
     Args:
-        file_path: Chemin du fichier de quittance généré
+        contenu: Contenu du document (bytes)
+        filename: Nom du fichier de quittance
         nom: Nom complet du locataire
         annee: Année de la quittance
         mois: Mois de la quittance
+        document: Champs d'index de la quittance (voir ecrire_fichier_atomique)
     
     Returns:
         Chemin complet du fichier sauvegardé
     """
     dest_dir = get_locataire_dir(nom, annee, mois)
-    filename = os.path.basename(file_path)
     dest_path = os.path.join(dest_dir, filename)
     
-    # Copier le fichier
-    shutil.copy2(file_path, dest_path)
-    
-    return dest_path
+    return ecrire_fichier_atomique(contenu, dest_path, document=document)
 
 
-def get_factures_files(appartement_adresse, annee=None):
+def get_factures_files(appartement_id, annee=None):
     """
     Récupère la liste des fichiers de factures pour un appartement
     
     Args:
-        appartement_adresse: Adresse de l'appartement
+        appartement_id: ID de l'appartement
         annee: Année spécifique (optionnel, sinon toutes les années)
     
     Returns:
-        Liste des chemins de fichiers
+        Liste des chemins de fichiers (index des documents)
     """
-    safe_adresse = "".join(c if c.isalnum() or c in (' ', '_') else '_' for c in appartement_adresse)
-    safe_adresse = safe_adresse.replace(' ', '_')
-    
-    files = []
-    base_path = os.path.join(APPARTEMENTS_DIR, safe_adresse)
-    
-    if not os.path.exists(base_path):
-        return files
-    
-    if annee:
-        factures_dir = os.path.join(base_path, str(annee), "Factures")
-        if os.path.exists(factures_dir):
-            files = [os.path.join(factures_dir, f) for f in os.listdir(factures_dir) 
-                    if os.path.isfile(os.path.join(factures_dir, f))]
-    else:
-        # Toutes les années
-        for year_dir in os.listdir(base_path):
-            factures_dir = os.path.join(base_path, year_dir, "Factures")
-            if os.path.exists(factures_dir):
-                files.extend([os.path.join(factures_dir, f) for f in os.listdir(factures_dir) 
-                            if os.path.isfile(os.path.join(factures_dir, f))])
+    from .database import get_documents
     
-    return files
+    return [d.chemin for d in get_documents('facture', appartement_id=appartement_id, annee=annee)]
 
 
-def get_quittances_files(nom, prenom, annee=None, mois=None):
+def get_quittances_files(locataire_id, annee=None, mois=None):
     """
     Récupère la liste des quittances pour un locataire
     
     Args:
-        nom: Nom du locataire
-        prenom: Prénom du locataire
+        locataire_id: ID du locataire
         annee: Année spécifique (optionnel)
         mois: Mois spécifique (optionnel)
     
     Returns:
-        Liste des chemins de fichiers
+        Liste des chemins de fichiers (index des documents)
     """
-    safe_nom = "".join(c if c.isalnum() or c in (' ', '_') else '_' for c in f"{nom}_{prenom}")
-    safe_nom = safe_nom.replace(' ', '_')
+    from .database import get_documents
     
-    files = []
-    base_path = os.path.join(LOCATAIRES_DIR, safe_nom)
+    return [d.chemin for d in get_documents('quittance', locataire_id=locataire_id, annee=annee, mois=mois)]
+
+
+def ecrire_zip_quittances(chemins, destination):
+    """
+    Écrit une archive ZIP des quittances fichier par fichier
     
-    if not os.path.exists(base_path):
-        return files
+    Les fichiers sont copiés dans l'archive par blocs : la mémoire utilisée ne
+    dépend pas du nombre ni de la taille des quittances. La destination peut
+    être un chemin ou un flux non positionnable (réponse HTTP, pipe...).
     
-    mois_noms = [
+    Args:
+        chemins: Liste des chemins de quittances
+        destination: Chemin du fichier ZIP ou objet file-like ouvert en écriture binaire
+    
+    Returns:
+        Nombre de fichiers ajoutés
+    """
+    nb = 0
+    noms_utilises = set()
+    # Les .docx sont déjà compressés : les stocker tels quels évite un travail inutile
+    with zipfile.ZipFile(destination, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for chemin in chemins:
+            if not chemin or not os.path.isfile(chemin):
+                continue
+            nom = os.path.basename(chemin)
+            if nom in noms_utilises:
+                nom = os.path.relpath(chemin, LOCATAIRES_DIR).replace(os.sep, '_')
+            noms_utilises.add(nom)
+            archive.write(chemin, arcname=nom)
+            nb += 1
+    return nb
+
+
+def contenu_zip_quittances(chemins):
+    """
+    Construit une archive ZIP des quittances et retourne son contenu
+    
+    L'archive est écrite par blocs dans un fichier temporaire propre à l'appel
+    (deux sessions qui exportent la même période ne se marchent pas dessus),
+    relue, puis supprimée. Le contenu entier est retourné en mémoire : c'est
+    ce qu'exige st.download_button.
+    
+    Args:
+        chemins: Liste des chemins de quittances
+    
+    Returns:
+        bytes de l'archive
+    """
+    os.makedirs(EXPORTS_DIR, exist_ok=True)
+    fd, chemin_zip = tempfile.mkstemp(dir=EXPORTS_DIR, suffix='.zip')
+    try:
+        with os.fdopen(fd, 'w+b') as f:
+            ecrire_zip_quittances(chemins, f)
+            f.seek(0)
+            return f.read()
+    finally:
+        os.remove(chemin_zip)
+
+
+# Mois des dossiers de quittances : noms (get_locataire_dir) ou numéros (quittances complètes)
+MOIS_DOSSIERS = {
+    nom.lower(): i + 1 for i, nom in enumerate([
         "Janvier", "Fevrier", "Mars", "Avril", "Mai", "Juin",
         "Juillet", "Aout", "Septembre", "Octobre", "Novembre", "Decembre"
-    ]
+    ])
+}
+
+
+def _dossiers_locataire(nom):
+    """Noms de dossier possibles d'un locataire, selon le module qui a écrit le fichier"""
+    safe_nom = "".join(c if c.isalnum() or c in (' ', '_') else '_' for c in nom).replace(' ', '_')
+    return {safe_nom, nom.replace(' ', '_').replace("'", "").replace('-', '_')}
+
+
+def _empreinte_fichier(chemin):
+    """Taille et SHA-256 d'un fichier, lu par blocs"""
+    sha = hashlib.sha256()
+    taille = 0
+    with open(chemin, 'rb') as f:
+        for bloc in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(bloc)
+            taille += len(bloc)
+    return taille, sha.hexdigest()
+
+
+def reindexer_documents(base_dir=BASE_DIR):
+    """
+    Reconstruit l'index des documents à partir de l'arborescence existante
+    
+    Commande ponctuelle, pour les fichiers écrits avant l'index : quittances
+    (dossiers par nom de mois ou par numéro), attestations annuelles et
+    factures. Les lignes dont le fichier a disparu sont retirées de l'index.
     
-    if annee and mois:
-        mois_nom = mois_noms[mois - 1] if 1 <= mois <= 12 else str(mois)
-        quittances_dir = os.path.join(base_path, str(annee), mois_nom, "quittances")
-        if os.path.exists(quittances_dir):
-            files = [os.path.join(quittances_dir, f) for f in os.listdir(quittances_dir) 
-                    if os.path.isfile(os.path.join(quittances_dir, f))]
-    elif annee:
-        year_path = os.path.join(base_path, str(annee))
-        if os.path.exists(year_path):
-            for month_dir in os.listdir(year_path):
-                quittances_dir = os.path.join(year_path, month_dir, "quittances")
-                if os.path.exists(quittances_dir):
-                    files.extend([os.path.join(quittances_dir, f) for f in os.listdir(quittances_dir) 
-                                if os.path.isfile(os.path.join(quittances_dir, f))])
-    else:
-        # Toutes les années et tous les mois
-        for year_dir in os.listdir(base_path):
-            year_path = os.path.join(base_path, year_dir)
-            if os.path.isdir(year_path):
-                for month_dir in os.listdir(year_path):
-                    quittances_dir = os.path.join(year_path, month_dir, "quittances")
-                    if os.path.exists(quittances_dir):
-                        files.extend([os.path.join(quittances_dir, f) for f in os.listdir(quittances_dir) 
-                                    if os.path.isfile(os.path.join(quittances_dir, f))])
-    
-    return files
+    Returns:
+        dict avec 'indexes', 'ignores' (chemins non rattachés) et 'supprimes'
+    """
+    from .database import (get_all_locataires, get_all_appartements, get_all_paiements,
+                           get_documents, enregistrer_documents, supprimer_documents)
+    
+    locataires = {}
+    for locataire in get_all_locataires():
+        for dossier in _dossiers_locataire(locataire.nom):
+            locataires.setdefault(dossier, locataire.id)
+    appartements = {
+        "".join(c if c.isalnum() or c in (' ', '_') else '_' for c in a.adresse).replace(' ', '_'): a.id
+        for a in get_all_appartements()
+    }
+    paiements_par_chemin = {}
+    paiements_par_periode = {}
+    for p in get_all_paiements():
+        if p.chemin_quittance:
+            paiements_par_chemin[os.path.normpath(p.chemin_quittance)] = p.id
+        paiements_par_periode[(p.locataire_id, p.annee, p.mois)] = p.id
+    
+    documents = []
+    ignores = []
+    for racine, _, fichiers in os.walk(base_dir):
+        for nom_fichier in fichiers:
+            if nom_fichier.startswith(('.tmp-', '~')):
+                continue
+            chemin = os.path.normpath(os.path.join(racine, nom_fichier))
+            parties = os.path.relpath(chemin, base_dir).split(os.sep)
+            document = None
+            
+            if parties[0] == 'locataires' and len(parties) >= 4 and parties[2].isdigit():
+                locataire_id = locataires.get(parties[1])
+                annee = int(parties[2])
+                if len(parties) == 4 and nom_fichier.startswith('attestation-'):
+                    document = {'type_document': 'attestation', 'locataire_id': locataire_id, 'annee': annee}
+                elif len(parties) == 5 or (len(parties) == 6 and parties[4] == 'quittances'):
+                    dossier_mois = parties[3]
+                    mois = int(dossier_mois) if dossier_mois.isdigit() else MOIS_DOSSIERS.get(dossier_mois.lower())
+                    document = {
+                        'type_document': 'quittance', 'locataire_id': locataire_id, 'annee': annee, 'mois': mois,
+                        'paiement_id': paiements_par_chemin.get(chemin,
+                                                                paiements_par_periode.get((locataire_id, annee, mois))),
+                    }
+                if document is not None and locataire_id is None:
+                    document = None
+            elif parties[0] == 'appartements' and len(parties) == 5 and parties[3] == 'Factures' and parties[2].isdigit():
+                appartement_id = appartements.get(parties[1])
+                if appartement_id is not None:
+                    document = {'type_document': 'facture', 'appartement_id': appartement_id, 'annee': int(parties[2])}
+            
+            if document is None:
+                if parties[0] in ('locataires', 'appartements'):
+                    ignores.append(chemin)
+                continue
+            document['chemin'] = chemin
+            document['taille'], document['empreinte'] = _empreinte_fichier(chemin)
+            documents.append(document)
+    
+    enregistrer_documents(documents)
+    disparus = [d.chemin for d in get_documents() if not os.path.exists(d.chemin)]
+    supprimer_documents(disparus)
+    
+    return {'indexes': len(documents), 'ignores': ignores, 'supprimes': len(disparus)}
 
 
 def delete_file(file_path):
-    """Supprime un fichier"""
+    """Supprime un fichier et sa ligne dans l'index des documents"""
+    from .database import supprimer_documents
+    
+    supprimer_documents([file_path])
     if os.path.exists(file_path):
         os.remove(file_path)
         return True
     return False
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    
+    parser = argparse.ArgumentParser(description="Gestion des fichiers de Locator")
+    commandes = parser.add_subparsers(dest='commande', required=True)
+    commandes.add_parser('reindex', help="Reconstruit l'index des documents à partir du dossier documents/")
+    args = parser.parse_args()
+    
+    if args.commande == 'reindex':
+        from .database import migrate_db
+        migrate_db()
+        print(json.dumps(reindexer_documents(), indent=2, ensure_ascii=False))
@@ -2,7 +2,7 @@
 Modèles de base de données pour Locator
 """
 
-from sqlalchemy import create_engine, Column, Integer, String, Float, Date, ForeignKey, Boolean, DateTime, Text
+from sqlalchemy import create_engine, Column, Integer, String, Float, Date, ForeignKey, Boolean, DateTime, Text, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
 from datetime import datetime
@@ -24,8 +24,8 @@ class Appartement(Base):
     created_at = Column(DateTime, default=datetime.now)
     
     # Relations
-    chambres = relationship("Chambre", back_populates="appartement", cascade="all, delete-orphan")
-    factures = relationship("Facture", back_populates="appartement", cascade="all, delete-orphan")
+    chambres = relationship("Chambre", back_populates="appartement", cascade="all, delete-orphan", passive_deletes=True)
+    factures = relationship("Facture", back_populates="appartement", cascade="all, delete-orphan", passive_deletes=True)
     
     def __repr__(self):
         return f"<Appartement(adresse='{self.adresse}')>"
@@ -36,7 +36,7 @@ class Chambre(Base):
     __tablename__ = 'chambres'
     
     id = Column(Integer, primary_key=True)
-    appartement_id = Column(Integer, ForeignKey('appartements.id'), nullable=False)
+    appartement_id = Column(Integer, ForeignKey('appartements.id', ondelete='CASCADE'), nullable=False)
     numero = Column(String(50), nullable=False)  # ex: "Chambre 1", "Studio", "Appartement complet", etc.
     loyer = Column(Float, nullable=False)
     charges = Column(Float, default=0.0)
@@ -47,8 +47,8 @@ class Chambre(Base):
     
     # Relations
     appartement = relationship("Appartement", back_populates="chambres")
-    bails = relationship("Bail", back_populates="chambre", cascade="all, delete-orphan")
-    paiements = relationship("Paiement", back_populates="chambre", cascade="all, delete-orphan")
+    bails = relationship("Bail", back_populates="chambre", cascade="all, delete-orphan", passive_deletes=True)
+    paiements = relationship("Paiement", back_populates="chambre", cascade="all, delete-orphan", passive_deletes=True)
     
     def __repr__(self):
         return f"<Chambre(numero='{self.numero}', loyer={self.loyer})>"
@@ -59,7 +59,7 @@ class Bail(Base):
     __tablename__ = 'bails'
     
     id = Column(Integer, primary_key=True)
-    chambre_id = Column(Integer, ForeignKey('chambres.id'), nullable=False)
+    chambre_id = Column(Integer, ForeignKey('chambres.id', ondelete='CASCADE'), nullable=False)
     date_debut = Column(Date, nullable=False)
     date_fin = Column(Date, nullable=True)
     loyer_total = Column(Float, nullable=False)
@@ -70,8 +70,8 @@ class Bail(Base):
     
     # Relations
     chambre = relationship("Chambre", back_populates="bails")
-    locataires = relationship("Locataire", back_populates="bail")
-    historique_loyers = relationship("HistoriqueLoyer", back_populates="bail", cascade="all, delete-orphan")
+    locataires = relationship("Locataire", back_populates="bail", passive_deletes=True)
+    historique_loyers = relationship("HistoriqueLoyer", back_populates="bail", cascade="all, delete-orphan", passive_deletes=True)
     
     def __repr__(self):
         return f"<Bail(chambre_id={self.chambre_id}, actif={self.actif})>"
@@ -82,7 +82,7 @@ class HistoriqueLoyer(Base):
     __tablename__ = 'historique_loyers'
     
     id = Column(Integer, primary_key=True)
-    bail_id = Column(Integer, ForeignKey('bails.id'), nullable=False)
+    bail_id = Column(Integer, ForeignKey('bails.id', ondelete='CASCADE'), nullable=False)
     ancien_loyer = Column(Float, nullable=False)
     nouveau_loyer = Column(Float, nullable=False)
     anciennes_charges = Column(Float, default=0.0)
@@ -103,7 +103,7 @@ class Locataire(Base):
     __tablename__ = 'locataires'
     
     id = Column(Integer, primary_key=True)
-    bail_id = Column(Integer, ForeignKey('bails.id'), nullable=True)
+    bail_id = Column(Integer, ForeignKey('bails.id', ondelete='SET NULL'), nullable=True)
     nom = Column(String(200), nullable=False)  # Contient maintenant le nom complet
     email = Column(String(150))
     telephone = Column(String(20))
@@ -117,7 +117,7 @@ class Locataire(Base):
     
     # Relations
     bail = relationship("Bail", back_populates="locataires")
-    paiements = relationship("Paiement", back_populates="locataire", cascade="all, delete-orphan")
+    paiements = relationship("Paiement", back_populates="locataire", cascade="all, delete-orphan", passive_deletes=True)
     
     def __repr__(self):
         return f"<Locataire(nom='{self.nom}')>"
@@ -132,8 +132,8 @@ class Paiement(Base):
     __tablename__ = 'paiements'
     
     id = Column(Integer, primary_key=True)
-    locataire_id = Column(Integer, ForeignKey('locataires.id'), nullable=False)
-    chambre_id = Column(Integer, ForeignKey('chambres.id'), nullable=False)
+    locataire_id = Column(Integer, ForeignKey('locataires.id', ondelete='CASCADE'), nullable=False)
+    chambre_id = Column(Integer, ForeignKey('chambres.id', ondelete='CASCADE'), nullable=False)
     mois = Column(Integer, nullable=False)  # 1-12
     annee = Column(Integer, nullable=False)
     montant = Column(Float, nullable=False)
@@ -144,6 +144,7 @@ class Paiement(Base):
     quittance_generee = Column(Boolean, default=False)
     date_quittance = Column(Date, nullable=True)  # Date de génération de la quittance
     chemin_quittance = Column(String(500), nullable=True)  # Chemin vers le fichier de quittance généré
+    empreinte_quittance = Column(String(64), nullable=True)  # Empreinte SHA-256 des données de la quittance générée
     quittance_envoyee = Column(Boolean, default=False)  # Si la quittance a été envoyée par email
     date_envoi_quittance = Column(DateTime, nullable=True)  # Date d'envoi de la quittance par email
     created_at = Column(DateTime, default=datetime.now)
@@ -161,7 +162,7 @@ class Facture(Base):
     __tablename__ = 'factures'
     
     id = Column(Integer, primary_key=True)
-    appartement_id = Column(Integer, ForeignKey('appartements.id'), nullable=False)
+    appartement_id = Column(Integer, ForeignKey('appartements.id', ondelete='CASCADE'), nullable=False)
     categorie = Column(String(50), nullable=False)  # 'travaux', 'electricite', 'eau', 'gaz', 'assurance', 'autre'
     fournisseur = Column(String(150))
     montant = Column(Float, nullable=False)
@@ -184,11 +185,98 @@ class AlerteEmail(Base):
     __tablename__ = 'alertes_email'
     
     id = Column(Integer, primary_key=True)
-    locataire_id = Column(Integer, ForeignKey('locataires.id'), nullable=False)
-    paiement_id = Column(Integer, ForeignKey('paiements.id'), nullable=False)
+    locataire_id = Column(Integer, ForeignKey('locataires.id', ondelete='CASCADE'), nullable=False)
+    paiement_id = Column(Integer, ForeignKey('paiements.id', ondelete='CASCADE'), nullable=False)
     date_envoi = Column(DateTime, default=datetime.now)
     statut = Column(String(20))  # 'envoye', 'erreur'
     message_erreur = Column(Text)
     
     def __repr__(self):
         return f"<AlerteEmail(locataire_id={self.locataire_id}, date_envoi={self.date_envoi})>"
+
+
+class EmailOutbox(Base):
+    """Modèle pour la file d'envoi des emails (quittances et alertes), traitée en arrière-plan"""
+    __tablename__ = 'outbox'
+    
+    id = Column(Integer, primary_key=True)
+    type_envoi = Column(String(20), nullable=False)  # 'quittance', 'alerte', 'recapitulatif'
+    locataire_id = Column(Integer, ForeignKey('locataires.id', ondelete='CASCADE'), nullable=False)
+    paiement_id = Column(Integer, ForeignKey('paiements.id', ondelete='CASCADE'), nullable=True)
+    # Clé d'idempotence : type, paiement, période et empreinte du contenu (un seul envoi par clé)
+    cle = Column(String(120))
+    payload = Column(Text)  # JSON : données nécessaires à l'envoi (ex: chemin de la quittance)
+    statut = Column(String(20), default='en_attente')  # 'en_attente', 'en_cours', 'envoye', 'echec'
+    tentatives = Column(Integer, default=0)
+    prochaine_tentative = Column(DateTime, default=datetime.now)
+    reserve_par = Column(String(50))  # Identifiant du worker qui traite l'envoi
+    reserve_a = Column(DateTime)
+    derniere_erreur = Column(Text)
+    date_envoi = Column(DateTime)
+    created_at = Column(DateTime, default=datetime.now)
+    
+    __table_args__ = (
+        Index('ix_outbox_statut_prochaine', 'statut', 'prochaine_tentative'),
+        Index('ix_outbox_paiement', 'paiement_id', 'type_envoi'),
+        Index('ux_outbox_cle', 'cle', unique=True),
+    )
+    
+    def __repr__(self):
+        return f"<EmailOutbox(type='{self.type_envoi}', paiement_id={self.paiement_id}, statut='{self.statut}')>"
+
+
+class MesureEnvoiEmail(Base):
+    """Modèle pour les mesures de chaque tentative d'envoi d'email (durées, réponse du serveur)"""
+    __tablename__ = 'mesures_envoi'
+    
+    id = Column(Integer, primary_key=True)
+    type_envoi = Column(String(20), nullable=False)  # 'quittance', 'alerte', 'recapitulatif'
+    outbox_id = Column(Integer, ForeignKey('outbox.id', ondelete='SET NULL'), nullable=True)
+    paiement_id = Column(Integer, ForeignKey('paiements.id', ondelete='SET NULL'), nullable=True)
+    tentative = Column(Integer, default=1)  # numéro de la tentative pour cet envoi
+    serveur = Column(String(100))
+    date_envoi = Column(DateTime, default=datetime.now)
+    succes = Column(Boolean, default=False)
+    code_smtp = Column(Integer)  # dernière réponse du serveur (250, 421, 550...)
+    erreur = Column(Text)
+    taille = Column(Integer)  # octets transmis
+    session_reutilisee = Column(Boolean)  # False si la connexion a été ouverte pour cet envoi
+    # Durées en millisecondes ; connexion, TLS et authentification seulement à l'ouverture d'une session
+    attente_ms = Column(Float)  # limiteur de débit
+    connexion_ms = Column(Float)
+    tls_ms = Column(Float)
+    auth_ms = Column(Float)
+    transfert_ms = Column(Float)
+    duree_ms = Column(Float)
+    
+    __table_args__ = (
+        Index('ix_mesures_envoi_date', 'date_envoi'),
+    )
+    
+    def __repr__(self):
+        return f"<MesureEnvoiEmail(type='{self.type_envoi}', succes={self.succes}, duree_ms={self.duree_ms})>"
+
+
+class DocumentFichier(Base):
+    """Modèle pour l'index des fichiers générés ou importés (quittances, attestations, factures)"""
+    __tablename__ = 'documents'
+    
+    id = Column(Integer, primary_key=True)
+    type_document = Column(String(20), nullable=False)  # 'quittance', 'attestation', 'facture'
+    locataire_id = Column(Integer, ForeignKey('locataires.id', ondelete='CASCADE'), nullable=True)
+    appartement_id = Column(Integer, ForeignKey('appartements.id', ondelete='CASCADE'), nullable=True)
+    paiement_id = Column(Integer, ForeignKey('paiements.id', ondelete='SET NULL'), nullable=True)
+    annee = Column(Integer, nullable=True)
+    mois = Column(Integer, nullable=True)  # 1-12, vide pour les documents annuels
+    chemin = Column(String(500), nullable=False, unique=True)
+    taille = Column(Integer)  # en octets
+    empreinte = Column(String(64))  # SHA-256 du contenu du fichier
+    created_at = Column(DateTime, default=datetime.now)
+    
+    __table_args__ = (
+        Index('ix_documents_locataire_periode', 'locataire_id', 'type_document', 'annee', 'mois'),
+        Index('ix_documents_appartement_periode', 'appartement_id', 'type_document', 'annee', 'mois'),
+    )
+    
+    def __repr__(self):
+        return f"<DocumentFichier(type='{self.type_document}', chemin='{self.chemin}')>"
@@ -2,17 +2,36 @@
 Module de génération de quittances
 """
 
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
 from docx import Document
+from docx.oxml.ns import qn
 from docx.shared import Pt, Inches
-from datetime import datetime
+from docx.table import Table
+from docx.text.paragraph import Paragraph
+from datetime import datetime, date
 from dateutil.relativedelta import relativedelta
+from functools import lru_cache
+from . import file_manager as fm
+from xml.sax.saxutils import escape as xml_escape
+import copy
+import hashlib
+import io
+import json
 import os
-import shutil
+import re
+import struct
+import threading
+import zipfile
+import zlib
 
 
-def generer_quittance_simple(locataire, chambre, appartement, paiement, mois, annee):
+def generer_quittance_simple(locataire, chambre, appartement, paiement, mois, annee, format='docx'):
     """
-    Génère une quittance de loyer simple en format Word
+    Génère une quittance de loyer simple en format Word ou PDF
+    
+    Le document est rendu en mémoire puis écrit directement dans le répertoire
+    du locataire.
     
     Args:
         locataire: Objet Locataire
@@ -21,17 +40,52 @@ def generer_quittance_simple(locataire, chambre, appartement, paiement, mois, an
         paiement: Objet Paiement
         mois: Numéro du mois (1-12)
         annee: Année
+        format: 'docx' (par défaut) ou 'pdf'
     
     Returns:
         Chemin du fichier généré
     """
+    contenu = render_quittance(locataire, None, chambre, appartement, paiement, mois, annee, format=format, modele='simple')
+    filename = nom_fichier_quittance(locataire, mois, annee, format=format, modele='simple')
+    return fm.save_quittance_file(contenu, filename, locataire.nom, annee, mois,
+                                  document=index_quittance(locataire, paiement, mois, annee))
+
+
+def index_quittance(locataire, paiement, mois, annee):
+    """Champs de la table documents pour une quittance"""
+    return {
+        'type_document': 'quittance',
+        'locataire_id': locataire.id,
+        'paiement_id': paiement.id,
+        'annee': annee,
+        'mois': mois,
+    }
+
+
+def _document_indexe(document, chemin, contenu):
+    """Ligne complète de la table documents, pour un enregistrement groupé"""
+    return dict(document, chemin=chemin, taille=len(contenu), empreinte=hashlib.sha256(contenu).hexdigest())
+
+
+def _nom_mois(mois):
+    """Nom français du mois (1-12)"""
     # Noms des mois en français
     mois_noms = [
         "Janvier", "Février", "Mars", "Avril", "Mai", "Juin",
         "Juillet", "Août", "Septembre", "Octobre", "Novembre", "Décembre"
     ]
     
-    mois_nom = mois_noms[mois - 1] if 1 <= mois <= 12 else str(mois)
+    return mois_noms[mois - 1] if 1 <= mois <= 12 else str(mois)
+
+
+def _rendre_quittance_simple(locataire, appartement, paiement, mois, annee, format='docx'):
+    """Rend la quittance simple en mémoire et retourne son contenu"""
+    mois_nom = _nom_mois(mois)
+    buffer = io.BytesIO()
+    
+    if format == 'pdf':
+        _quittance_simple_pdf(locataire, appartement, paiement, mois_nom, annee, buffer)
+        return buffer.getvalue()
     
     # Créer un nouveau document
     doc = Document()
@@ -104,21 +158,472 @@ def generer_quittance_simple(locataire, chambre, appartement, paiement, mois, an
     doc.add_paragraph()
     doc.add_paragraph('Signature du bailleur :')
     
-    # Créer le nom de fichier
-    safe_nom = locataire.nom.replace(' ', '_')
-    filename = f"Quittance_{safe_nom}_{mois_nom}_{annee}.docx"
-    temp_path = os.path.join("temp", filename)
+    # Sauvegarder le document
+    doc.save(buffer)
     
-    # Créer le dossier temp si nécessaire
-    os.makedirs("temp", exist_ok=True)
+    return buffer.getvalue()
+
+
+def render_quittance(locataire, bail, chambre, appartement, paiement, mois, annee, format='docx', modele='complet'):
+    """
+    Rend une quittance en mémoire, sans rien écrire sur disque
     
-    # Sauvegarder le document
-    doc.save(temp_path)
+    Args:
+        locataire, bail, chambre, appartement, paiement: Objets du paiement
+        mois: Numéro du mois (1-12)
+        annee: Année
+        format: 'docx' (par défaut) ou 'pdf'
+        modele: 'complet' (template du dossier exemple) ou 'simple'
+    
+    Returns:
+        bytes du document (le modèle simple est utilisé si aucun template n'existe)
+    """
+    _verifier_format(format)
+    
+    template = get_template_quittance() if modele == 'complet' else None
+    if template is None:
+        return _rendre_quittance_simple(locataire, appartement, paiement, mois, annee, format)
+    
+    replacements = _valeurs_quittance(locataire, appartement, paiement, mois, annee)
+    if format == 'docx':
+        return template.ooxml().rendre(replacements)
+    
+    buffer = io.BytesIO()
+    _document_vers_pdf(template.rendre(replacements), buffer)
+    return buffer.getvalue()
+
+
+def nom_fichier_quittance(locataire, mois, annee, format='docx', modele='complet'):
+    """Nom du fichier de quittance, selon le modèle utilisé"""
+    if modele == 'simple' or get_template_quittance() is None:
+        safe_nom = locataire.nom.replace(' ', '_')
+        return f"Quittance_{safe_nom}_{_nom_mois(mois)}_{annee}.{format}"
+    safe_nom = locataire.nom.replace(' ', '_').replace("'", "").replace('-', '_')
+    return f"quittance-{safe_nom.lower()}-{annee}{mois:02d}.{format}"
+
+
+# Variables reconnues dans le template de quittance
+PLACEHOLDERS = [
+    'DATE_DEBUT_MOIS',
+    'DATE_FIN_MOIS',
+    'DATE_DEBUT_SUIVANT_MOIS',
+    'DATE_FIN_SUIVANT_MOIS',
+    'ADRESSE_BIEN',
+    'NOM_LOCATAIRE',
+    'MT_LOYER',
+]
+
+TEMPLATE_DIR = os.path.join("documents", "exemple")
+
+RT_HEADER = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/header'
+RT_FOOTER = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/footer'
+
+
+def _valeurs_quittance(locataire, appartement, paiement, mois, annee):
+    """
+    Calcule les valeurs des variables du template pour un paiement
+    
+    Les valeurs sont brutes (dates, montant) : leur mise en forme est faite au
+    rendu par le moteur de variables, selon le formateur demandé par le template.
+    """
+    # Date début et fin du mois en cours
+    date_debut_mois = datetime(annee, mois, 1)
+    date_fin_mois = date_debut_mois + relativedelta(months=1) - relativedelta(days=1)
+    
+    # Date début et fin du mois suivant
+    date_debut_mois_suivant = date_debut_mois + relativedelta(months=1)
+    date_fin_mois_suivant = date_debut_mois + relativedelta(months=2) - relativedelta(days=1)
+    
+    # Préparer les valeurs de remplacement
+    nom_complet = locataire.nom
+    adresse_complete = f"{appartement.adresse}, {appartement.code_postal} {appartement.ville}"
+    
+    # Utiliser le montant du paiement pour avoir le montant historique correct
+    # et non le montant actuel du bail qui peut avoir changé
+    montant_loyer = paiement.montant
+    
+    return {
+        'DATE_DEBUT_MOIS': date_debut_mois,
+        'DATE_FIN_MOIS': date_fin_mois,
+        'DATE_DEBUT_SUIVANT_MOIS': date_debut_mois_suivant,
+        'DATE_FIN_SUIVANT_MOIS': date_fin_mois_suivant,
+        'ADRESSE_BIEN': adresse_complete,
+        'NOM_LOCATAIRE': nom_complet,
+        'MT_LOYER': montant_loyer,
+    }
+
+
+def _formater_date(valeur, motif):
+    return valeur.strftime(motif)
+
+
+# Formateurs utilisables dans le template : {MT_LOYER|lettres}, {DATE_FIN_MOIS|long}...
+# Un formateur contenant '%' est un format strftime : {DATE_DEBUT_MOIS|%d.%m.%y}
+FORMATEURS = {
+    'montant': lambda valeur: f"{valeur:.2f} €",
+    'nombre': lambda valeur: f"{valeur:.2f}",
+    'lettres': lambda valeur: nombre_en_lettres(valeur),
+    'court': lambda valeur: _formater_date(valeur, '%d/%m/%Y'),
+    'long': lambda valeur: f"{valeur.day} {_nom_mois(valeur.month).lower()} {valeur.year}",
+    'mois': lambda valeur: f"{_nom_mois(valeur.month).lower()} {valeur.year}",
+    'iso': lambda valeur: _formater_date(valeur, '%Y-%m-%d'),
+    'majuscules': lambda valeur: str(valeur).upper(),
+    'minuscules': lambda valeur: str(valeur).lower(),
+}
+
+
+class MoteurVariables:
+    """
+    Moteur de substitution des variables d'un template, compilé une fois.
+    
+    Toutes les variables sont réunies dans une seule expression régulière
+    (alternative), ce qui permet de remplacer un texte en une passe, quel que
+    soit le nombre de variables. Deux syntaxes sont reconnues : le nom nu
+    (MT_LOYER, syntaxe historique des templates) et le nom entre accolades,
+    éventuellement suivi d'un formateur ({MT_LOYER|lettres}).
+    """
+    
+    def __init__(self, cles):
+        self.cles = list(cles)
+        alternative = '|'.join(re.escape(cle) for cle in sorted(self.cles, key=len, reverse=True))
+        self.motif = re.compile(r'\{\s*(' + alternative + r')\s*(?:\|\s*([^{}|]*?)\s*)?\}|(' + alternative + ')')
+    
+    def contient(self, texte):
+        return self.motif.search(texte) is not None
+    
+    def analyser(self, variable):
+        """Décompose une variable du template en (clé, formateur ou None)"""
+        m = self.motif.fullmatch(variable)
+        if m is None:
+            raise ValueError(f"Variable de template invalide : {variable}")
+        return (m.group(1) or m.group(3)), (m.group(2) or None)
+    
+    @staticmethod
+    def formater(valeur, formateur=None):
+        """Met en forme une valeur, par défaut comme les quittances historiques"""
+        if formateur is None:
+            if isinstance(valeur, (datetime, date)):
+                return valeur.strftime('%d/%m/%Y')
+            if isinstance(valeur, (int, float)):
+                return f"{valeur:.2f} €"
+            return str(valeur)
+        if '%' in formateur:
+            return valeur.strftime(formateur)
+        if formateur not in FORMATEURS:
+            raise ValueError(f"Formateur de template inconnu : {formateur} (attendu : {', '.join(FORMATEURS)})")
+        return FORMATEURS[formateur](valeur)
+    
+    def valeur(self, m, valeurs):
+        """Texte de remplacement d'une correspondance du motif"""
+        cle = m.group(1) or m.group(3)
+        if cle not in valeurs:
+            return m.group(0)
+        return self.formater(valeurs[cle], m.group(2) or None)
+    
+    def remplacer(self, texte, valeurs):
+        """Remplace toutes les variables d'un texte en une seule passe"""
+        return self.motif.sub(lambda m: self.valeur(m, valeurs), texte)
+    
+    def remplacer_dans_runs(self, paragraph, valeurs=None):
+        """
+        Remplace les variables d'un paragraphe en gardant le formatage des runs
+        
+        Le texte de la variable va dans le run où elle commence, et seuls les
+        morceaux de variable sont retirés des runs suivants : une variable
+        coupée entre plusieurs runs par Word est donc bien reconnue, et le
+        reste du paragraphe garde sa mise en forme. Sans valeurs, chaque
+        variable est seulement regroupée dans son premier run.
+        """
+        runs = paragraph.runs
+        textes = [run.text for run in runs]
+        debuts = []
+        position = 0
+        for texte in textes:
+            debuts.append(position)
+            position += len(texte)
+        
+        correspondances = list(self.motif.finditer(''.join(textes)))
+        if not correspondances:
+            return
+        
+        modifies = set()
+        # De droite à gauche : les positions d'origine restent valables
+        for m in reversed(correspondances):
+            remplacement = m.group(0) if valeurs is None else self.valeur(m, valeurs)
+            # Runs qui contiennent le premier et le dernier caractère de la variable
+            i = bisect_right(debuts, m.start()) - 1
+            j = bisect_right(debuts, m.end() - 1) - 1
+            if i == j:
+                textes[i] = textes[i][:m.start() - debuts[i]] + remplacement + textes[i][m.end() - debuts[i]:]
+            else:
+                textes[i] = textes[i][:m.start() - debuts[i]] + remplacement
+                for k in range(i + 1, j):
+                    textes[k] = ''
+                textes[j] = textes[j][m.end() - debuts[j]:]
+            modifies.update(range(i, j + 1))
+        
+        for k in sorted(modifies):
+            if runs[k].text != textes[k]:
+                runs[k].text = textes[k]
+
+
+MOTEUR_QUITTANCE = MoteurVariables(PLACEHOLDERS)
+
+
+def _remplacer_dans_runs(paragraph, replacements):
+    """Remplace les variables dans les runs d'un paragraphe en gardant le formatage"""
+    MOTEUR_QUITTANCE.remplacer_dans_runs(paragraph, replacements)
+
+
+class TemplateQuittance:
+    """
+    Template de quittance chargé et analysé une seule fois.
+    
+    Le document est parsé au chargement et les paragraphes contenant des
+    variables (corps, tableaux, en-têtes, pieds de page) sont repérés par leur
+    chemin XPath. Chaque rendu copie le document en mémoire et ne modifie que
+    ces paragraphes.
+    """
+    
+    def __init__(self, chemin):
+        self.chemin = chemin
+        self.mtime = os.path.getmtime(chemin)
+        with open(chemin, 'rb') as f:
+            contenu = f.read()
+        self.empreinte = hashlib.sha256(contenu).hexdigest()
+        self.document = Document(io.BytesIO(contenu))
+        self.emplacements = self._analyser()
+        self._ooxml = None
+        self._ooxml_lock = threading.Lock()
+    
+    def _parties(self, document):
+        """Parties XML du document à traiter : corps, en-têtes et pieds de page"""
+        parties = [(None, document.part)]
+        for rel_id, rel in document.part.rels.items():
+            if rel.reltype in (RT_HEADER, RT_FOOTER):
+                parties.append((rel_id, rel.target_part))
+        return parties
+    
+    def _analyser(self):
+        """Repère les paragraphes qui contiennent au moins une variable"""
+        emplacements = []
+        for rel_id, partie in self._parties(self.document):
+            racine = partie.element
+            arbre = racine.getroottree()
+            for p in racine.iter(qn('w:p')):
+                texte = Paragraph(p, None).text
+                if MOTEUR_QUITTANCE.contient(texte):
+                    emplacements.append((rel_id, arbre.getpath(p)))
+        return emplacements
+    
+    def ooxml(self):
+        """Version compilée du template pour le rendu OOXML direct (construite au premier appel)"""
+        with self._ooxml_lock:
+            if self._ooxml is None:
+                self._ooxml = TemplateOOXML(self)
+            return self._ooxml
+    
+    def rendre(self, replacements):
+        """Retourne une copie du document avec les variables remplacées"""
+        doc = copy.deepcopy(self.document)
+        parties = dict(self._parties(doc))
+        for rel_id, chemin in self.emplacements:
+            racine = parties[rel_id].element
+            namespaces = {prefixe: uri for prefixe, uri in racine.nsmap.items() if prefixe}
+            for p in racine.getroottree().xpath(chemin, namespaces=namespaces):
+                _remplacer_dans_runs(Paragraph(p, None), replacements)
+        return doc
+
+
+class TemplateOOXML:
+    """
+    Template de quittance pré-découpé pour un rendu sans python-docx.
+    
+    À la compilation, chaque variable coupée entre plusieurs runs est regroupée
+    dans son premier run (comme le fait le rendu python-docx), puis remplacée
+    dans le texte du run par un repère numéroté. Seuls les runs des
+    paragraphes repérés par TemplateQuittance sont touchés : un signet ou un
+    champ nommé comme une variable (attribut, instruction) reste intact. Le
+    document est sérialisé une fois et le XML du corps, des en-têtes et des
+    pieds de page est découpé aux repères, avec les variables déjà
+    décomposées en (clé, formateur). Un rendu ne fait plus qu'assembler les
+    morceaux avec les valeurs mises en forme et échappées, puis écrire l'archive.
+    """
+    
+    def __init__(self, template):
+        doc = copy.deepcopy(template.document)
+        parties = dict(template._parties(doc))
+        noms_parties = {str(partie.partname).lstrip('/') for partie in parties.values()}
+        
+        # Variables : (clé, formateur, texte d'origine), dans l'ordre des repères
+        variables = []
+        
+        def reperer(m):
+            variables.append(MOTEUR_QUITTANCE.analyser(m.group(0)) + (m.group(0),))
+            return f"{REPERE_DEBUT}{len(variables) - 1}{REPERE_FIN}"
+        
+        # Regrouper chaque variable dans le run où elle commence, puis la remplacer par son repère
+        for rel_id, chemin in template.emplacements:
+            racine = parties[rel_id].element
+            namespaces = {prefixe: uri for prefixe, uri in racine.nsmap.items() if prefixe}
+            for p in racine.getroottree().xpath(chemin, namespaces=namespaces):
+                paragraphe = Paragraph(p, None)
+                MOTEUR_QUITTANCE.remplacer_dans_runs(paragraphe)
+                for run in paragraphe.runs:
+                    texte = run.text
+                    if MOTEUR_QUITTANCE.contient(texte):
+                        run.text = MOTEUR_QUITTANCE.motif.sub(reperer, texte)
+        
+        buffer = io.BytesIO()
+        doc.save(buffer)
+        
+        # Chaque entrée : (ZipInfo, entrée ZIP pré-compressée ou None, morceaux ou None).
+        # Les parties statiques (styles, thème...) sont compressées une seule fois ici.
+        self.entrees = []
+        with zipfile.ZipFile(io.BytesIO(buffer.getvalue())) as archive:
+            for info in archive.infolist():
+                contenu = archive.read(info)
+                if info.filename in noms_parties:
+                    xml = contenu.decode('utf-8')
+                    morceaux = []
+                    position = 0
+                    for m in _MOTIF_REPERE.finditer(xml):
+                        morceaux.append(xml[position:m.start()])
+                        morceaux.append(variables[int(m.group(1))])
+                        position = m.end()
+                    morceaux.append(xml[position:])
+                    if len(morceaux) > 1:
+                        self.entrees.append((info, None, morceaux))
+                        continue
+                self.entrees.append((info, _compresser_entree_zip(info, contenu), None))
     
-    return temp_path
+    def rendre(self, replacements):
+        """
+        Retourne le contenu .docx avec les variables remplacées
+        
+        Returns:
+            bytes du fichier .docx
+        """
+        valeurs = {}
+        
+        def valeur(variable):
+            # Chaque couple (clé, formateur) n'est mis en forme qu'une fois par rendu
+            if variable not in valeurs:
+                cle, formateur, texte = variable
+                if cle in replacements:
+                    valeurs[variable] = xml_escape(MOTEUR_QUITTANCE.formater(replacements[cle], formateur))
+                else:
+                    valeurs[variable] = texte
+            return valeurs[variable]
+        
+        blocs = []
+        repertoire = []
+        position = 0
+        for info, entree, morceaux in self.entrees:
+            if morceaux is not None:
+                # Les morceaux impairs sont les variables
+                contenu = ''.join(
+                    morceau if i % 2 == 0 else valeur(morceau)
+                    for i, morceau in enumerate(morceaux)
+                ).encode('utf-8')
+                entree = _compresser_entree_zip(info, contenu)
+            en_tete_local, donnees, champs_centraux, nom = entree
+            repertoire.append(struct.pack(_ZIP_CENTRAL, 0x02014b50, 20, *champs_centraux, position) + nom)
+            blocs.append(en_tete_local)
+            blocs.append(donnees)
+            position += len(en_tete_local) + len(donnees)
+        
+        taille_repertoire = sum(len(r) for r in repertoire)
+        fin = struct.pack(_ZIP_FIN, 0x06054b50, 0, 0, len(repertoire), len(repertoire), taille_repertoire, position, 0)
+        return b''.join(blocs + repertoire + [fin])
+
+
+# Repère d'une variable dans le XML compilé : numéro entre deux caractères à
+# usage privé, qu'un template n'utilise pas
+REPERE_DEBUT = '\ue000'
+REPERE_FIN = '\ue001'
+_MOTIF_REPERE = re.compile(REPERE_DEBUT + r'(\d+)' + REPERE_FIN)
+
+# Structures ZIP (APPNOTE 4.3.7, 4.3.12 et 4.3.16)
+_ZIP_LOCAL = '<IHHHHHIIIHH'
+_ZIP_CENTRAL = '<IHHHHHHIIIHHHHHII'
+_ZIP_FIN = '<IHHHHIIH'
 
 
-def generer_quittance_complete(locataire, bail, chambre, appartement, paiement, mois, annee, notes_supplementaires=""):
+def _compresser_entree_zip(info, contenu):
+    """
+    Compresse une entrée d'archive et prépare ses en-têtes
+    
+    Returns:
+        tuple (en-tête local + nom, données compressées, champs de l'en-tête central, nom)
+    """
+    compresseur = zlib.compressobj(6, zlib.DEFLATED, -15)
+    donnees = compresseur.compress(contenu) + compresseur.flush()
+    nom = info.filename.encode('utf-8')
+    drapeaux = 0x800 if not info.filename.isascii() else 0
+    annee, mois, jour, heure, minute, seconde = info.date_time
+    heure_dos = (heure << 11) | (minute << 5) | (seconde // 2)
+    date_dos = ((annee - 1980) << 9) | (mois << 5) | jour
+    crc = zlib.crc32(contenu)
+    en_tete_local = struct.pack(
+        _ZIP_LOCAL, 0x04034b50, 20, drapeaux, zipfile.ZIP_DEFLATED, heure_dos, date_dos,
+        crc, len(donnees), len(contenu), len(nom), 0
+    ) + nom
+    # version requise, drapeaux, méthode, heure, date, crc, tailles, longueurs nom/extra/commentaire, disque, attributs
+    champs_centraux = (20, drapeaux, zipfile.ZIP_DEFLATED, heure_dos, date_dos, crc, len(donnees), len(contenu),
+                       len(nom), 0, 0, 0, 0, 0)
+    return en_tete_local, donnees, champs_centraux, nom
+
+
+_templates_cache = {}
+_templates_cache_lock = threading.Lock()
+
+
+def get_template_quittance(exemple_dir=TEMPLATE_DIR):
+    """
+    Retourne le template de quittance du dossier, depuis le cache si possible.
+    
+    Le dossier n'est relu que si sa date de modification change (fichier ajouté
+    ou supprimé), et le template n'est rechargé que si sa propre date change.
+    
+    Returns:
+        TemplateQuittance, ou None si aucun template .docx n'est présent
+    """
+    try:
+        mtime_dossier = os.path.getmtime(exemple_dir)
+    except OSError:
+        return None
+    
+    with _templates_cache_lock:
+        entree = _templates_cache.get(exemple_dir)
+        
+        if entree is None or entree['mtime_dossier'] != mtime_dossier:
+            # Chercher le premier fichier .docx dans le dossier exemple
+            template_path = None
+            for file in sorted(os.listdir(exemple_dir)):
+                if file.endswith('.docx') and not file.startswith('~'):
+                    template_path = os.path.join(exemple_dir, file)
+                    break
+            entree = {'mtime_dossier': mtime_dossier, 'chemin': template_path, 'template': None}
+            _templates_cache[exemple_dir] = entree
+        
+        if entree['chemin'] is None:
+            return None
+        
+        try:
+            mtime_template = os.path.getmtime(entree['chemin'])
+        except OSError:
+            del _templates_cache[exemple_dir]
+            return None
+        
+        if entree['template'] is None or entree['template'].mtime != mtime_template:
+            entree['template'] = TemplateQuittance(entree['chemin'])
+        
+        return entree['template']
+
+
+def generer_quittance_complete(locataire, bail, chambre, appartement, paiement, mois, annee, notes_supplementaires="",
+                               format='docx'):
     """
     Génère une quittance complète à partir du template
     
@@ -131,120 +636,112 @@ def generer_quittance_complete(locataire, bail, chambre, appartement, paiement,
         mois: Numéro du mois (1-12)
         annee: Année
         notes_supplementaires: Notes optionnelles
+        format: 'docx' (par défaut) ou 'pdf'
     
     Returns:
         Chemin du fichier généré
     """
-    # Noms des mois en français
-    mois_noms = [
-        "Janvier", "Février", "Mars", "Avril", "Mai", "Juin",
-        "Juillet", "Août", "Septembre", "Octobre", "Novembre", "Décembre"
-    ]
+    _verifier_format(format)
     
-    mois_nom = mois_noms[mois - 1] if 1 <= mois <= 12 else str(mois)
+    template = get_template_quittance()
     
-    # Chercher le template dans le dossier exemple
-    exemple_dir = os.path.join("documents", "exemple")
-    template_path = None
+    if template is None:
+        # Si le template n'existe pas, créer une quittance simple
+        return generer_quittance_simple(locataire, chambre, appartement, paiement, mois, annee, format=format)
     
-    # Chercher le premier fichier .docx dans le dossier exemple
-    if os.path.exists(exemple_dir):
-        for file in os.listdir(exemple_dir):
-            if file.endswith('.docx') and not file.startswith('~'):
-                template_path = os.path.join(exemple_dir, file)
-                break
+    replacements = _valeurs_quittance(locataire, appartement, paiement, mois, annee)
+    doc = template.rendre(replacements)
     
-    if not template_path or not os.path.exists(template_path):
-        # Si le template n'existe pas, créer une quittance simple
-        return generer_quittance_simple(locataire, chambre, appartement, paiement, mois, annee)
+    # Rendre en mémoire puis écrire le fichier en une fois
+    buffer = io.BytesIO()
+    if format == 'pdf':
+        _document_vers_pdf(doc, buffer)
+    else:
+        doc.save(buffer)
     
-    # Charger le template
-    doc = Document(template_path)
+    output_path = _chemin_quittance(locataire, mois, annee, extension=format)
+    fm.ecrire_fichier_atomique(buffer.getvalue(), output_path,
+                               document=index_quittance(locataire, paiement, mois, annee))
     
-    # Calculer les dates
-    # Date début du mois en cours
-    date_debut_mois = datetime(annee, mois, 1)
+    return output_path
+
+
+def generer_quittance_ooxml(locataire, bail, chambre, appartement, paiement, mois, annee, notes_supplementaires=""):
+    """
+    Génère une quittance complète en écrivant directement l'archive OOXML
     
-    # Date fin du mois en cours
-    if mois == 12:
-        date_fin_mois = datetime(annee + 1, 1, 1) - relativedelta(days=1)
-        mois_suivant = 1
-        annee_suivante = annee + 1
-    else:
-        date_fin_mois = datetime(annee, mois + 1, 1) - relativedelta(days=1)
-        mois_suivant = mois + 1
-        annee_suivante = annee
+    Même résultat que generer_quittance_complete, sans construire l'arbre
+    python-docx à chaque quittance : les parties XML pré-découpées du template
+    sont assemblées avec les valeurs échappées.
     
-    # Date début du mois suivant
-    date_debut_mois_suivant = datetime(annee_suivante, mois_suivant, 1)
+    Returns:
+        Chemin du fichier généré
+    """
+    if get_template_quittance() is None:
+        # Si le template n'existe pas, créer une quittance simple
+        return generer_quittance_simple(locataire, chambre, appartement, paiement, mois, annee)
     
-    # Date fin du mois suivant
-    if mois_suivant == 12:
-        date_fin_mois_suivant = datetime(annee_suivante + 1, 1, 1) - relativedelta(days=1)
-    else:
-        date_fin_mois_suivant = datetime(annee_suivante, mois_suivant + 1, 1) - relativedelta(days=1)
+    contenu = render_quittance(locataire, bail, chambre, appartement, paiement, mois, annee)
     
-    # Préparer les valeurs de remplacement
-    nom_complet = locataire.nom
-    adresse_complete = f"{appartement.adresse}, {appartement.code_postal} {appartement.ville}"
+    output_path = _chemin_quittance(locataire, mois, annee)
+    fm.ecrire_fichier_atomique(contenu, output_path, document=index_quittance(locataire, paiement, mois, annee))
     
-    # Utiliser le montant du paiement pour avoir le montant historique correct
-    # et non le montant actuel du bail qui peut avoir changé
-    montant_loyer = paiement.montant
+    return output_path
+
+
+def empreinte_quittance(locataire, appartement, paiement, mois, annee, format='docx'):
+    """
+    Empreinte SHA-256 des données qui entrent dans le rendu d'une quittance
     
-    # Dictionnaire de remplacement avec les nouvelles variables
-    replacements = {
-        'DATE_DEBUT_MOIS': date_debut_mois.strftime('%d/%m/%Y'),
-        'DATE_FIN_MOIS': date_fin_mois.strftime('%d/%m/%Y'),
-        'DATE_DEBUT_SUIVANT_MOIS': date_debut_mois_suivant.strftime('%d/%m/%Y'),
-        'DATE_FIN_SUIVANT_MOIS': date_fin_mois_suivant.strftime('%d/%m/%Y'),
-        'ADRESSE_BIEN': adresse_complete,
-        'NOM_LOCATAIRE': nom_complet,
-        'MT_LOYER': f"{montant_loyer:.2f} €",
+    Montant, dates, nom du locataire, adresse, format et empreinte du template :
+    toute modification de l'un d'eux change l'empreinte.
+    """
+    template = get_template_quittance()
+    donnees = {
+        'valeurs': {cle: MoteurVariables.formater(valeur)
+                    for cle, valeur in _valeurs_quittance(locataire, appartement, paiement, mois, annee).items()},
+        'date_paiement': paiement.date_paiement.isoformat() if paiement.date_paiement else None,
+        'mode_paiement': paiement.mode_paiement,
+        'format': format,
+        'template': template.empreinte if template is not None else 'simple',
     }
+    return hashlib.sha256(json.dumps(donnees, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def generer_quittance_si_necessaire(locataire, bail, chambre, appartement, paiement, mois, annee, format='docx',
+                                    indexer=True):
+    """
+    Génère la quittance seulement si ses données ont changé depuis le dernier rendu
     
-    # Fonction pour remplacer dans un texte en gardant le formatage
-    def remplacer_dans_runs(paragraph):
-        """Remplace les variables dans les runs d'un paragraphe en gardant le formatage"""
-        texte_complet = paragraph.text
-        texte_modifie = texte_complet
-        
-        # Remplacer toutes les variables
-        for key, value in replacements.items():
-            texte_modifie = texte_modifie.replace(key, str(value))
-        
-        # Si le texte a changé, le remplacer
-        if texte_modifie != texte_complet:
-            # Garder le premier run et supprimer les autres
-            for run in paragraph.runs[1:]:
-                run.text = ''
-            
-            # Mettre le nouveau texte dans le premier run
-            if paragraph.runs:
-                paragraph.runs[0].text = texte_modifie
-    
-    # Remplacer dans tous les paragraphes
-    for paragraph in doc.paragraphs:
-        remplacer_dans_runs(paragraph)
-    
-    # Remplacer dans tous les tableaux
-    for table in doc.tables:
-        for row in table.rows:
-            for cell in row.cells:
-                for paragraph in cell.paragraphs:
-                    remplacer_dans_runs(paragraph)
-    
-    # Remplacer dans les en-têtes
-    for section in doc.sections:
-        if section.header:
-            for paragraph in section.header.paragraphs:
-                remplacer_dans_runs(paragraph)
-        
-        # Remplacer dans les pieds de page
-        if section.footer:
-            for paragraph in section.footer.paragraphs:
-                remplacer_dans_runs(paragraph)
+    Si l'empreinte enregistrée sur le paiement est identique et que le fichier
+    existe toujours à chemin_quittance, ce fichier est renvoyé tel quel.
+    Sinon la quittance est rendue en mémoire puis écrite de façon atomique,
+    avec sa ligne dans la table documents (sauf indexer=False : l'appelant
+    enregistre alors l'index lui-même, par exemple en lot).
+    
+    Returns:
+        tuple (chemin, empreinte, contenu) : contenu est le document rendu
+        (bytes), ou None si le fichier existant a été réutilisé
+    """
+    empreinte = empreinte_quittance(locataire, appartement, paiement, mois, annee, format)
+    
+    if (getattr(paiement, 'empreinte_quittance', None) == empreinte
+            and paiement.chemin_quittance and os.path.exists(paiement.chemin_quittance)):
+        return paiement.chemin_quittance, empreinte, None
     
+    contenu = render_quittance(locataire, bail, chambre, appartement, paiement, mois, annee, format=format)
+    document = index_quittance(locataire, paiement, mois, annee) if indexer else None
+    if get_template_quittance() is None:
+        filename = nom_fichier_quittance(locataire, mois, annee, format=format, modele='simple')
+        chemin = fm.save_quittance_file(contenu, filename, locataire.nom, annee, mois, document=document)
+    else:
+        chemin = _chemin_quittance(locataire, mois, annee, extension=format)
+        fm.ecrire_fichier_atomique(contenu, chemin, document=document)
+    return chemin, empreinte, contenu
+
+
+def _chemin_quittance(locataire, mois, annee, extension='docx'):
+    """Chemin de sortie d'une quittance complète, répertoire créé si nécessaire"""
     # Créer le répertoire de destination
     safe_nom = locataire.nom.replace(' ', '_').replace("'", "").replace('-', '_')
     annee_str = str(annee)
@@ -254,18 +751,437 @@ def generer_quittance_complete(locataire, bail, chambre, appartement, paiement,
     os.makedirs(quittance_dir, exist_ok=True)
     
     # Nom du fichier de sortie : quittance-nomlocataire-yyyymm.docx
-    filename = f"quittance-{safe_nom.lower()}-{annee}{mois:02d}.docx"
-    output_path = os.path.join(quittance_dir, filename)
+    filename = nom_fichier_quittance(locataire, mois, annee, format=extension)
+    return os.path.join(quittance_dir, filename)
+
+
+# ==================== PDF ====================
+
+FORMATS_QUITTANCE = ('docx', 'pdf')
+
+# Police TrueType embarquée dans les PDF (Bitstream Vera, fournie avec reportlab, par défaut)
+PDF_FONT = os.getenv('LOCATOR_PDF_FONT', '')
+PDF_FONT_BOLD = os.getenv('LOCATOR_PDF_FONT_BOLD', '')
+
+
+def _verifier_format(format):
+    if format not in FORMATS_QUITTANCE:
+        raise ValueError(f"Format de quittance inconnu : {format} (attendu : {', '.join(FORMATS_QUITTANCE)})")
+
+
+@lru_cache(maxsize=None)
+def _styles_pdf():
+    """
+    Enregistre les polices et prépare les styles PDF, une seule fois par processus.
     
-    # Sauvegarder le document
-    doc.save(output_path)
+    Les fichiers TrueType ne sont lus et analysés qu'ici ; chaque PDF n'embarque
+    ensuite que le sous-ensemble de glyphes qu'il utilise.
+    """
+    try:
+        import reportlab
+        from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+        from reportlab.pdfbase import pdfmetrics
+        from reportlab.pdfbase.ttfonts import TTFont
+    except ImportError:
+        raise ImportError("La génération PDF nécessite reportlab : pip install reportlab")
     
-    return output_path
+    dossier_polices = os.path.join(os.path.dirname(reportlab.__file__), 'fonts')
+    pdfmetrics.registerFont(TTFont('Locator', PDF_FONT or os.path.join(dossier_polices, 'Vera.ttf')))
+    pdfmetrics.registerFont(TTFont('Locator-Bold', PDF_FONT_BOLD or os.path.join(dossier_polices, 'VeraBd.ttf')))
+    pdfmetrics.registerFontFamily('Locator', normal='Locator', bold='Locator-Bold',
+                                  italic='Locator', boldItalic='Locator-Bold')
+    
+    base = getSampleStyleSheet()
+    return {
+        'normal': ParagraphStyle('QuittanceNormal', parent=base['Normal'], fontName='Locator', fontSize=10, leading=14),
+        'gras': ParagraphStyle('QuittanceGras', parent=base['Normal'], fontName='Locator-Bold', fontSize=10, leading=14),
+        'titre': ParagraphStyle('QuittanceTitre', parent=base['Title'], fontName='Locator-Bold', fontSize=18, leading=22),
+        'intertitre': ParagraphStyle('QuittanceIntertitre', parent=base['Heading2'], fontName='Locator-Bold', fontSize=13, leading=16),
+    }
 
 
+def _style_pdf(nom, alignement=None):
+    """Style PDF, éventuellement aligné (valeurs python-docx : 1 centré, 2 droite, 3 justifié)"""
+    from reportlab.lib.enums import TA_CENTER, TA_RIGHT, TA_JUSTIFY
+    
+    style = _styles_pdf()[nom]
+    correspondance = {1: TA_CENTER, 2: TA_RIGHT, 3: TA_JUSTIFY}
+    if alignement is None or int(alignement) not in correspondance:
+        return style
+    return _style_aligne(nom, correspondance[int(alignement)])
+
+
+@lru_cache(maxsize=None)
+def _style_aligne(nom, alignement):
+    from reportlab.lib.styles import ParagraphStyle
+    return ParagraphStyle(f"{_styles_pdf()[nom].name}_{alignement}", parent=_styles_pdf()[nom], alignment=alignement)
+
+
+def _paragraphe_pdf(texte, style):
+    from reportlab.platypus import Paragraph as ParagraphPDF, Spacer
+    
+    if not texte.strip():
+        return Spacer(1, 8)
+    return ParagraphPDF(xml_escape(texte).replace('\n', '<br/>'), style)
+
+
+def _tableau_pdf(lignes):
+    from reportlab.lib import colors
+    from reportlab.platypus import Table as TablePDF, TableStyle
+    
+    style = _styles_pdf()['normal']
+    tableau = TablePDF([[_paragraphe_pdf(cellule, style) for cellule in ligne] for ligne in lignes])
+    tableau.setStyle(TableStyle([
+        ('GRID', (0, 0), (-1, -1), 0.5, colors.grey),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+    ]))
+    return tableau
+
+
+def _ecrire_pdf(destination, elements, en_tete='', pied_de_page=''):
+    """Construit le PDF (chemin ou flux binaire) à partir d'éléments platypus, avec en-tête et pied de page texte"""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.units import cm
+    from reportlab.platypus import SimpleDocTemplate
+    
+    def decorer_page(canvas, document):
+        canvas.saveState()
+        canvas.setFont('Locator', 8)
+        if en_tete:
+            canvas.drawCentredString(A4[0] / 2, A4[1] - 1.2 * cm, en_tete)
+        if pied_de_page:
+            canvas.drawCentredString(A4[0] / 2, 1.2 * cm, pied_de_page)
+        canvas.restoreState()
+    
+    document = SimpleDocTemplate(destination, pagesize=A4, leftMargin=2.5 * cm, rightMargin=2.5 * cm,
+                                 topMargin=2.5 * cm, bottomMargin=2.5 * cm, title="Quittance de loyer")
+    document.build(elements, onFirstPage=decorer_page, onLaterPages=decorer_page)
+
+
+def _quittance_simple_pdf(locataire, appartement, paiement, mois_nom, annee, destination):
+    """Version PDF de la quittance simple (même contenu que le document Word)"""
+    normal = _style_pdf('normal')
+    
+    elements = [_paragraphe_pdf('QUITTANCE DE LOYER', _style_pdf('titre')), _paragraphe_pdf('', normal)]
+    lignes = [
+        'Le bailleur :', '[Votre nom]', '[Votre adresse]', '',
+        'Certifie avoir reçu de :', locataire.nom, appartement.adresse,
+        f'{appartement.code_postal} {appartement.ville}', '',
+        f'La somme de : {paiement.montant:.2f} €',
+        f'Pour la période du : {mois_nom} {annee}', '',
+        'Au titre de :',
+    ]
+    elements.extend(_paragraphe_pdf(ligne, normal) for ligne in lignes)
+    elements.append(_tableau_pdf([
+        ['Loyer et charges', f'{paiement.montant:.2f} €'],
+        ['TOTAL', f'{paiement.montant:.2f} €'],
+    ]))
+    elements.append(_paragraphe_pdf('', normal))
+    
+    if paiement.date_paiement:
+        elements.append(_paragraphe_pdf(f'Date du paiement : {paiement.date_paiement.strftime("%d/%m/%Y")}', normal))
+    if paiement.mode_paiement:
+        elements.append(_paragraphe_pdf(f'Mode de paiement : {paiement.mode_paiement}', normal))
+    
+    elements.extend([
+        _paragraphe_pdf('', normal),
+        _paragraphe_pdf(f'Fait à [Ville], le {datetime.now().strftime("%d/%m/%Y")}', normal),
+        _paragraphe_pdf('', normal),
+        _paragraphe_pdf('Signature du bailleur :', normal),
+    ])
+    
+    _ecrire_pdf(destination, elements)
+
+
+def _document_vers_pdf(doc, destination):
+    """
+    Convertit un document python-docx rendu en PDF, sans suite bureautique.
+    
+    Le contenu (paragraphes, tableaux, en-tête et pied de page) est repris dans
+    l'ordre du document avec une mise en forme simplifiée : titres, gras et
+    alignement sont conservés, la mise en page fine du Word ne l'est pas.
+    """
+    elements = []
+    for bloc in doc.iter_inner_content():
+        if isinstance(bloc, Table):
+            elements.append(_tableau_pdf([[cellule.text for cellule in ligne.cells] for ligne in bloc.rows]))
+            continue
+        
+        # Identifiant brut du style : résoudre bloc.style parcourt toute la feuille de styles
+        nom_style = bloc._p.style or ''
+        if nom_style.startswith('Title'):
+            style = 'titre'
+        elif nom_style.startswith('Heading'):
+            style = 'intertitre'
+        elif bloc.runs and all(run.bold for run in bloc.runs if run.text):
+            style = 'gras'
+        else:
+            style = 'normal'
+        elements.append(_paragraphe_pdf(bloc.text, _style_pdf(style, bloc.alignment)))
+    
+    section = doc.sections[0]
+    en_tete = '' if section.header.is_linked_to_previous else ' '.join(p.text for p in section.header.paragraphs).strip()
+    pied_de_page = '' if section.footer.is_linked_to_previous else ' '.join(p.text for p in section.footer.paragraphs).strip()
+    
+    _ecrire_pdf(destination, elements, en_tete, pied_de_page)
+
+
+def _generer_quittance_lot(args):
+    """Point d'entrée des processus de génération par lot"""
+    paiement, locataire, chambre, appartement, format = args
+    try:
+        chemin, empreinte, contenu = generer_quittance_si_necessaire(
+            locataire=locataire,
+            bail=None,
+            chambre=chambre,
+            appartement=appartement,
+            paiement=paiement,
+            mois=paiement.mois,
+            annee=paiement.annee,
+            format=format,
+            indexer=False
+        )
+        # L'index est enregistré par le processus parent, en une seule écriture
+        document = None
+        if contenu is not None:
+            document = _document_indexe(index_quittance(locataire, paiement, paiement.mois, paiement.annee),
+                                        chemin, contenu)
+        return paiement.id, chemin, empreinte, document, None
+    except Exception as e:
+        return paiement.id, None, None, None, str(e)
+
+
+def generer_quittances_mois(mois, annee, appartement_id=None, max_workers=None, format='docx'):
+    """
+    Génère en parallèle les quittances d'un mois dont les données ont changé
+    
+    Tous les paiements payés de la période sont examinés : ceux dont
+    l'empreinte correspond au fichier existant sont ignorés, les autres sont
+    rendus sur un pool de processus (moteur OOXML direct pour le .docx), puis
+    chemins, dates et empreintes sont enregistrés en une seule mise à jour,
+    et les fichiers dans la table documents en une seule insertion.
+    Relancer le lot sans changement ne génère donc rien.
+    
+    Args:
+        mois: Mois de la période
+        annee: Année de la période
+        appartement_id: Limiter à un appartement (optionnel)
+        max_workers: Nombre de processus (nombre de CPU par défaut)
+        format: 'docx' (par défaut) ou 'pdf'
+    
+    Returns:
+        dict avec 'generees' ({paiement_id: chemin}), 'inchangees' (nombre) et 'erreurs' ({paiement_id: message})
+    """
+    from .database import get_paiements_a_quittancer, marquer_quittances_generees, enregistrer_documents
+    
+    _verifier_format(format)
+    
+    lots = []
+    inchangees = 0
+    for paiement, locataire, chambre, appartement in get_paiements_a_quittancer(
+            mois, annee, appartement_id, seulement_sans_quittance=False):
+        empreinte = empreinte_quittance(locataire, appartement, paiement, paiement.mois, paiement.annee, format)
+        if (paiement.empreinte_quittance == empreinte and paiement.chemin_quittance
+                and os.path.exists(paiement.chemin_quittance)):
+            inchangees += 1
+            continue
+        lots.append((paiement, locataire, chambre, appartement, format))
+    
+    if len(lots) <= 1 or max_workers == 1:
+        resultats = [_generer_quittance_lot(lot) for lot in lots]
+    else:
+        max_workers = min(max_workers or os.cpu_count() or 1, len(lots))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            resultats = list(executor.map(_generer_quittance_lot, lots, chunksize=max(1, len(lots) // (max_workers * 4))))
+    
+    generees = {paiement_id: chemin for paiement_id, chemin, _, _, erreur in resultats if erreur is None}
+    empreintes = {paiement_id: empreinte for paiement_id, _, empreinte, _, erreur in resultats if erreur is None}
+    erreurs = {paiement_id: erreur for paiement_id, _, _, _, erreur in resultats if erreur is not None}
+    
+    marquer_quittances_generees(generees, empreintes)
+    enregistrer_documents([document for _, _, _, document, erreur in resultats if document is not None])
+    
+    return {'generees': generees, 'inchangees': inchangees, 'erreurs': erreurs}
+
+
+# ==================== ATTESTATION ANNUELLE ====================
+
+def _textes_attestation(recapitulatif, annee):
+    """Paragraphes de l'attestation, avant et après le tableau des mois"""
+    locataire = recapitulatif['locataire']
+    appartement = recapitulatif['appartement']
+    
+    avant = [
+        'Le bailleur :', '[Votre nom]', '[Votre adresse]', '',
+        'Atteste avoir reçu de :', locataire.nom, appartement.adresse,
+        f'{appartement.code_postal} {appartement.ville}', '',
+        f"Les sommes suivantes au titre des loyers et charges de l'année {annee} :",
+    ]
+    apres = [
+        '',
+        f"Soit un total de {recapitulatif['total']:.2f} € pour {recapitulatif['nb_mois']} mois.",
+        '',
+        f'Fait à [Ville], le {datetime.now().strftime("%d/%m/%Y")}',
+        '',
+        'Signature du bailleur :',
+    ]
+    return avant, apres
+
+
+def _tableau_attestation(recapitulatif):
+    """Lignes du tableau : en-tête, un mois par ligne, puis le total"""
+    lignes = [['Mois', 'Montant', 'Date du paiement', 'Mode de paiement']]
+    for ligne in recapitulatif['mois']:
+        lignes.append([
+            _nom_mois(ligne['mois']),
+            f"{ligne['montant']:.2f} €",
+            ligne['date_paiement'].strftime('%d/%m/%Y') if ligne['date_paiement'] else '',
+            ligne['mode_paiement'] or '',
+        ])
+    lignes.append(['TOTAL', f"{recapitulatif['total']:.2f} €", '', ''])
+    return lignes
+
+
+def render_attestation_annuelle(recapitulatif, annee, format='docx'):
+    """
+    Rend en mémoire l'attestation annuelle de loyers d'un locataire
+    
+    Args:
+        recapitulatif: Élément renvoyé par database.get_recapitulatif_annuel
+        annee: Année de l'attestation
+        format: 'docx' (par défaut) ou 'pdf'
+    
+    Returns:
+        bytes du document
+    """
+    _verifier_format(format)
+    
+    avant, apres = _textes_attestation(recapitulatif, annee)
+    lignes = _tableau_attestation(recapitulatif)
+    buffer = io.BytesIO()
+    
+    if format == 'pdf':
+        normal = _style_pdf('normal')
+        elements = [_paragraphe_pdf(f'ATTESTATION DE LOYERS {annee}', _style_pdf('titre')), _paragraphe_pdf('', normal)]
+        elements.extend(_paragraphe_pdf(texte, normal) for texte in avant)
+        elements.append(_tableau_pdf(lignes))
+        elements.extend(_paragraphe_pdf(texte, normal) for texte in apres)
+        _ecrire_pdf(buffer, elements)
+        return buffer.getvalue()
+    
+    doc = Document()
+    
+    title = doc.add_heading(f'ATTESTATION DE LOYERS {annee}', 0)
+    title.alignment = 1  # Centré
+    doc.add_paragraph()
+    
+    for texte in avant:
+        doc.add_paragraph(texte)
+    
+    table = doc.add_table(rows=len(lignes), cols=len(lignes[0]))
+    table.style = 'Light Grid Accent 1'
+    for row, ligne in zip(table.rows, lignes):
+        for cell, texte in zip(row.cells, ligne):
+            cell.text = texte
+    
+    for texte in apres:
+        doc.add_paragraph(texte)
+    
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+def _chemin_attestation(locataire, annee, extension='docx'):
+    """Chemin de l'attestation annuelle, à côté des dossiers mensuels du locataire"""
+    safe_nom = locataire.nom.replace(' ', '_').replace("'", "").replace('-', '_')
+    filename = f"attestation-{safe_nom.lower()}-{annee}.{extension}"
+    return os.path.join("documents", "locataires", safe_nom, str(annee), filename)
+
+
+def generer_attestation_annuelle(recapitulatif, annee, format='docx'):
+    """
+    Génère l'attestation annuelle d'un locataire et l'écrit sur disque
+    
+    Args:
+        recapitulatif: Élément renvoyé par database.get_recapitulatif_annuel
+        annee: Année de l'attestation
+        format: 'docx' (par défaut) ou 'pdf'
+    
+    Returns:
+        Chemin du fichier généré
+    """
+    contenu = render_attestation_annuelle(recapitulatif, annee, format=format)
+    return fm.ecrire_fichier_atomique(contenu, _chemin_attestation(recapitulatif['locataire'], annee, format),
+                                      document=_index_attestation(recapitulatif, annee))
+
+
+def _index_attestation(recapitulatif, annee):
+    """Champs de la table documents pour une attestation annuelle"""
+    return {
+        'type_document': 'attestation',
+        'locataire_id': recapitulatif['locataire'].id,
+        'appartement_id': recapitulatif['appartement'].id,
+        'annee': annee,
+    }
+
+
+def _generer_attestation_lot(args):
+    """Point d'entrée des processus de génération des attestations"""
+    recapitulatif, annee, format = args
+    locataire_id = recapitulatif['locataire'].id
+    try:
+        contenu = render_attestation_annuelle(recapitulatif, annee, format=format)
+        chemin = fm.ecrire_fichier_atomique(contenu, _chemin_attestation(recapitulatif['locataire'], annee, format))
+        # L'index est enregistré par le processus parent, en une seule écriture
+        return locataire_id, chemin, _document_indexe(_index_attestation(recapitulatif, annee), chemin, contenu), None
+    except Exception as e:
+        return locataire_id, None, None, str(e)
+
+
+def generer_attestations_annee(annee, locataire_id=None, max_workers=None, format='docx'):
+    """
+    Génère en parallèle les attestations annuelles de tous les locataires
+    
+    Les données de tous les locataires viennent d'une seule requête groupée
+    (database.get_recapitulatif_annuel) ; les documents sont ensuite rendus
+    sur un pool de processus.
+    
+    Args:
+        annee: Année des attestations
+        locataire_id: Limiter à un locataire (optionnel)
+        max_workers: Nombre de processus (nombre de CPU par défaut)
+        format: 'docx' (par défaut) ou 'pdf'
+    
+    Returns:
+        dict avec 'generees' ({locataire_id: chemin}) et 'erreurs' ({locataire_id: message})
+    """
+    from .database import get_recapitulatif_annuel, enregistrer_documents
+    
+    _verifier_format(format)
+    
+    lots = [(recap, annee, format) for recap in get_recapitulatif_annuel(annee, locataire_id)]
+    
+    if len(lots) <= 1 or max_workers == 1:
+        resultats = [_generer_attestation_lot(lot) for lot in lots]
+    else:
+        max_workers = min(max_workers or os.cpu_count() or 1, len(lots))
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            resultats = list(executor.map(_generer_attestation_lot, lots, chunksize=max(1, len(lots) // (max_workers * 4))))
+    
+    enregistrer_documents([document for _, _, document, erreur in resultats if erreur is None])
+    
+    return {
+        'generees': {locataire_id: chemin for locataire_id, chemin, _, erreur in resultats if erreur is None},
+        'erreurs': {locataire_id: erreur for locataire_id, _, _, erreur in resultats if erreur is not None},
+    }
+
+
+@lru_cache(maxsize=4096)
 def nombre_en_lettres(nombre):
     """
     Convertit un nombre en lettres (version simplifiée pour les montants)
+    
+    Mémoïsée : les mêmes montants reviennent à chaque quittance.
     """
     unites = ["", "un", "deux", "trois", "quatre", "cinq", "six", "sept", "huit", "neuf"]
     dizaines = ["", "dix", "vingt", "trente", "quarante", "cinquante", "soixante", "soixante-dix", "quatre-vingt", "quatre-vingt-dix"]
@@ -0,0 +1,88 @@
+"""
+Test de charge des écritures concurrentes sur SQLite
+
+Lance N threads qui appellent update_paiement en parallèle sur une base
+temporaire, avec un délai de verrou SQLite volontairement court pour
+provoquer des "database is locked" et vérifier qu'ils sont absorbés par
+les nouvelles tentatives.
+
+Usage :
+    python stress_db.py [--threads 16] [--iterations 50] [--single-writer]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import date
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test de charge des écritures SQLite")
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--single-writer', action='store_true', help="Sérialiser via la file d'écriture unique")
+    args = parser.parse_args()
+
+    # La base doit être configurée avant l'import du module database
+    tmp_dir = tempfile.mkdtemp(prefix="locator-stress-")
+    os.environ['LOCATOR_DB_PATH'] = os.path.join(tmp_dir, "stress.db")
+    os.environ.setdefault('LOCATOR_DB_TIMEOUT', '0.01')
+    os.environ.setdefault('LOCATOR_DB_RETRY_MAX', '12')
+
+    try:
+        from src import database as db
+
+        db.init_db()
+        if args.single_writer:
+            db.enable_single_writer()
+
+        appt = db.create_appartement("1 rue du Test", "Paris", "75001", 50.0)
+        chambre = db.create_chambre(appt.id, "Chambre 1", 500.0)
+        locataire = db.create_locataire("Test Charge", "test@example.com", "", date(2024, 1, 1))
+        paiement_ids = [
+            db.create_paiement(locataire.id, chambre.id, mois, 2024, 500.0).id
+            for mois in range(1, 13)
+        ]
+
+        erreurs = []
+
+        def travailleur(numero):
+            for i in range(args.iterations):
+                paiement_id = paiement_ids[(numero + i) % len(paiement_ids)]
+                try:
+                    if i % 2 == 0:
+                        db.update_paiement(paiement_id, date_paiement=date(2024, 1, 1 + numero % 28), mode_paiement='virement')
+                    else:
+                        db.update_paiement(paiement_id, date_paiement=None, notes=f"thread {numero} iter {i}")
+                except Exception as e:
+                    erreurs.append(e)
+            db.Session.remove()
+
+        debut = time.perf_counter()
+        threads = [threading.Thread(target=travailleur, args=(n,)) for n in range(args.threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        duree = time.perf_counter() - debut
+
+        total = args.threads * args.iterations
+        print(f"{total} écritures en {duree:.2f} s ({total / duree:.0f} écritures/s)")
+        print(f"Erreurs : {len(erreurs)}")
+        for e in erreurs[:5]:
+            print(f"  - {e}")
+
+        if args.single_writer:
+            db.disable_single_writer()
+
+        return 1 if erreurs else 0
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())